@@ -1,19 +1,46 @@
-from flask import Flask, render_template, request, jsonify, session, redirect, url_for
+from flask import Flask, Response, render_template, request, jsonify, session, redirect, url_for
 from flask_cors import CORS
+import click
 import sqlite3
 import hashlib
 import jwt
 import datetime
+import functools
 import json
+import math
 import re
 from collections import Counter
 import os
 import secrets
 import bcrypt
-from werkzeug.security import generate_password_hash, check_password_hash
 import validators
+import db
+from db import get_db
+import migrations
+import importer
+import fingerprints
+import exporter
+import search
+import rollups
+import timeseries
+import cache
+import columnar
+import shards
+import auth
+import passwords
+import classifier
+import writer
+import jobs
+import metrics
+import responses
 
 app = Flask(__name__)
+db.init_app(app)
+metrics.init_app(app)
+# After metrics, whose hook then runs last and records compressed sizes
+responses.init_app(app)
+writer.init_app(app)
+columnar.init_app(app)
 
 # Secure secret key generation
 def generate_secret_key():
@@ -60,107 +87,401 @@ def sanitize_input(text):
 def validate_amount(amount):
     try:
         amount_float = float(amount)
+        # float() accepts 'nan' and 'inf', which no total can hold
+        if not math.isfinite(amount_float):
+            return False, "Amount must be a finite number"
         if amount_float <= 0:
             return False, "Amount must be positive"
         return True, amount_float
     except ValueError:
         return False, "Invalid amount format"
 
+DATE_PATTERN = re.compile(r'[0-9]{4}-[0-9]{2}-[0-9]{2}')
+
 def validate_date(date_str):
     try:
-        datetime.datetime.strptime(date_str, '%Y-%m-%d')
-        return True, date_str
+        # Fast path for canonical YYYY-MM-DD input, which avoids strptime
+        if DATE_PATTERN.fullmatch(date_str):
+            datetime.date(int(date_str[:4]), int(date_str[5:7]), int(date_str[8:]))
+            return True, date_str
+        # Store dates zero-padded so they sort and bucket by month correctly
+        parsed = datetime.datetime.strptime(date_str, '%Y-%m-%d')
+        return True, parsed.strftime('%Y-%m-%d')
     except ValueError:
         return False, "Invalid date format (YYYY-MM-DD)"
 
-# Database initialization
+# Transaction list pagination
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+# Cursors are "<date>:<id>" of the last row on the previous page
+def make_cursor(date, transaction_id):
+    return f'{date}:{transaction_id}'
+
+def parse_cursor(cursor):
+    date_part, separator, id_part = cursor.rpartition(':')
+    if not separator or not id_part.isdigit():
+        return False, "Invalid cursor"
+    is_valid, date_result = validate_date(date_part)
+    if not is_valid:
+        return False, "Invalid cursor"
+    return True, (date_result, int(id_part))
+
+# Translate GET /transactions query parameters into SQL filters, and the
+# same filters as keyword arguments for the columnar cache
+def parse_transaction_filters(args):
+    clauses = []
+    params = []
+    filters = {}
+    
+    type_filter = args.get('type', '').strip().lower()
+    if type_filter:
+        if type_filter not in ['income', 'expense']:
+            return False, "Type must be income or expense"
+        clauses.append('type = ?')
+        params.append(type_filter)
+        filters['type_filter'] = type_filter
+    
+    category_filter = sanitize_input(args.get('category', '').strip().lower())
+    if category_filter:
+        clauses.append('category = ?')
+        params.append(category_filter)
+        filters['category'] = category_filter
+    
+    for name, clause, key in (('from', 'date >= ?', 'start'), ('to', 'date <= ?', 'end')):
+        value = args.get(name, '').strip()
+        if value:
+            is_valid, date_result = validate_date(value)
+            if not is_valid:
+                return False, date_result
+            clauses.append(clause)
+            params.append(date_result)
+            filters[key] = date_result
+    
+    try:
+        limit = int(args.get('limit', DEFAULT_PAGE_SIZE))
+    except ValueError:
+        return False, "Invalid limit"
+    if limit <= 0:
+        return False, "Limit must be positive"
+    limit = min(limit, MAX_PAGE_SIZE)
+    
+    cursor_position = None
+    cursor = args.get('cursor', '').strip()
+    if cursor:
+        is_valid, cursor_result = parse_cursor(cursor)
+        if not is_valid:
+            return False, cursor_result
+        cursor_position = cursor_result
+    
+    return True, (clauses, params, filters, limit, cursor_position)
+
+# Database initialization: the main database and every shard
 def init_db():
-    conn = sqlite3.connect('finance.db')
-    cursor = conn.cursor()
+    shards.init_databases(app)
+
+@app.cli.command('init-db')
+def init_db_command():
+    init_db()
+    print('Database is up to date')
+
+# Queries on the request hot path. Each one must be answered from an index;
+# `flask check-query-plans` verifies that against the current schema.
+LIST_TRANSACTIONS_SQL = '''
+    SELECT id, description, amount, type, category, date
+    FROM transactions WHERE user_id = ?{filters}
+    ORDER BY date DESC, id DESC LIMIT ?
+'''
+
+TRANSACTION_TOTALS_SQL = '''
+    SELECT COUNT(*),
+        SUM(CASE WHEN type = 'income' THEN amount ELSE 0 END),
+        SUM(CASE WHEN type = 'expense' THEN amount ELSE 0 END)
+    FROM transactions WHERE user_id = ?{filters}
+'''
+
+MONTHLY_SUMMARY_SQL = '''
+    SELECT 
+        SUM(CASE WHEN type = 'income' THEN total ELSE 0 END) as total_income,
+        SUM(CASE WHEN type = 'expense' THEN total ELSE 0 END) as total_expenses
+    FROM monthly_rollups 
+    WHERE user_id = ? AND month = ?
+'''
+
+CATEGORY_BREAKDOWN_SQL = '''
+    SELECT category, total
+    FROM monthly_rollups 
+    WHERE user_id = ? AND month = ? AND type = 'expense'
+    ORDER BY total DESC
+'''
+
+RECENT_EXPENSES_SQL = '''
+    SELECT description, amount, category, date
+    FROM transactions 
+    WHERE user_id = ? AND type = 'expense'
+    ORDER BY date DESC LIMIT 10
+'''
+
+HOT_QUERIES = [
+    ('list_transactions', LIST_TRANSACTIONS_SQL.format(filters=''), (1, 50)),
+    ('list_transactions_page',
+     LIST_TRANSACTIONS_SQL.format(filters=' AND type = ? AND (date, id) < (?, ?)'),
+     (1, 'expense', '2024-01-31', 100, 50)),
+    ('monthly_summary', MONTHLY_SUMMARY_SQL, (1, 202401)),
+    ('category_breakdown', CATEGORY_BREAKDOWN_SQL, (1, 202401)),
+    ('recent_expenses', RECENT_EXPENSES_SQL, (1,)),
+    ('timeseries_daily', timeseries.RAW_ROWS_SQL, ('2024-01-01', 1, '2024-01-01', '2024-12-31')),
+    ('timeseries_monthly', timeseries.ROLLUP_ROWS_SQL, (24289, 1, 202401, 202412)),
+    ('export', exporter.EXPORT_ROWS_SQL, (1, '2024-01-01', '2024-12-31')),
+    ('search', search.SEARCH_SQL, ('search_owner : "u1" AND description : "coffee" *', 1, 50, 0)),
+    ('import_fingerprints', fingerprints.EXISTING_FINGERPRINTS_SQL, (1, '[1, 2]')),
+    ('columnar_page_rows', columnar.PAGE_ROWS_SQL, ('[1, 2]', 1)),
+    ('token_state', auth.TOKEN_STATE_SQL, (bytes(16), 1)),
+]
+
+# Statement labels in /metrics
+QUERY_NAMES = [
+    ('list_transactions', LIST_TRANSACTIONS_SQL),
+    ('transaction_totals', TRANSACTION_TOTALS_SQL),
+    ('monthly_summary', MONTHLY_SUMMARY_SQL),
+    ('category_breakdown', CATEGORY_BREAKDOWN_SQL),
+    ('recent_expenses', RECENT_EXPENSES_SQL),
+    ('timeseries_daily', timeseries.RAW_ROWS_SQL),
+    ('timeseries_monthly', timeseries.ROLLUP_ROWS_SQL),
+    ('export', exporter.EXPORT_ROWS_SQL),
+    ('search', search.SEARCH_SQL),
+    ('import_fingerprints', fingerprints.EXISTING_FINGERPRINTS_SQL),
+    ('columnar_page_rows', columnar.PAGE_ROWS_SQL),
+    ('token_state', auth.TOKEN_STATE_SQL),
+    ('insert_transaction', importer.INSERT_TRANSACTION_SQL),
+    ('upsert_rollup', rollups.UPSERT_ROLLUP_SQL),
+]
+
+for name, sql in QUERY_NAMES:
+    metrics.name_query(sql, name)
+
+@app.cli.command('rebuild-rollups')
+def rebuild_rollups_command():
+    init_db()
+    for name in db.database_paths(app):
+        with db.get_pool(app, name).connection() as conn:
+            rollups.rebuild(conn)
+    print('Monthly rollups rebuilt from transactions')
+
+@app.cli.command('verify-rollups')
+def verify_rollups_command():
+    init_db()
+    drift = []
+    for name in db.database_paths(app):
+        with db.get_pool(app, name).connection() as conn:
+            drift.extend(rollups.verify(conn))
+    for entry in drift:
+        print(f"user {entry['user_id']} {entry['month']} {entry['type']}/{entry['category']}: "
+              f"stored {entry['stored']}, expected {entry['expected']}")
+    if drift:
+        print(f'{len(drift)} rollup rows drifted; run `flask --app app rebuild-rollups` to repair')
+        raise SystemExit(1)
+    print('Monthly rollups match transactions')
+
+@app.cli.command('check-query-plans')
+def check_query_plans_command():
+    init_db()
+    with db.get_pool(app).connection() as conn:
+        scans = migrations.find_full_scans(conn, HOT_QUERIES)
+    for name, detail in scans:
+        print(f'{name}: {detail}')
+    if scans:
+        raise SystemExit(1)
+    print(f'All {len(HOT_QUERIES)} hot queries use index searches')
+
+# Move users whose data is not on the shard the hash ring assigns them, or
+# one user to a named database with --user and --to
+@app.cli.command('rebalance-shards')
+@click.option('--dry-run', is_flag=True, help='Only list the moves')
+@click.option('--user', 'user_id', type=int, help='Move this user only')
+@click.option('--to', 'target', help='Database to move --user to (main, shard0, ...)')
+def rebalance_shards_command(dry_run, user_id, target):
+    init_db()
+    if user_id is not None:
+        with db.get_pool(app).connection() as conn:
+            moves = [(user_id, db.placement(conn, user_id), target or shards.get_ring(app).owner(user_id))]
+    else:
+        moves = shards.plan_moves(app)
     
-    # Users table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username TEXT UNIQUE NOT NULL,
-            password TEXT NOT NULL,
-            email TEXT UNIQUE NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    
-    # Transactions table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS transactions (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            description TEXT NOT NULL,
-            amount REAL NOT NULL,
-            type TEXT NOT NULL,
-            category TEXT,
-            date TEXT NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users (id)
-        )
-    ''')
-    
-    # Categories table for ML training
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS categories (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            description TEXT NOT NULL,
-            category TEXT NOT NULL,
-            FOREIGN KEY (user_id) REFERENCES users (id)
-        )
-    ''')
-    
-    conn.commit()
-    conn.close()
-
-# Simple ML-based transaction classification
-def classify_transaction(description):
-    description = description.lower()
-    
-    # Define category keywords
-    categories = {
-        'groceries': ['food', 'grocery', 'supermarket', 'market', 'fresh', 'organic', 'produce'],
-        'transportation': ['uber', 'lyft', 'taxi', 'gas', 'fuel', 'parking', 'metro', 'bus', 'train'],
-        'entertainment': ['movie', 'theater', 'concert', 'game', 'netflix', 'spotify', 'amazon prime'],
-        'utilities': ['electric', 'water', 'gas', 'internet', 'phone', 'cable', 'wifi'],
-        'shopping': ['amazon', 'walmart', 'target', 'clothing', 'shoes', 'electronics'],
-        'dining': ['restaurant', 'cafe', 'coffee', 'pizza', 'burger', 'sushi', 'dinner', 'lunch'],
-        'healthcare': ['pharmacy', 'doctor', 'medical', 'dental', 'vision', 'insurance'],
-        'education': ['book', 'course', 'tuition', 'school', 'college', 'university'],
-        'travel': ['hotel', 'flight', 'airbnb', 'vacation', 'trip', 'booking']
-    }
+    moved_users = 0
+    for move_user_id, source, destination in moves:
+        if dry_run:
+            print(f'user {move_user_id}: {source} -> {destination}')
+            continue
+        try:
+            moved = shards.move_user(app, move_user_id, destination)
+        except shards.MoveError as e:
+            print(f'user {move_user_id}: skipped, {e}')
+            continue
+        print(f'user {move_user_id}: {source} -> {destination}, {moved} transactions')
+        moved_users += 1
     
-    # Find matching category
-    for category, keywords in categories.items():
-        for keyword in keywords:
-            if keyword in description:
-                return category
+    if dry_run:
+        print(f'{len(moves)} users to move')
+        return
     
-    return 'other'
+    swept = shards.sweep_orphans(app)
+    if swept:
+        print(f'Removed leftover data of {swept} users')
+    print(f'{moved_users} of {len(moves)} users moved')
+
+# CSV import settings. Uploads are streamed from disk, so the cap only
+# bounds disk usage for the spooled request body.
+MAX_UPLOAD_SIZE = int(os.environ.get('FINANCE_MAX_UPLOAD_MB', '500')) * 1024 * 1024
+
+# Validate one CSV row (Description, Amount, Type[, Date])
+def parse_csv_row(parts):
+    if len(parts) < 3:
+        return False, "Expected at least description, amount and type columns"
+    
+    description = sanitize_input(parts[0].strip())
+    amount_str = parts[1].strip()
+    type_transaction = parts[2].strip().lower()
+    # Rows without a date column are dated by the import (see importer.import_csv)
+    date = parts[3].strip() if len(parts) > 3 else None
+    
+    if not description:
+        return False, "Description is required"
+    
+    # Validate amount
+    is_valid, amount_result = validate_amount(amount_str)
+    if not is_valid:
+        return False, f'Invalid amount: {amount_result}'
+    
+    # Validate type
+    if type_transaction not in ['income', 'expense']:
+        return False, 'Invalid type: must be income or expense'
+    
+    # Validate date
+    date_result = None
+    if date is not None:
+        is_valid, date_result = validate_date(date)
+        if not is_valid:
+            return False, f'Invalid date: {date_result}'
+    
+    return True, (description, amount_result, type_transaction, date_result)
+
+# Validate one transaction from a JSON body; same result shape as parse_csv_row
+def parse_transaction(data):
+    if not isinstance(data, dict):
+        return False, 'Transaction must be an object'
+    
+    description = data.get('description', '')
+    amount = data.get('amount')
+    type_transaction = data.get('type', '')
+    date = data.get('date', '')
+    if not all(isinstance(value, str) for value in (description, type_transaction, date)):
+        return False, 'Description, type and date must be strings'
+    # JSON true and false are ints to Python
+    if amount is not None and (isinstance(amount, bool) or not isinstance(amount, (int, float, str))):
+        return False, 'Amount must be a number or a numeric string'
+    description = description.strip()
+    type_transaction = type_transaction.lower()
+    date = date.strip()
+    
+    # Input validation
+    if not description or amount is None or not type_transaction or not date:
+        return False, 'All fields are required'
+    
+    # Validate amount
+    is_valid, amount_result = validate_amount(amount)
+    if not is_valid:
+        return False, amount_result
+    
+    # Validate transaction type
+    if type_transaction not in ['income', 'expense']:
+        return False, 'Type must be income or expense'
+    
+    # Validate date
+    is_valid, date_result = validate_date(date)
+    if not is_valid:
+        return False, date_result
+    
+    # Sanitize description
+    return True, (sanitize_input(description), amount_result, type_transaction, date_result)
+
+# Learned per-user classification, trained from the categories table
+MODEL_CACHE_BYTES = int(os.environ.get('FINANCE_MODEL_CACHE_MB', '64')) * 1024 * 1024
+
+def load_category_corrections(user_id):
+    return get_db().execute('SELECT description, category FROM categories WHERE user_id = ?', (user_id,))
 
-# Secure password hashing
+def category_data_version(user_id):
+    return cache.get_data_version(get_db(), user_id)
+
+def count_category_corrections(user_id):
+    return get_db().execute('SELECT COUNT(*) FROM categories WHERE user_id = ?', (user_id,)).fetchone()[0]
+
+category_models = classifier.ModelCache(MODEL_CACHE_BYTES, load_category_corrections,
+                                        category_data_version,
+                                        count_category_corrections)
+
+# Background CSV imports; the workers start with the first request and pick
+# up jobs an earlier process left unfinished
+jobs.init_app(app, parse_csv_row, category_models.classify_many)
+
+@app.before_request
+def start_import_jobs():
+    jobs.get_jobs(app)
+
+# Secure password hashing, run in the bounded passwords worker pool
 def hash_password(password):
-    return generate_password_hash(password, method='pbkdf2:sha256')
+    return passwords.hash_password(password)
 
 def verify_password(password, hashed_password):
-    return check_password_hash(hashed_password, password)
+    return passwords.verify_password(password, hashed_password)
+
+# Best effort: a busy pool, a failed hash, a database error or a concurrent
+# change just leaves the old hash, and the login goes ahead
+def rehash_password(user_id, old_hash, password):
+    try:
+        new_hash = hash_password(password)
+    except passwords.HashingBusy:
+        return
+    except Exception:
+        app.logger.exception('Rehashing the password of user %s failed', user_id)
+        return
+    conn = db.get_main_db()
+    try:
+        conn.execute('UPDATE users SET password = ? WHERE id = ? AND password = ?', (new_hash, user_id, old_hash))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        app.logger.exception('Storing the rehashed password of user %s failed', user_id)
+
+def hashing_busy_response():
+    response = jsonify({'error': 'Server is busy, please try again shortly'})
+    response.headers['Retry-After'] = '1'
+    return response, 503
+
+# A shard move switched the user's database during the request; retrying
+# reads the new placement
+@app.errorhandler(db.UserMoved)
+def user_moved(error):
+    response = jsonify({'error': 'Your data is being moved, please try again'})
+    response.headers['Retry-After'] = '1'
+    return response, 503
 
 # Generate JWT token
-def generate_token(user_id, username):
+def generate_token(user_id, username, generation):
     payload = {
         'user_id': user_id,
         'username': username,
+        'gen': generation,
+        # Tokens issued in the same second differ, so /logout revokes only one
+        'jti': secrets.token_urlsafe(8),
         'exp': datetime.datetime.utcnow() + datetime.timedelta(hours=24),
         'iat': datetime.datetime.utcnow()
     }
     return jwt.encode(payload, app.secret_key, algorithm='HS256')
 
 # Verify JWT token
+@metrics.timed('verify_token')
 def verify_token(token):
     try:
         payload = jwt.decode(token, app.secret_key, algorithms=['HS256'])
@@ -170,6 +491,64 @@ def verify_token(token):
     except jwt.InvalidTokenError:
         return None
 
+# Tokens that verified recently, so repeat requests skip the signature check
+TOKEN_CACHE_SIZE = int(os.environ.get('FINANCE_TOKEN_CACHE_SIZE', '10000'))
+TOKEN_CACHE_TTL = int(os.environ.get('FINANCE_TOKEN_CACHE_TTL', '300'))
+# Seconds a cached token is trusted before its revocation state is read
+# from the database again, i.e. how long other processes take to notice a
+# logout (0 checks on every request)
+TOKEN_RECHECK_SECONDS = float(os.environ.get('FINANCE_TOKEN_RECHECK_SECONDS', '1'))
+
+token_cache = auth.TokenCache(TOKEN_CACHE_SIZE, TOKEN_CACHE_TTL, TOKEN_RECHECK_SECONDS)
+
+# Revocations are stored in the main database, whichever shard holds the user
+def check_token(digest, payload):
+    return auth.is_current(db.get_main_db(), digest, payload)
+
+# The verified, unrevoked payload of a bearer token, or None
+def authenticate(token):
+    return token_cache.get(token, verify_token, check_token) if token else None
+
+def get_bearer_token():
+    return request.headers.get('Authorization', '').removeprefix('Bearer ')
+
+# Authenticate the request and pass the user's id as the first argument
+def require_auth(view):
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        payload = authenticate(get_bearer_token())
+        
+        if not payload:
+            return jsonify({'error': 'Invalid or expired token'}), 401
+        
+        db.bind_user(payload['user_id'])
+        return view(payload['user_id'], *args, **kwargs)
+    return wrapper
+
+# Per-user cache of serialized GET responses, keyed by data version
+RESPONSE_CACHE_BYTES = int(os.environ.get('FINANCE_RESPONSE_CACHE_MB', '64')) * 1024 * 1024
+
+response_cache = cache.ResponseCache(RESPONSE_CACHE_BYTES)
+
+# Serve a GET endpoint through the response cache. build() returns the usual
+# (response, status) pair; only 200 responses are cached.
+def cached_json(endpoint, user_id, build, *extra):
+    version = cache.get_data_version(get_db(), user_id)
+    key = cache.make_key(user_id, version, endpoint, request.args, *extra)
+    entry = response_cache.get(key)
+    cache_status = 'HIT'
+    if entry is None:
+        response, status = build()
+        if status != 200:
+            return response, status
+        
+        entry = cache.entry_from_response(response)
+        response_cache.put(key, entry)
+        cache_status = 'MISS'
+    
+    body, encoding = response_cache.encode(key, entry, request.accept_encodings)
+    return cache.build_response(entry, request, cache_status, body, encoding)
+
 # Routes
 @app.route('/')
 def index():
@@ -203,25 +582,30 @@ def register():
     if len(username) < 3 or len(username) > 50:
         return jsonify({'error': 'Username must be between 3 and 50 characters'}), 400
     
-    conn = sqlite3.connect('finance.db')
+    # Hash before taking a database connection so slow hashing never holds one
+    try:
+        hashed_password = hash_password(password)
+    except passwords.HashingBusy:
+        return hashing_busy_response()
+    except Exception as e:
+        return jsonify({'error': 'Registration failed'}), 500
+    
+    conn = db.get_main_db()
     cursor = conn.cursor()
     
     try:
-        hashed_password = hash_password(password)
         cursor.execute('INSERT INTO users (username, password, email) VALUES (?, ?, ?)',
                       (username, hashed_password, email))
+        user_id = cursor.lastrowid
+        shards.place_user(cursor, app, user_id)
         conn.commit()
         
-        user_id = cursor.lastrowid
-        token = generate_token(user_id, username)
+        token = generate_token(user_id, username, 0)
         
-        conn.close()
         return jsonify({'token': token, 'user_id': user_id, 'username': username}), 201
     except sqlite3.IntegrityError:
-        conn.close()
         return jsonify({'error': 'Username or email already exists'}), 400
     except Exception as e:
-        conn.close()
         return jsonify({'error': 'Registration failed'}), 500
 
 @app.route('/login', methods=['POST'])
@@ -236,166 +620,452 @@ def login():
     # Sanitize username
     username = sanitize_input(username)
     
-    conn = sqlite3.connect('finance.db')
+    conn = db.get_main_db()
     cursor = conn.cursor()
     
     try:
-        cursor.execute('SELECT id, username, password FROM users WHERE username = ?', (username,))
+        cursor.execute('SELECT id, username, password, token_generation FROM users WHERE username = ?',
+                       (username,))
         user = cursor.fetchone()
-        conn.close()
+        
+        # Return the connection to the pool while the password is checked
+        db.close_db()
         
         if user and verify_password(password, user[2]):
-            token = generate_token(user[0], user[1])
+            # Upgrade hashes made with older hashing parameters
+            if passwords.needs_rehash(user[2]):
+                rehash_password(user[0], user[2], password)
+            
+            token = generate_token(user[0], user[1], user[3])
             return jsonify({'token': token, 'user_id': user[0], 'username': user[1]}), 200
         else:
             return jsonify({'error': 'Invalid credentials'}), 401
+    except passwords.HashingBusy:
+        return hashing_busy_response()
     except Exception as e:
-        conn.close()
         return jsonify({'error': 'Login failed'}), 500
 
-@app.route('/transactions', methods=['GET', 'POST'])
-def transactions():
-    token = request.headers.get('Authorization', '').replace('Bearer ', '')
-    payload = verify_token(token)
+@app.route('/logout', methods=['POST'])
+def logout():
+    token = get_bearer_token()
+    payload = authenticate(token)
     
     if not payload:
         return jsonify({'error': 'Invalid or expired token'}), 401
     
-    user_id = payload['user_id']
+    conn = db.get_main_db()
+    try:
+        auth.store_revocation(conn, auth.token_digest(token), payload)
+    except Exception as e:
+        conn.rollback()
+        return jsonify({'error': 'Logout failed'}), 500
+    token_cache.revoke(token, payload)
+    return jsonify({'message': 'Logged out successfully'}), 200
+
+# Invalidate every token issued to the user so far, e.g. after a password leak
+@app.route('/logout/all', methods=['POST'])
+@require_auth
+def logout_all(user_id):
+    conn = db.get_main_db()
+    try:
+        generation = auth.next_generation(conn, user_id)
+    except Exception as e:
+        conn.rollback()
+        return jsonify({'error': 'Logout failed'}), 500
+    token_cache.revoke_user(user_id, generation)
+    return jsonify({'message': 'All sessions logged out'}), 200
+
+# format=columnar sends a page as parallel arrays instead of one object per
+# transaction, with type and category as codes into lists of their values:
+# {"id": [...], "description": [...], "amount": [...], "date": [...],
+#  "type": {"values": [...], "codes": [...]}, "category": {...}}
+LISTING_FORMATS = ('rows', 'columnar')
+
+def dictionary_encode(values):
+    codes = {}
+    return {'codes': [codes.setdefault(value, len(codes)) for value in values], 'values': list(codes)}
+
+def columnar_listing(rows):
+    ids, descriptions, amounts, types, categories, dates = zip(*rows) if rows else ((),) * 6
+    return {
+        'id': ids,
+        'description': descriptions,
+        'amount': amounts,
+        'type': dictionary_encode(types),
+        'category': dictionary_encode(categories),
+        'date': dates
+    }
+
+def list_transactions(user_id):
+    is_valid, filters_result = parse_transaction_filters(request.args)
+    if not is_valid:
+        return jsonify({'error': filters_result}), 400
+    clauses, params, column_filters, limit, cursor_position = filters_result
     
-    if request.method == 'POST':
-        data = request.get_json()
-        description = data.get('description', '').strip()
-        amount = data.get('amount')
-        type_transaction = data.get('type', '').lower()
-        date = data.get('date', '').strip()
-        
-        # Input validation
-        if not description or amount is None or not type_transaction or not date:
-            return jsonify({'error': 'All fields are required'}), 400
-        
-        # Validate amount
-        is_valid, amount_result = validate_amount(amount)
-        if not is_valid:
-            return jsonify({'error': amount_result}), 400
+    response_format = request.args.get('format', 'rows').strip().lower()
+    if response_format not in LISTING_FORMATS:
+        return jsonify({'error': 'Format must be rows or columnar'}), 400
+    
+    conn = get_db()
+    cursor = conn.cursor()
+    
+    try:
+        filters = ''.join(' AND ' + clause for clause in clauses)
+        columns = columnar.get_columns(conn, user_id)
+        if columns is not None:
+            # The cache picks the page's ids; only those rows are read
+            ids = columns.page(limit + 1, before=cursor_position, **column_filters)
+            rows = columnar.fetch_rows(conn, user_id, ids)
+        else:
+            page_filters = filters
+            page_params = [user_id] + params
+            if cursor_position:
+                page_filters += ' AND (date, id) < (?, ?)'
+                page_params += list(cursor_position)
+            
+            # Fetch one extra row to know whether another page follows
+            cursor.execute(LIST_TRANSACTIONS_SQL.format(filters=page_filters), page_params + [limit + 1])
+            rows = cursor.fetchall()
         
-        # Validate transaction type
-        if type_transaction not in ['income', 'expense']:
-            return jsonify({'error': 'Type must be income or expense'}), 400
+        page = rows[:limit]
+        if response_format == 'columnar':
+            response = jsonify(columnar_listing(page))
+        else:
+            response = jsonify([{
+                'id': row[0],
+                'description': row[1],
+                'amount': row[2],
+                'type': row[3],
+                'category': row[4],
+                'date': row[5]
+            } for row in page])
+        if len(rows) > limit:
+            last = page[-1]
+            response.headers['X-Next-Cursor'] = make_cursor(last[5], last[0])
         
-        # Validate date
-        is_valid, date_result = validate_date(date)
-        if not is_valid:
-            return jsonify({'error': date_result}), 400
+        # Totals for the whole filtered set are only needed with the first page
+        if not cursor_position:
+            if columns is not None:
+                count, total_income, total_expenses = columns.totals(**column_filters)
+            else:
+                cursor.execute(TRANSACTION_TOTALS_SQL.format(filters=filters), [user_id] + params)
+                count, total_income, total_expenses = cursor.fetchone()
+            response.headers['X-Total-Count'] = str(count)
+            response.headers['X-Total-Income'] = str(total_income or 0)
+            response.headers['X-Total-Expenses'] = str(total_expenses or 0)
         
-        # Sanitize description
-        description = sanitize_input(description)
+        return response, 200
+    except Exception as e:
+        return jsonify({'error': 'Failed to load transactions'}), 500
+
+def search_transactions(user_id):
+    match = search.build_match(user_id, request.args.get('q', ''))
+    if match is None:
+        return jsonify({'error': 'Search query is required'}), 400
+    
+    try:
+        limit = int(request.args.get('limit', DEFAULT_PAGE_SIZE))
+    except ValueError:
+        return jsonify({'error': 'Invalid limit'}), 400
+    if limit <= 0:
+        return jsonify({'error': 'Limit must be positive'}), 400
+    limit = min(limit, MAX_PAGE_SIZE)
+    
+    # Results are ordered by relevance, so the cursor is an offset
+    cursor_value = request.args.get('cursor', '0').strip() or '0'
+    if not cursor_value.isdigit():
+        return jsonify({'error': 'Invalid cursor'}), 400
+    offset = int(cursor_value)
+    
+    try:
+        rows = search.search(get_db(), user_id, match, limit + 1, offset)
+    except Exception as e:
+        return jsonify({'error': 'Failed to search transactions'}), 500
+    
+    transactions = []
+    for row in rows[:limit]:
+        transactions.append({
+            'id': row[0],
+            'description': row[1],
+            'amount': row[2],
+            'type': row[3],
+            'category': row[4],
+            'date': row[5]
+        })
+    
+    response = jsonify(transactions)
+    if len(rows) > limit:
+        response.headers['X-Next-Cursor'] = str(offset + limit)
+    return response, 200
+
+@app.route('/transactions/search')
+@require_auth
+def transactions_search(user_id):
+    return cached_json('search', user_id, lambda: search_transactions(user_id))
+
+# Insert classified (description, amount, type, category, date) rows and
+# return their ids. With write-behind enabled the group-commit writer thread
+# commits them together with other requests' rows.
+def insert_transactions(user_id, rows):
+    transaction_writer = writer.get_writer()
+    if transaction_writer is not None:
+        return transaction_writer.submit(user_id, rows).result(timeout=writer.WRITE_TIMEOUT)
+    
+    conn = get_db()
+    try:
+        ids = importer.insert_rows(conn.cursor(), user_id, rows)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return ids
+
+@app.route('/transactions', methods=['GET', 'POST'])
+@require_auth
+def transactions(user_id):
+    if request.method == 'POST':
+        is_valid, result = parse_transaction(request.get_json(silent=True))
+        if not is_valid:
+            return jsonify({'error': result}), 400
+        description, amount_result, type_transaction, date_result = result
         
         # Auto-classify transaction
-        category = classify_transaction(description)
-        
-        conn = sqlite3.connect('finance.db')
-        cursor = conn.cursor()
+        category = category_models.classify(user_id, description)
         
         try:
-            cursor.execute('''
-                INSERT INTO transactions (user_id, description, amount, type, category, date)
-                VALUES (?, ?, ?, ?, ?, ?)
-            ''', (user_id, description, amount_result, type_transaction, category, date_result))
-            
-            conn.commit()
-            conn.close()
+            insert_transactions(user_id, [(description, amount_result, type_transaction, category, date_result)])
             
             return jsonify({'message': 'Transaction added successfully', 'category': category}), 201
+        except db.UserMoved:
+            raise
         except Exception as e:
-            conn.close()
             return jsonify({'error': 'Failed to add transaction'}), 500
     
     else:  # GET request
-        conn = sqlite3.connect('finance.db')
-        cursor = conn.cursor()
-        
-        try:
-            cursor.execute('''
-                SELECT id, description, amount, type, category, date
-                FROM transactions WHERE user_id = ? ORDER BY date DESC
-            ''', (user_id,))
-            
-            transactions = []
-            for row in cursor.fetchall():
-                transactions.append({
-                    'id': row[0],
-                    'description': row[1],
-                    'amount': row[2],
-                    'type': row[3],
-                    'category': row[4],
-                    'date': row[5]
-                })
-            
-            conn.close()
-            return jsonify(transactions), 200
-        except Exception as e:
-            conn.close()
-            return jsonify({'error': 'Failed to load transactions'}), 500
+        return cached_json('transactions', user_id, lambda: list_transactions(user_id))
 
-@app.route('/transactions/<int:transaction_id>', methods=['DELETE'])
-def delete_transaction(transaction_id):
-    token = request.headers.get('Authorization', '').replace('Bearer ', '')
-    payload = verify_token(token)
+# Batch writes: one request, one SQLite transaction. Items are reported back
+# in request order; with "atomic": true a single bad item fails the batch.
+MAX_BATCH_SIZE = int(os.environ.get('FINANCE_MAX_BATCH_SIZE', '1000'))
+
+def parse_batch(data, field):
+    if not isinstance(data, dict) or not isinstance(data.get(field), list):
+        return False, f'Request body must contain a "{field}" array'
+    items = data[field]
+    if not items:
+        return False, f'"{field}" must not be empty'
+    if len(items) > MAX_BATCH_SIZE:
+        return False, f'Too many items in one batch (max {MAX_BATCH_SIZE})'
+    return True, (items, bool(data.get('atomic', False)))
+
+def batch_response(results, atomic):
+    failed = sum(1 for result in results if result['status'] == 'error')
+    if atomic and failed:
+        # Nothing was written, so the valid items are reported as skipped
+        for result in results:
+            if result['status'] != 'error':
+                result['status'] = 'skipped'
+    succeeded = sum(1 for result in results if result['status'] not in ('error', 'skipped'))
+    status = 400 if atomic and failed else 200
+    return jsonify({'succeeded': succeeded, 'failed': failed, 'atomic': atomic, 'results': results}), status
+
+@app.route('/transactions/batch', methods=['POST'])
+@require_auth
+def create_transactions_batch(user_id):
+    is_valid, batch_result = parse_batch(request.get_json(silent=True), 'transactions')
+    if not is_valid:
+        return jsonify({'error': batch_result}), 400
+    items, atomic = batch_result
     
-    if not payload:
-        return jsonify({'error': 'Invalid or expired token'}), 401
+    results = []
+    rows = []
+    for index, item in enumerate(items):
+        is_valid, row_result = parse_transaction(item)
+        if is_valid:
+            results.append({'index': index, 'status': 'created'})
+            rows.append(row_result)
+        else:
+            results.append({'index': index, 'status': 'error', 'error': row_result})
     
-    user_id = payload['user_id']
+    if not rows or (atomic and len(rows) < len(items)):
+        return batch_response(results, atomic)
+    
+    categories = category_models.classify_many(user_id, [row[0] for row in rows])
+    
+    try:
+        ids = insert_transactions(user_id, [
+            (description, amount, type_transaction, category, date)
+            for (description, amount, type_transaction, date), category in zip(rows, categories)
+        ])
+    except db.UserMoved:
+        raise
+    except Exception as e:
+        return jsonify({'error': 'Failed to add transactions'}), 500
+    
+    created = iter(zip(ids, categories))
+    for result in results:
+        if result['status'] == 'created':
+            result['id'], result['category'] = next(created)
+    
+    return batch_response(results, atomic)
+
+@app.route('/transactions/batch', methods=['DELETE'])
+@require_auth
+def delete_transactions_batch(user_id):
+    is_valid, batch_result = parse_batch(request.get_json(silent=True), 'ids')
+    if not is_valid:
+        return jsonify({'error': batch_result}), 400
+    ids, atomic = batch_result
+    
+    if not all(isinstance(transaction_id, int) and not isinstance(transaction_id, bool) and transaction_id > 0
+               for transaction_id in ids):
+        return jsonify({'error': 'Transaction IDs must be positive integers'}), 400
+    
+    conn = get_db()
+    cursor = conn.cursor()
     
+    try:
+        # json_each avoids a variable per id in the IN list. RETURNING gives
+        # the rows this statement deleted, so a concurrent delete of the same
+        # rows cannot take them off the rollups twice.
+        cursor.execute('''
+            DELETE FROM transactions
+            WHERE user_id = ? AND id IN (SELECT value FROM json_each(?))
+            RETURNING id, amount, type, category, date
+        ''', (user_id, json.dumps(ids)))
+        found = {row[0]: row[1:] for row in cursor.fetchall()}
+        
+        results = []
+        deleted = {}
+        seen = set()
+        missing = 0
+        for index, transaction_id in enumerate(ids):
+            if transaction_id in seen:
+                # Already handled earlier in the batch; not an error
+                results.append({'index': index, 'id': transaction_id, 'status': 'skipped',
+                                'reason': 'Duplicate transaction ID'})
+                continue
+            seen.add(transaction_id)
+            if transaction_id in found:
+                deleted[transaction_id] = found[transaction_id]
+                results.append({'index': index, 'id': transaction_id, 'status': 'deleted'})
+            else:
+                missing += 1
+                results.append({'index': index, 'id': transaction_id, 'status': 'error',
+                                'error': 'Transaction not found'})
+        
+        if not deleted or (atomic and missing):
+            conn.rollback()
+            return batch_response(results, atomic)
+        
+        rollups.remove_transactions(cursor, user_id, list(deleted.values()))
+        cache.bump_data_version(cursor, user_id)
+        columnar.record_delete(cursor, user_id, [(transaction_id, row[3]) for transaction_id, row in deleted.items()])
+        
+        conn.commit()
+    except db.UserMoved:
+        raise
+    except Exception as e:
+        conn.rollback()
+        return jsonify({'error': 'Failed to delete transactions'}), 500
+    
+    return batch_response(results, atomic)
+
+@app.route('/transactions/<int:transaction_id>', methods=['DELETE'])
+@require_auth
+def delete_transaction(user_id, transaction_id):
     # Validate transaction_id
     if transaction_id <= 0:
         return jsonify({'error': 'Invalid transaction ID'}), 400
     
-    conn = sqlite3.connect('finance.db')
+    conn = get_db()
     cursor = conn.cursor()
     
     try:
-        cursor.execute('DELETE FROM transactions WHERE id = ? AND user_id = ?',
+        # Only the request that actually deletes the row gets it back
+        cursor.execute('DELETE FROM transactions WHERE id = ? AND user_id = ? RETURNING amount, type, category, date',
                       (transaction_id, user_id))
-        
-        if cursor.rowcount == 0:
-            conn.close()
+        row = cursor.fetchone()
+        if not row:
+            conn.rollback()
             return jsonify({'error': 'Transaction not found'}), 404
         
+        rollups.remove_transactions(cursor, user_id, [row])
+        cache.bump_data_version(cursor, user_id)
+        columnar.record_delete(cursor, user_id, [(transaction_id, row[3])])
+        
         conn.commit()
-        conn.close()
         
         return jsonify({'message': 'Transaction deleted successfully'}), 200
+    except db.UserMoved:
+        raise
     except Exception as e:
-        conn.close()
+        conn.rollback()
         return jsonify({'error': 'Failed to delete transaction'}), 500
 
-@app.route('/analytics')
-def analytics():
-    token = request.headers.get('Authorization', '').replace('Bearer ', '')
-    payload = verify_token(token)
+@app.route('/transactions/<int:transaction_id>/category', methods=['POST'])
+@require_auth
+def correct_category(user_id, transaction_id):
+    # Validate transaction_id
+    if transaction_id <= 0:
+        return jsonify({'error': 'Invalid transaction ID'}), 400
     
-    if not payload:
-        return jsonify({'error': 'Invalid or expired token'}), 401
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not isinstance(data.get('category'), str):
+        return jsonify({'error': 'Request body must contain a "category" string'}), 400
+    category = sanitize_input(data['category']).strip().lower()
+    if category not in classifier.CATEGORIES:
+        return jsonify({'error': 'Unknown category'}), 400
     
-    user_id = payload['user_id']
+    conn = get_db()
+    cursor = conn.cursor()
     
-    conn = sqlite3.connect('finance.db')
+    try:
+        # Take the write lock before reading the old category, so concurrent
+        # corrections of the same row apply their rollup changes in turn
+        cursor.execute('BEGIN IMMEDIATE')
+        cursor.execute('SELECT description, amount, type, category, date FROM transactions WHERE id = ? AND user_id = ?',
+                      (transaction_id, user_id))
+        row = cursor.fetchone()
+        if not row:
+            conn.rollback()
+            return jsonify({'error': 'Transaction not found'}), 404
+        description, amount, type_transaction, old_category, date = row
+        
+        # Store the correction as a training example for this user's model
+        cursor.execute('UPDATE transactions SET category = ? WHERE id = ? AND user_id = ?',
+                      (category, transaction_id, user_id))
+        if not cursor.rowcount:
+            conn.rollback()
+            return jsonify({'error': 'Transaction not found'}), 404
+        if category != old_category:
+            rollups.remove_transactions(cursor, user_id, [(amount, type_transaction, old_category, date)])
+            rollups.add_transactions(cursor, user_id, [(amount, type_transaction, category, date)])
+        cursor.execute('INSERT INTO categories (user_id, description, category) VALUES (?, ?, ?)',
+                      (user_id, description, category))
+        cache.bump_data_version(cursor, user_id)
+        columnar.record_category(cursor, user_id, transaction_id, date, category)
+        conn.commit()
+        
+        category_models.record(user_id, description, category)
+        
+        return jsonify({'message': 'Category updated successfully', 'category': category}), 200
+    except db.UserMoved:
+        raise
+    except Exception as e:
+        conn.rollback()
+        return jsonify({'error': 'Failed to update category'}), 500
+
+def build_analytics(user_id):
+    conn = get_db()
     cursor = conn.cursor()
     
     try:
         # Get current month's data
-        current_month = datetime.datetime.now().strftime('%Y-%m')
+        current_month = migrations.month_key(datetime.datetime.now().strftime('%Y-%m-%d'))
         
         # Monthly summary
-        cursor.execute('''
-            SELECT 
-                SUM(CASE WHEN type = 'income' THEN amount ELSE 0 END) as total_income,
-                SUM(CASE WHEN type = 'expense' THEN amount ELSE 0 END) as total_expenses
-            FROM transactions 
-            WHERE user_id = ? AND date LIKE ?
-        ''', (user_id, f'{current_month}%'))
+        cursor.execute(MONTHLY_SUMMARY_SQL, (user_id, current_month))
         
         summary = cursor.fetchone()
         total_income = summary[0] or 0
@@ -403,13 +1073,7 @@ def analytics():
         net_income = total_income - total_expenses
         
         # Category breakdown
-        cursor.execute('''
-            SELECT category, SUM(amount) as total
-            FROM transactions 
-            WHERE user_id = ? AND type = 'expense' AND date LIKE ?
-            GROUP BY category
-            ORDER BY total DESC
-        ''', (user_id, f'{current_month}%'))
+        cursor.execute(CATEGORY_BREAKDOWN_SQL, (user_id, current_month))
         
         categories = []
         for row in cursor.fetchall():
@@ -419,12 +1083,7 @@ def analytics():
             })
         
         # Recent transactions for insights
-        cursor.execute('''
-            SELECT description, amount, category, date
-            FROM transactions 
-            WHERE user_id = ? AND type = 'expense'
-            ORDER BY date DESC LIMIT 10
-        ''', (user_id,))
+        cursor.execute(RECENT_EXPENSES_SQL, (user_id,))
         
         recent_transactions = []
         for row in cursor.fetchall():
@@ -435,8 +1094,6 @@ def analytics():
                 'date': row[3]
             })
         
-        conn.close()
-        
         # Generate insights
         insights = []
         if total_expenses > total_income * 0.8:
@@ -463,19 +1120,134 @@ def analytics():
             'insights': insights
         }), 200
     except Exception as e:
-        conn.close()
         return jsonify({'error': 'Failed to load analytics'}), 500
 
-@app.route('/upload', methods=['POST'])
-def upload_csv():
-    token = request.headers.get('Authorization', '').replace('Bearer ', '')
-    payload = verify_token(token)
+@app.route('/analytics')
+@require_auth
+def analytics(user_id):
+    # The summary covers the current month, so the date is part of the key
+    return cached_json('analytics', user_id, lambda: build_analytics(user_id), datetime.date.today())
+
+def build_timeseries(user_id, bucket, start, end, window):
+    try:
+        conn = get_db()
+        columns = columnar.get_columns(conn, user_id) if bucket != 'month' else None
+        result = timeseries.compute(conn, user_id, bucket, start, end, window, columns)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': 'Failed to load time series'}), 500
     
-    if not payload:
-        return jsonify({'error': 'Invalid or expired token'}), 401
+    result['from'] = start.isoformat()
+    result['to'] = end.isoformat()
+    return jsonify(result), 200
+
+@app.route('/analytics/timeseries')
+@require_auth
+def analytics_timeseries(user_id):
+    bucket = request.args.get('bucket', 'month').strip().lower()
+    if bucket not in timeseries.BUCKETS:
+        return jsonify({'error': 'Bucket must be day, week or month'}), 400
+    
+    # Validate date range
+    end_str = request.args.get('to', '').strip() or datetime.date.today().isoformat()
+    is_valid, end_result = validate_date(end_str)
+    if not is_valid:
+        return jsonify({'error': end_result}), 400
+    end = datetime.date.fromisoformat(end_result)
+    
+    start_str = request.args.get('from', '').strip()
+    if start_str:
+        is_valid, start_result = validate_date(start_str)
+        if not is_valid:
+            return jsonify({'error': start_result}), 400
+        start = datetime.date.fromisoformat(start_result)
+    else:
+        start = timeseries.default_start(bucket, end)
+    
+    if start > end:
+        return jsonify({'error': 'Start date must not be after end date'}), 400
     
-    user_id = payload['user_id']
+    try:
+        window = int(request.args.get('window', timeseries.DEFAULT_WINDOW))
+    except ValueError:
+        return jsonify({'error': 'Invalid window'}), 400
+    if window <= 0:
+        return jsonify({'error': 'Window must be positive'}), 400
     
+    # Default ranges end today, so the date is part of the key
+    return cached_json('timeseries', user_id, lambda: build_timeseries(user_id, bucket, start, end, window),
+                       datetime.date.today())
+
+# Hold a pooled connection only while the export is being streamed
+def stream_export(pool, user_id, export_format, start, end, compress):
+    with pool.connection() as conn:
+        yield from exporter.export(conn, user_id, export_format, start, end, compress)
+
+@app.route('/export')
+@require_auth
+def export_transactions(user_id):
+    export_format = request.args.get('format', 'csv').strip().lower()
+    if export_format not in exporter.FORMATS:
+        return jsonify({'error': 'Format must be csv or ndjson'}), 400
+    
+    # Validate date range; both ends are optional
+    bounds = []
+    for name, default in (('from', '0000-01-01'), ('to', '9999-12-31')):
+        value = request.args.get(name, '').strip()
+        if value:
+            is_valid, date_result = validate_date(value)
+            if not is_valid:
+                return jsonify({'error': date_result}), 400
+            value = date_result
+        bounds.append(value or default)
+    start, end = bounds
+    
+    # Compressed on the fly when asked for and the client accepts gzip
+    compress = (request.args.get('gzip', '').lower() in ('1', 'true')
+                and 'gzip' in request.accept_encodings)
+    
+    response = Response(stream_export(db.get_pool(name=db.current_database()), user_id, export_format, start, end, compress),
+                        mimetype=exporter.MIMETYPES[export_format])
+    filename = f'transactions-{datetime.date.today().isoformat()}.{export_format}'
+    response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+    if compress:
+        response.headers['Content-Encoding'] = 'gzip'
+        response.headers['Vary'] = 'Accept-Encoding'
+    return response
+
+@app.route('/cache/stats')
+@require_auth
+def cache_stats(user_id):
+    return jsonify(response_cache.stats()), 200
+
+# Cache sizes, read whenever /metrics is scraped
+def cache_gauges():
+    responses = response_cache.stats()
+    tokens = token_cache.stats()
+    columns = columnar.active.stats()
+    return [
+        ('finance_response_cache_entries', 'Responses held by the response cache', responses['entries']),
+        ('finance_response_cache_bytes', 'Bytes held by the response cache', responses['bytes']),
+        ('finance_response_cache_hit_ratio', 'Response cache hit ratio since start', responses['hit_ratio']),
+        ('finance_token_cache_entries', 'Verified tokens held by the token cache', tokens['entries']),
+        ('finance_model_cache_bytes', 'Estimated bytes held by per-user category models', category_models.size),
+        ('finance_columnar_cache_rows', 'Transactions held by the columnar cache', columns['rows']),
+        ('finance_columnar_cache_bytes', 'Bytes held by the columnar cache', columns['bytes']),
+        ('finance_columnar_cache_hit_ratio', 'Columnar cache hit ratio since start', columns['hit_ratio']),
+    ]
+
+metrics.REGISTRY.add_collector(cache_gauges)
+
+# Prometheus text exposition of request, SQL and hot-path timings. Labels
+# are routes and query names only, never user data.
+@app.route('/metrics')
+def metrics_endpoint():
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+@app.route('/upload', methods=['POST'])
+@require_auth
+def upload_csv(user_id):
     if 'file' not in request.files:
         return jsonify({'error': 'No file provided'}), 400
     
@@ -487,68 +1259,36 @@ def upload_csv():
     if not file.filename.lower().endswith('.csv'):
         return jsonify({'error': 'Please upload a CSV file'}), 400
     
-    # Check file size (limit to 5MB)
+    # Check file size
     file.seek(0, 2)  # Seek to end
     file_size = file.tell()
     file.seek(0)  # Reset to beginning
     
-    if file_size > 5 * 1024 * 1024:  # 5MB limit
-        return jsonify({'error': 'File size too large (max 5MB)'}), 400
+    if file_size > MAX_UPLOAD_SIZE:
+        return jsonify({'error': f'File size too large (max {MAX_UPLOAD_SIZE // (1024 * 1024)}MB)'}), 400
     
-    try:
-        content = file.read().decode('utf-8')
-        lines = content.strip().split('\n')
-        
-        if len(lines) < 2:  # Need at least header + 1 data row
-            return jsonify({'error': 'CSV file must contain at least a header and one data row'}), 400
-        
-        conn = sqlite3.connect('finance.db')
-        cursor = conn.cursor()
-        
-        imported_count = 0
-        for line_num, line in enumerate(lines[1:], 2):  # Skip header, start counting from 2
-            parts = line.split(',')
-            if len(parts) >= 3:
-                description = sanitize_input(parts[0].strip())
-                amount_str = parts[1].strip()
-                type_transaction = parts[2].strip().lower()
-                date = parts[3].strip() if len(parts) > 3 else datetime.datetime.now().strftime('%Y-%m-%d')
-                
-                # Validate amount
-                is_valid, amount_result = validate_amount(amount_str)
-                if not is_valid:
-                    conn.close()
-                    return jsonify({'error': f'Invalid amount in row {line_num}: {amount_result}'}), 400
-                
-                # Validate type
-                if type_transaction not in ['income', 'expense']:
-                    conn.close()
-                    return jsonify({'error': f'Invalid type in row {line_num}: must be income or expense'}), 400
-                
-                # Validate date
-                is_valid, date_result = validate_date(date)
-                if not is_valid:
-                    conn.close()
-                    return jsonify({'error': f'Invalid date in row {line_num}: {date_result}'}), 400
-                
-                category = classify_transaction(description)
-                
-                cursor.execute('''
-                    INSERT INTO transactions (user_id, description, amount, type, category, date)
-                    VALUES (?, ?, ?, ?, ?, ?)
-                ''', (user_id, description, amount_result, type_transaction, category, date_result))
-                
-                imported_count += 1
-        
-        conn.commit()
-        conn.close()
-        
-        return jsonify({'message': f'Successfully imported {imported_count} transactions'}), 200
-        
-    except UnicodeDecodeError:
-        return jsonify({'error': 'Invalid file encoding. Please use UTF-8 encoding'}), 400
-    except Exception as e:
-        return jsonify({'error': f'Error processing file: {str(e)}'}), 400
+    # Spool the file and import it in the background
+    job_id = jobs.get_jobs().submit(get_db(), user_id, file.filename, file.save)
+    
+    return jsonify({'message': 'Import started', 'job_id': job_id}), 202
+
+@app.route('/upload/<job_id>')
+@require_auth
+def upload_status(user_id, job_id):
+    status = jobs.job_status(get_db(), user_id, job_id)
+    if status is None:
+        return jsonify({'error': 'Import job not found'}), 404
+    
+    return jsonify(status), 200
+
+@app.route('/upload/<job_id>/cancel', methods=['POST'])
+@require_auth
+def cancel_upload(user_id, job_id):
+    status = jobs.get_jobs().cancel(get_db(), user_id, job_id)
+    if status is None:
+        return jsonify({'error': 'Import job not found'}), 404
+    
+    return jsonify({'job_id': job_id, 'status': status}), 200
 
 if __name__ == '__main__':
     init_db()
@@ -0,0 +1,153 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+# Verified token cache and revocation checks.
+#
+# Verifying a JWT means an HMAC over the token plus claim checks on every
+# request, while clients send the same token over and over. Tokens that
+# verified once are remembered by digest (never the raw token) until their
+# own exp or the cache TTL, whichever comes first, so repeat requests cost a
+# dict lookup.
+#
+# Revocations are stored in the main database so they survive restarts and
+# apply to every process: logged-out tokens by digest in revoked_tokens, and
+# all of a user's tokens by users.token_generation, which /logout/all
+# increments and which tokens carry in their gen claim. A cached token is
+# checked against the database again once it has gone `recheck` seconds
+# without a check. The process that revokes also records the revocation in
+# memory, so it rejects the token immediately.
+
+
+def token_digest(token):
+    return hashlib.blake2b(token.encode('utf-8'), digest_size=16).digest()
+
+
+TOKEN_STATE_SQL = '''
+    SELECT token_generation, EXISTS (SELECT 1 FROM revoked_tokens WHERE digest = ?)
+    FROM users WHERE id = ?
+'''
+
+
+# Whether a verified token is still valid: not logged out, and issued
+# since the user's last /logout/all. Users that no longer exist have no
+# valid tokens.
+def is_current(conn, digest, payload):
+    row = conn.execute(TOKEN_STATE_SQL, (digest, payload.get('user_id'))).fetchone()
+    return row is not None and not row[1] and payload.get('gen', 0) >= row[0]
+
+
+# Store a logged-out token until it would have expired anyway
+def store_revocation(conn, digest, payload):
+    now = time.time()
+    conn.execute('INSERT OR IGNORE INTO revoked_tokens (digest, expires_at) VALUES (?, ?)',
+                 (digest, payload.get('exp', now)))
+    # Expired tokens fail verification on their own
+    conn.execute('DELETE FROM revoked_tokens WHERE expires_at < ?', (now,))
+    conn.commit()
+
+
+# Invalidate every token issued to the user so far and return the new
+# generation, which tokens issued from now on carry
+def next_generation(conn, user_id):
+    conn.execute('UPDATE users SET token_generation = token_generation + 1 WHERE id = ?', (user_id,))
+    generation = conn.execute('SELECT token_generation FROM users WHERE id = ?', (user_id,)).fetchone()[0]
+    conn.commit()
+    return generation
+
+
+class TokenCache:
+    def __init__(self, max_entries, ttl, recheck):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.recheck = recheck
+        self._entries = OrderedDict()
+        # digest -> exp, kept until the token would have expired anyway
+        self._revoked = {}
+        self._next_sweep = 1024
+        # user_id -> lowest token generation still accepted
+        self._generations = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _is_revoked(self, digest, payload):
+        if digest in self._revoked:
+            return True
+        return payload.get('gen', 0) < self._generations.get(payload.get('user_id'), 0)
+
+    # Return the payload for token, calling verify(token) on a miss.
+    # verify returns the decoded payload or None when the token is invalid;
+    # check(digest, payload) returns whether a verified token is still
+    # current (see is_current).
+    def get(self, token, verify, check):
+        digest = token_digest(token)
+        now = time.time()
+
+        with self._lock:
+            entry = self._entries.get(digest)
+            payload = None
+            if entry is not None:
+                payload, expires, checked_until = entry
+                if expires <= now:
+                    del self._entries[digest]
+                    payload = None
+                elif self._is_revoked(digest, payload):
+                    return None
+                elif checked_until > now:
+                    self._entries.move_to_end(digest)
+                    self.hits += 1
+                    return payload
+            if payload is None:
+                self.misses += 1
+
+        if payload is None:
+            payload = verify(token)
+            if payload is None:
+                return None
+        if not check(digest, payload):
+            with self._lock:
+                self._entries.pop(digest, None)
+            return None
+
+        with self._lock:
+            if self._is_revoked(digest, payload):
+                return None
+            self._entries[digest] = (payload, min(payload.get('exp', now), now + self.ttl), now + self.recheck)
+            self._entries.move_to_end(digest)
+            if len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return payload
+
+    # Reject one token in this process from now on; store_revocation
+    # records it for the others. payload is the token's verified claims.
+    def revoke(self, token, payload):
+        digest = token_digest(token)
+        now = time.time()
+        with self._lock:
+            self._entries.pop(digest, None)
+            self._revoked[digest] = payload.get('exp', now + self.ttl)
+            if len(self._revoked) >= self._next_sweep:
+                # Expired tokens fail verification on their own
+                self._revoked = {key: exp for key, exp in self._revoked.items() if exp > now}
+                self._next_sweep = max(1024, len(self._revoked) * 2)
+
+    # Reject the user's tokens from generations before `generation`, as
+    # returned by next_generation, in this process from now on
+    def revoke_user(self, user_id, generation):
+        with self._lock:
+            self._generations[user_id] = max(generation, self._generations.get(user_id, 0))
+            for digest in [key for key, (payload, _, _) in self._entries.items()
+                           if payload.get('gen', 0) < generation and payload.get('user_id') == user_id]:
+                del self._entries[digest]
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'revoked_tokens': len(self._revoked),
+                'hits': self.hits,
+                'misses': self.misses,
+            }
@@ -0,0 +1,71 @@
+# classify_transaction microbenchmark.
+#
+# Usage: python benchmarks/classify_benchmark.py [descriptions]
+#
+# Compares the original per-call implementation (which rebuilt its keyword
+# table and lowercased every description on each call) with the current
+# classify_transaction and the classify_many batch entry point, and checks
+# that all three agree.
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from classifier import classify_many, classify_transaction
+
+MERCHANTS = [
+    'STARBUCKS COFFEE #{n}', 'Shell Gas Station {n}', 'Amazon Prime Video', 'Amazon Mktplace {n}',
+    'Salary ACME Corp', 'Transfer to savings {n}', 'Walmart Supercenter {n}', 'CVS Pharmacy {n}',
+    'Hotel Booking Paris', 'Monthly rent payment', 'ATM withdrawal {n}', 'Comcast Cable',
+    'Whole Foods Market {n}', 'Uber Trip {n}', 'Netflix.com', 'Book Depository order {n}',
+    'City Water Utility', 'Dr Smith Dental', 'Delta Flight {n}', 'Pizza Hut {n}',
+]
+
+
+def legacy_classify_transaction(description):
+    description = description.lower()
+
+    categories = {
+        'groceries': ['food', 'grocery', 'supermarket', 'market', 'fresh', 'organic', 'produce'],
+        'transportation': ['uber', 'lyft', 'taxi', 'gas', 'fuel', 'parking', 'metro', 'bus', 'train'],
+        'entertainment': ['movie', 'theater', 'concert', 'game', 'netflix', 'spotify', 'amazon prime'],
+        'utilities': ['electric', 'water', 'gas', 'internet', 'phone', 'cable', 'wifi'],
+        'shopping': ['amazon', 'walmart', 'target', 'clothing', 'shoes', 'electronics'],
+        'dining': ['restaurant', 'cafe', 'coffee', 'pizza', 'burger', 'sushi', 'dinner', 'lunch'],
+        'healthcare': ['pharmacy', 'doctor', 'medical', 'dental', 'vision', 'insurance'],
+        'education': ['book', 'course', 'tuition', 'school', 'college', 'university'],
+        'travel': ['hotel', 'flight', 'airbnb', 'vacation', 'trip', 'booking']
+    }
+
+    for category, keywords in categories.items():
+        for keyword in keywords:
+            if keyword in description:
+                return category
+
+    return 'other'
+
+
+def timed(label, func, count):
+    started = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - started
+    print(f'{label:<28} {elapsed:7.2f}s  {count / elapsed:>12,.0f} descriptions/s')
+    return result
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    random.seed(42)
+    descriptions = [random.choice(MERCHANTS).format(n=random.randint(1, 99999)) for _ in range(count)]
+
+    legacy = timed('legacy classify_transaction', lambda: [legacy_classify_transaction(d) for d in descriptions], count)
+    current = timed('classify_transaction', lambda: [classify_transaction(d) for d in descriptions], count)
+    batch = timed('classify_many', lambda: classify_many(descriptions), count)
+
+    assert legacy == current == batch, 'classifiers disagree'
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+# Columnar cache benchmark: memory per row and read latency against SQLite.
+#
+# Usage: python benchmarks/columnar_benchmark.py [--db FILE] [--rows N] [--users N]
+#            [--iterations N]
+#
+# Without --db a scratch database is generated (see generate_data.py). For
+# the heaviest user (user1) and a median one it reports the cached columns'
+# bytes per row and load time, then the latency of listing and time series
+# requests answered from SQLite and from the cache, and the peak Python
+# memory allocated per request. The response cache is off throughout, so
+# every request is built. Finally it times applying one insert and one
+# delete to the cached columns.
+import argparse
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import generate_data
+
+REQUESTS = (
+    ('first page + totals', '/transactions?limit=50'),
+    ('expenses page', '/transactions?type=expense&limit=50'),
+    ('category, 1 year', '/transactions?category=dining&from={year_ago}&limit=50'),
+    ('page 20', '/transactions?limit=50&cursor={cursor}'),
+    ('timeseries day', '/analytics/timeseries?bucket=day&from={year_ago}'),
+    ('timeseries week', '/analytics/timeseries?bucket=week&from={three_years_ago}'),
+)
+
+
+def time_request(client, headers, path, iterations):
+    latencies = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        response = client.get(path, headers=headers)
+        latencies.append((time.perf_counter() - started) * 1000)
+        if response.status_code != 200:
+            raise SystemExit(f'{path} failed ({response.status_code}): {response.get_data()[:200]!r}')
+    return statistics.median(latencies)
+
+
+def peak_memory(client, headers, path):
+    tracemalloc.start()
+    client.get(path, headers=headers)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the columnar transaction cache')
+    parser.add_argument('--db', help='database made by generate_data.py (default: generate one)')
+    parser.add_argument('--rows', type=int, default=500000)
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--iterations', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    database = args.db or os.path.join(workdir, 'benchmark.db')
+    # Set before the app modules are imported, which read them once
+    os.environ['FINANCE_DB_PATH'] = database
+    os.environ['FINANCE_SPOOL_DIR'] = os.path.join(workdir, 'spool')
+    os.environ['FINANCE_HASH_WORKERS'] = '0'
+    os.environ['FINANCE_RESPONSE_CACHE_MB'] = '0'
+    os.environ.setdefault('FINANCE_COLUMNAR_CACHE_MB', '256')
+    if not args.db:
+        print(f'generating {args.rows:,} rows for {args.users} users...')
+        generate_data.write_db(database, args.rows, args.users, 3, random.Random(args.seed))
+
+    import app as finance_app
+    import columnar
+
+    finance_app.init_db()
+    cache = columnar.active
+    client = finance_app.app.test_client()
+    with sqlite3.connect(database) as conn:
+        counts = conn.execute('SELECT user_id, COUNT(*) FROM transactions GROUP BY user_id '
+                              'ORDER BY COUNT(*) DESC').fetchall()
+    today = time.strftime('%Y-%m-%d')
+    year_ago = f'{int(today[:4]) - 1}{today[4:]}'
+    three_years_ago = f'{int(today[:4]) - 3}{today[4:]}'
+
+    for user_id, rows in (counts[0], counts[len(counts) // 2]):
+        username = f'user{user_id}'
+        token = client.post('/login', json={'username': username, 'password': generate_data.PASSWORD}).get_json()['token']
+        headers = {'Authorization': f'Bearer {token}'}
+
+        # Cursor for the 20th page of the unfiltered listing
+        columnar.active = None
+        cursor = None
+        for _ in range(19):
+            path = '/transactions?limit=50' + (f'&cursor={cursor}' if cursor else '')
+            cursor = client.get(path, headers=headers).headers['X-Next-Cursor']
+        columnar.active = cache
+
+        started = time.perf_counter()
+        cache._load(user_id)
+        load_seconds = time.perf_counter() - started
+        with cache._lock:
+            entry = cache._entries[user_id]
+        print(f'\n{username}: {rows:,} rows, {entry.size / rows:.1f} bytes per cached row '
+              f'({entry.size / 1024 / 1024:.1f} MB), loaded in {load_seconds:.2f}s')
+        print(f'  {"request":<24}{"sqlite ms":>11}{"cache ms":>10}{"speedup":>9}{"sqlite peak":>13}{"cache peak":>12}')
+        for name, template in REQUESTS:
+            request_path = template.format(year_ago=year_ago, three_years_ago=three_years_ago, cursor=cursor)
+            results = []
+            for enabled in (None, cache):
+                columnar.active = enabled
+                time_request(client, headers, request_path, 3)
+                results.append((time_request(client, headers, request_path, args.iterations),
+                                peak_memory(client, headers, request_path)))
+            columnar.active = cache
+            (sql_ms, sql_peak), (cache_ms, cache_peak) = results
+            print(f'  {name:<24}{sql_ms:>11.3f}{cache_ms:>10.3f}{sql_ms / cache_ms:>8.1f}x'
+                  f'{sql_peak / 1024:>11.0f}KB{cache_peak / 1024:>10.0f}KB')
+
+        # Cost of keeping the entry current on writes
+        row = ('Coffee', 4.5, 'expense', 'dining', today)
+        started = time.perf_counter()
+        updated = entry.inserted(entry.version + 1, [10 ** 9], [row])
+        insert_ms = (time.perf_counter() - started) * 1000
+        started = time.perf_counter()
+        updated.deleted(entry.version + 2, [(10 ** 9, today)])
+        delete_ms = (time.perf_counter() - started) * 1000
+        print(f'  applying one insert {insert_ms:.3f} ms, one delete {delete_ms:.3f} ms')
+
+
+if __name__ == '__main__':
+    main()
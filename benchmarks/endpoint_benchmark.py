@@ -0,0 +1,305 @@
+# Endpoint latency and throughput benchmark.
+#
+# Usage: python benchmarks/endpoint_benchmark.py [--db FILE] [--mode client|http|both]
+#            [--url URL] [--concurrency N] [--duration SECONDS] [--endpoints NAME,...]
+#            [--output results.json] [--baseline earlier.json]
+#
+# Runs each endpoint for --duration seconds from --concurrency threads and
+# reports p50/p95/p99 latency and requests per second. Each thread logs in
+# as a different generated user (user1 owns the most rows), so responses
+# come from a mix of small and large histories.
+#
+# Without --db a scratch database with 200k rows for 50 users is generated
+# first (see generate_data.py). "client" mode calls the app in-process
+# through Flask's test client; "http" mode serves it on a local threaded
+# server, or targets --url, whose database must have been made by
+# generate_data.py. classify_transaction is timed as a plain function call.
+# upload measures accepting a file; the imports it queues run in the
+# background and add rows to the database.
+#
+# Results are written as JSON with --output; with --baseline, each endpoint
+# is compared with the same endpoint in an earlier results file.
+import argparse
+import datetime
+import http.client
+import io
+import json
+import os
+import platform
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import generate_data
+
+UPLOAD_ROWS = 1000
+
+# name -> (method, path). The upload body is a generated statement.
+ENDPOINTS = {
+    'list_transactions': ('GET', '/transactions?limit=50'),
+    'list_expenses': ('GET', '/transactions?type=expense&limit=50'),
+    'analytics': ('GET', '/analytics'),
+    'timeseries': ('GET', '/analytics/timeseries?bucket=week'),
+    'search': ('GET', '/transactions/search?q=coffee'),
+    'upload': ('POST', '/upload'),
+}
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+def percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def summarize(latencies, errors, elapsed):
+    ordered = sorted(latencies)
+    if not ordered:
+        return {'requests': 0, 'errors': errors}
+    return {
+        'requests': len(ordered),
+        'errors': errors,
+        'throughput': round(len(ordered) / elapsed, 1),
+        'mean_ms': round(sum(ordered) / len(ordered), 4),
+        'p50_ms': round(percentile(ordered, 0.50), 4),
+        'p95_ms': round(percentile(ordered, 0.95), 4),
+        'p99_ms': round(percentile(ordered, 0.99), 4),
+        'max_ms': round(ordered[-1], 4),
+    }
+
+
+def statement_csv(rng):
+    rows = generate_data.generate_rows(UPLOAD_ROWS, 1, rng)
+    lines = ['Description,Amount,Type,Date'] + [
+        f'{description},{amount},{type_transaction},{date}'
+        for description, amount, type_transaction, date in rows
+    ]
+    return ('\n'.join(lines) + '\n').encode()
+
+
+# Sends requests through Flask's test client, one client per thread
+class TestClientTransport:
+    def __init__(self, flask_app):
+        self.flask_app = flask_app
+        self.local = threading.local()
+
+    def request(self, method, path, token=None, json_body=None, upload=None):
+        client = getattr(self.local, 'client', None)
+        if client is None:
+            client = self.local.client = self.flask_app.test_client()
+        headers = {'Authorization': f'Bearer {token}'} if token else {}
+        if upload is not None:
+            response = client.open(path, method=method, headers=headers,
+                                   data={'file': (io.BytesIO(upload), 'statement.csv')},
+                                   content_type='multipart/form-data')
+        else:
+            response = client.open(path, method=method, headers=headers, json=json_body)
+        return response.status_code, response.get_data()
+
+
+# Sends requests over HTTP, one connection per request
+class HttpTransport:
+    def __init__(self, base):
+        parsed = urllib.parse.urlsplit(base)
+        self.host = parsed.hostname
+        self.port = parsed.port or 80
+
+    def request(self, method, path, token=None, json_body=None, upload=None):
+        headers = {'Authorization': f'Bearer {token}'} if token else {}
+        body = None
+        if upload is not None:
+            boundary = 'benchmarkboundary'
+            body = (f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="statement.csv"\r\n'
+                    f'Content-Type: text/csv\r\n\r\n').encode() + upload + f'\r\n--{boundary}--\r\n'.encode()
+            headers['Content-Type'] = f'multipart/form-data; boundary={boundary}'
+        elif json_body is not None:
+            body = json.dumps(json_body).encode()
+            headers['Content-Type'] = 'application/json'
+        conn = http.client.HTTPConnection(self.host, self.port, timeout=60)
+        try:
+            conn.request(method, path, body=body, headers=headers)
+            response = conn.getresponse()
+            return response.status, response.read()
+        finally:
+            conn.close()
+
+
+def login(transport, users, count):
+    tokens = []
+    for i in range(count):
+        username = f'user{i % users + 1}'
+        status, body = transport.request('POST', '/login',
+                                         json_body={'username': username, 'password': generate_data.PASSWORD})
+        if status != 200:
+            raise SystemExit(f'Login as {username} failed ({status}): {body[:200]!r}')
+        tokens.append(json.loads(body)['token'])
+    return tokens
+
+
+def run_endpoint(transport, tokens, method, path, duration, upload=None):
+    stop = threading.Event()
+    latencies = [[] for _ in tokens]
+    errors = [0] * len(tokens)
+
+    def client(index):
+        while not stop.is_set():
+            started = time.perf_counter()
+            status, _ = transport.request(method, path, token=tokens[index], upload=upload)
+            latencies[index].append((time.perf_counter() - started) * 1000)
+            if status >= 400:
+                errors[index] += 1
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(len(tokens))]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    time.sleep(duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    return summarize([value for values in latencies for value in values], sum(errors), elapsed)
+
+
+def run_classify(duration, rng):
+    import classifier
+
+    descriptions = [row[0] for row in generate_data.generate_rows(10000, 1, rng)]
+    latencies = []
+    started = time.perf_counter()
+    deadline = started + duration
+    while time.perf_counter() < deadline:
+        for description in descriptions[:1000]:
+            call_started = time.perf_counter()
+            classifier.classify_transaction(description)
+            latencies.append((time.perf_counter() - call_started) * 1000)
+        descriptions.append(descriptions.pop(0))
+    return summarize(latencies, 0, time.perf_counter() - started)
+
+
+def run_mode(transport, args, users, rng):
+    tokens = login(transport, users, args.concurrency)
+    results = {}
+    for name in args.endpoints:
+        if name == 'classify_transaction':
+            results[name] = run_classify(args.duration, rng)
+        else:
+            method, path = ENDPOINTS[name]
+            upload = statement_csv(rng) if name == 'upload' else None
+            results[name] = run_endpoint(transport, tokens, method, path, args.duration, upload)
+        print_result(name, results[name])
+    return results
+
+
+def print_result(name, result):
+    if not result['requests']:
+        print(f'  {name:<22} no requests completed')
+        return
+    print(f'  {name:<22}{result["requests"]:>8}{result["throughput"]:>10.1f}/s'
+          f'{result["p50_ms"]:>10.3f}{result["p95_ms"]:>10.3f}{result["p99_ms"]:>10.3f}'
+          f'{result["errors"]:>8}')
+
+
+def compare(results, baseline):
+    print('\nchange against baseline (p50, p99, throughput)')
+    for mode, endpoints in results.items():
+        for name, result in endpoints.items():
+            before = baseline.get('results', {}).get(mode, {}).get(name)
+            if not before or not before.get('requests') or not result['requests']:
+                continue
+            changes = [(result[key] - before[key]) / before[key] * 100 if before[key] else 0.0
+                       for key in ('p50_ms', 'p99_ms', 'throughput')]
+            print(f'  {mode:<7}{name:<22}' + ''.join(f'{change:>+9.1f}%' for change in changes))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the finance API endpoints')
+    parser.add_argument('--db', help='database made by generate_data.py (default: generate one)')
+    parser.add_argument('--mode', choices=('client', 'http', 'both'), default='client')
+    parser.add_argument('--url', help='benchmark a running server instead of starting one (http mode)')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=5)
+    parser.add_argument('--endpoints', default=','.join(list(ENDPOINTS) + ['classify_transaction']))
+    parser.add_argument('--output', help='write results as JSON to this file')
+    parser.add_argument('--baseline', help='earlier results file to compare with')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    args.endpoints = [name.strip() for name in args.endpoints.split(',') if name.strip()]
+    for name in args.endpoints:
+        if name not in ENDPOINTS and name != 'classify_transaction':
+            parser.error(f'unknown endpoint {name}')
+
+    rng = random.Random(args.seed)
+    workdir = tempfile.mkdtemp()
+    database = args.db
+    users = rows = None
+    if database or not args.url:
+        # Set before the app modules are imported, which read them once
+        database = database or os.path.join(workdir, 'benchmark.db')
+        os.environ['FINANCE_DB_PATH'] = database
+        os.environ.setdefault('FINANCE_SPOOL_DIR', os.path.join(workdir, 'spool'))
+        os.environ.setdefault('FINANCE_HASH_WORKERS', '0')
+        if not args.db:
+            print('generating 200,000 rows for 50 users...')
+            generate_data.write_db(database, 200000, 50, 3, rng)
+        with sqlite3.connect(database) as conn:
+            users = conn.execute('SELECT COUNT(*) FROM users').fetchone()[0]
+            rows = conn.execute('SELECT COUNT(*) FROM transactions').fetchone()[0]
+
+    modes = ('client', 'http') if args.mode == 'both' else (args.mode,)
+    results = {}
+    print(f'{"endpoint":<24}{"requests":>8}{"rate":>12}{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}{"errors":>8}')
+    for mode in modes:
+        print(f'{mode}:')
+        if mode == 'http' and args.url:
+            results[mode] = run_mode(HttpTransport(args.url), args, users or args.concurrency, rng)
+            continue
+
+        import app as finance_app
+        finance_app.init_db()
+        if mode == 'client':
+            results[mode] = run_mode(TestClientTransport(finance_app.app), args, users, rng)
+        else:
+            server = make_server('127.0.0.1', 0, finance_app.app, threaded=True, request_handler=QuietHandler)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            try:
+                results[mode] = run_mode(HttpTransport(f'http://127.0.0.1:{server.server_port}'),
+                                         args, users, rng)
+            finally:
+                server.shutdown()
+
+    report = {
+        'meta': {
+            'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+            'database': args.url or database,
+            'users': users,
+            'rows': rows,
+            'concurrency': args.concurrency,
+            'duration': args.duration,
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'cpus': os.cpu_count(),
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f'\nresults written to {args.output}')
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
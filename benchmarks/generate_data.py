@@ -0,0 +1,158 @@
+# Synthetic data generator.
+#
+# Usage: python benchmarks/generate_data.py OUTPUT [--rows N] [--users N]
+#            [--format db|csv] [--years N] [--seed N]
+#
+# Generates users and transactions with realistic descriptions, categories
+# and amounts. A few users own most of the rows, as in real data; user1 is
+# always the heaviest.
+#
+# --format db (the default) writes a new finance.db at OUTPUT with every
+# migration applied. Users are named user1..userN and share the password
+# Passw0rdBench. Rows are loaded before the rollup, full-text and
+# fingerprint migrations run, so those are built in one pass each.
+#
+# --format csv writes one statement per user in the /upload format into the
+# OUTPUT directory, as statement_user<N>.csv.
+import argparse
+import datetime
+import math
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+PASSWORD = 'Passw0rdBench'
+
+# (description templates, type, weight, median amount, spread). Weights give
+# the share of rows; amounts are log-normal around the median. '{n}' becomes
+# a store or reference number, as bank statements print them.
+MERCHANTS = (
+    (('Whole Foods Market #{n}', 'Trader Joes {n}', 'Safeway Supermarket', 'Fresh Produce Stand',
+      'Organic Grocery Co'), 'expense', 16, 65, 0.6),
+    (('Starbucks Coffee #{n}', 'Blue Bottle Cafe', 'Chipotle Restaurant', 'Pizza Hut {n}',
+      'Sushi Bar Dinner', 'Five Guys Burger', 'Lunch Deli {n}'), 'expense', 20, 14, 0.6),
+    (('Uber Trip {n}', 'Lyft Ride', 'Shell Gas Station #{n}', 'City Parking Garage', 'Metro Card Reload',
+      'Amtrak Train'), 'expense', 12, 22, 0.7),
+    (('Netflix Subscription', 'Spotify Premium', 'AMC Movie Theater', 'Steam Game Purchase',
+      'Concert Tickets'), 'expense', 6, 18, 0.7),
+    (('Electric Company Bill', 'City Water Utility', 'Comcast Internet', 'Verizon Phone Bill'),
+     'expense', 5, 85, 0.4),
+    (('Amazon Marketplace', 'Walmart Supercenter #{n}', 'Target Store {n}', 'Nike Shoes',
+      'Best Buy Electronics'), 'expense', 14, 45, 0.9),
+    (('CVS Pharmacy #{n}', 'Family Doctor Copay', 'Dental Care Clinic', 'Vision Center'), 'expense', 4, 40, 0.8),
+    (('Barnes Noble Book Store', 'Online Course Fee', 'University Tuition'), 'expense', 2, 60, 1.2),
+    (('Marriott Hotel', 'Delta Flight {n}', 'Airbnb Stay', 'Expedia Booking'), 'expense', 3, 240, 0.8),
+    (('ATM Withdrawal {n}', 'Venmo Transfer', 'Bank Fee', 'Check #{n}'), 'expense', 8, 60, 1.0),
+    (('Salary ACME Corp', 'Payroll Deposit'), 'income', 6, 2600, 0.3),
+    (('Freelance Work Payment', 'Interest Payment', 'Refund {n}'), 'income', 4, 180, 1.0),
+)
+
+LOAD_BATCH_SIZE = 50000
+
+
+def weighted_merchants():
+    templates = []
+    weights = []
+    for descriptions, type_transaction, weight, median, spread in MERCHANTS:
+        for description in descriptions:
+            templates.append((description, type_transaction, math.log(median), spread))
+            weights.append(weight / len(descriptions))
+    return templates, weights
+
+
+# Rows per user: Pareto-distributed shares, largest first, summing to rows
+def rows_per_user(rows, users, rng):
+    shares = sorted((rng.paretovariate(1.2) for _ in range(users)), reverse=True)
+    total = sum(shares)
+    counts = [int(rows * share / total) for share in shares]
+    counts[0] += rows - sum(counts)
+    return counts
+
+
+# Yield (description, amount, type, date) for one user's rows
+def generate_rows(count, years, rng):
+    templates, weights = weighted_merchants()
+    end = datetime.date.today()
+    days = years * 365
+    chosen = rng.choices(templates, weights, k=count)
+    for description, type_transaction, mu, sigma in chosen:
+        if '{n}' in description:
+            description = description.format(n=rng.randint(100, 9999))
+        amount = round(max(0.01, rng.lognormvariate(mu, sigma)), 2)
+        date = (end - datetime.timedelta(days=rng.randrange(days))).isoformat()
+        yield description, amount, type_transaction, date
+
+
+def write_csv(output, rows, users, years, rng):
+    os.makedirs(output, exist_ok=True)
+    for user_number, count in enumerate(rows_per_user(rows, users, rng), start=1):
+        path = os.path.join(output, f'statement_user{user_number}.csv')
+        with open(path, 'w', newline='') as f:
+            f.write('Description,Amount,Type,Date\n')
+            for description, amount, type_transaction, date in generate_rows(count, years, rng):
+                f.write(f'{description},{amount},{type_transaction},{date}\n')
+
+
+def write_db(output, rows, users, years, rng):
+    if os.path.exists(output):
+        raise SystemExit(f'{output} already exists')
+
+    import classifier
+    import db
+    import migrations
+    import passwords
+
+    passwords.HASH_WORKERS = 0
+    password_hash = passwords.hash_password(PASSWORD)
+    conn = db.connect(output)
+    rollup_version = next(version for version, description, _ in migrations.MIGRATIONS
+                          if description == 'Monthly rollup table')
+    migrations.migrate(conn, until=rollup_version - 1)
+
+    conn.executemany('INSERT INTO users (id, username, password, email) VALUES (?, ?, ?, ?)',
+                     [(number, f'user{number}', password_hash, f'user{number}@example.com')
+                      for number in range(1, users + 1)])
+    batch = []
+    for user_id, count in enumerate(rows_per_user(rows, users, rng), start=1):
+        for description, amount, type_transaction, date in generate_rows(count, years, rng):
+            batch.append((user_id, description, amount, type_transaction,
+                          classifier.classify_transaction(description), date))
+            if len(batch) >= LOAD_BATCH_SIZE:
+                conn.executemany('INSERT INTO transactions (user_id, description, amount, type, category, date) '
+                                 'VALUES (?, ?, ?, ?, ?, ?)', batch)
+                batch = []
+    if batch:
+        conn.executemany('INSERT INTO transactions (user_id, description, amount, type, category, date) '
+                         'VALUES (?, ?, ?, ?, ?, ?)', batch)
+    conn.commit()
+
+    # Rollups, search index and fingerprints are built from the loaded rows
+    migrations.migrate(conn)
+    conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate synthetic finance data')
+    parser.add_argument('output')
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--format', choices=('db', 'csv'), default='db')
+    parser.add_argument('--years', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    started = time.perf_counter()
+    if args.format == 'db':
+        write_db(args.output, args.rows, args.users, args.years, rng)
+    else:
+        write_csv(args.output, args.rows, args.users, args.years, rng)
+    print(f'{args.rows:,} rows for {args.users} users written to {args.output} '
+          f'in {time.perf_counter() - started:.1f}s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+# CSV import throughput benchmark.
+#
+# Usage: python benchmarks/import_benchmark.py [rows] [chunk_size]
+#
+# Writes a synthetic statement in the /upload format to a temporary file,
+# streams it through the importer into a scratch database and reports rows
+# per second together with the peak resident memory of the process (which
+# includes database pages mapped through mmap_size). The same file is then
+# imported a second time, when every row is skipped by its fingerprint.
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+DESCRIPTIONS = [
+    'Grocery Shopping', 'Uber Ride', 'Netflix Subscription', 'Electric Bill',
+    'Amazon Purchase', 'Coffee Shop', 'Pharmacy', 'Book Store', 'Hotel Booking',
+    'Salary', 'Freelance Work', '"Dinner, with friends"', 'Misc transfer',
+]
+
+
+def write_statement(path, rows):
+    with open(path, 'w', newline='') as f:
+        f.write('Description,Amount,Type,Date\n')
+        for i in range(rows):
+            description = random.choice(DESCRIPTIONS)
+            type_transaction = 'income' if description in ('Salary', 'Freelance Work') else 'expense'
+            f.write(f'{description},{random.randint(1, 50000) / 100},{type_transaction},'
+                    f'2024-{random.randint(1, 12):02d}-{random.randint(1, 28):02d}\n')
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    workdir = tempfile.mkdtemp()
+    os.environ['FINANCE_DB_PATH'] = os.path.join(workdir, 'bench.db')
+
+    import app
+    import classifier
+    import importer
+    chunk_size = int(sys.argv[2]) if len(sys.argv) > 2 else importer.IMPORT_CHUNK_SIZE
+
+    csv_path = os.path.join(workdir, 'statement.csv')
+    write_statement(csv_path, rows)
+    app.init_db()
+
+    size_mb = os.path.getsize(csv_path) / (1024 * 1024)
+    print(f'file: {rows} rows, {size_mb:.1f} MB, chunk size {chunk_size}')
+
+    first_elapsed = None
+    for label in ('first import', 're-import'):
+        with app.app.app_context(), open(csv_path, 'rb') as f:
+            conn = app.get_db()
+            started = time.perf_counter()
+            result = importer.import_csv(conn, 1, f, app.parse_csv_row, classifier.classify_many,
+                                         chunk_size=chunk_size)
+            elapsed = time.perf_counter() - started
+        print(f'{label}: imported {result.imported}, skipped {result.skipped}, failed {result.failed} '
+              f'in {elapsed:.2f}s ({result.processed / elapsed:,.0f} rows/s)')
+        first_elapsed = first_elapsed or elapsed
+    print(f're-import took {elapsed / first_elapsed:.0%} of the first import')
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(f'peak resident memory: {peak_rss / 1024:.1f} MB')
+
+
+if __name__ == '__main__':
+    main()
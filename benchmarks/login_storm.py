@@ -0,0 +1,111 @@
+# Login storm benchmark.
+#
+# Usage: python benchmarks/login_storm.py [login clients] [seconds]
+#
+# Starts the app on a local threaded server with a scratch database, then
+# measures /analytics latency from one client while `login clients` threads
+# call /login in a loop. Runs once with password hashing inline on request
+# threads and once with the bounded worker pool, and prints p50/p99 for
+# /analytics plus how many logins succeeded or were told to back off.
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+
+def request(base, method, path, body=None, token=None):
+    data = json.dumps(body).encode() if body is not None else None
+    req = urllib.request.Request(base + path, data=data, method=method)
+    req.add_header('Content-Type', 'application/json')
+    if token:
+        req.add_header('Authorization', f'Bearer {token}')
+    try:
+        with urllib.request.urlopen(req, timeout=60) as response:
+            return response.status, response.read()
+    except urllib.error.HTTPError as e:
+        return e.code, e.read()
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def run(base, token, clients, seconds):
+    stop = threading.Event()
+    login_statuses = []
+
+    def storm():
+        while not stop.is_set():
+            status, _ = request(base, 'POST', '/login', {'username': 'storm', 'password': 'Passw0rdStorm'})
+            login_statuses.append(status)
+            if status == 503:
+                # Clients are expected to back off when told the server is busy
+                time.sleep(0.05)
+
+    threads = [threading.Thread(target=storm) for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+
+    latencies = []
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        started = time.perf_counter()
+        request(base, 'GET', '/analytics', token=token)
+        latencies.append((time.perf_counter() - started) * 1000)
+        time.sleep(0.01)
+
+    stop.set()
+    for thread in threads:
+        thread.join()
+    return latencies, login_statuses
+
+
+def main():
+    clients = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+    os.environ['FINANCE_DB_PATH'] = os.path.join(tempfile.mkdtemp(), 'benchmark.db')
+
+    import app as finance_app
+    import passwords
+
+    finance_app.init_db()
+    server = make_server('127.0.0.1', 0, finance_app.app, threaded=True, request_handler=QuietHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f'http://127.0.0.1:{server.server_port}'
+
+    request(base, 'POST', '/register', {'username': 'storm', 'password': 'Passw0rdStorm', 'email': 'storm@example.com'})
+    _, body = request(base, 'POST', '/login', {'username': 'storm', 'password': 'Passw0rdStorm'})
+    token = json.loads(body)['token']
+
+    idle, _ = run(base, token, 0, 1)
+    print(f'idle /analytics: p50 {percentile(idle, 0.5):.1f} ms  p99 {percentile(idle, 0.99):.1f} ms')
+
+    pool_workers = passwords.HASH_WORKERS
+    for label, workers in (('inline', 0), (f'pool ({pool_workers} workers)', pool_workers)):
+        passwords.HASH_WORKERS = workers
+        latencies, statuses = run(base, token, clients, seconds)
+        print(f'{label:>20}: /analytics p50 {percentile(latencies, 0.5):.1f} ms  '
+              f'p99 {percentile(latencies, 0.99):.1f} ms  '
+              f'logins ok {statuses.count(200)}  busy {statuses.count(503)}')
+
+    server.shutdown()
+    passwords.shutdown()
+
+
+if __name__ == '__main__':
+    main()
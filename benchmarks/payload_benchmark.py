@@ -0,0 +1,116 @@
+# Transaction listing payload benchmark: response size and encoding time.
+#
+# Usage: python benchmarks/payload_benchmark.py [--db FILE] [--rows N] [--users N]
+#            [--limits 50,500] [--iterations N]
+#
+# Without --db a scratch database is generated (see generate_data.py). For
+# pages of each size from the heaviest user's history it reports, for the
+# default row-per-object format and format=columnar:
+#   - body size uncompressed, gzipped and brotli-compressed as the app
+#     compresses them
+#   - time to encode the page with the json module (Flask's default encoder)
+#     and with orjson, and to compress it
+#   - median GET /transactions latency through the Flask test client before
+#     (json module, rows, no compression) and after (orjson, columnar, the
+#     best encoding the app offers)
+# The response cache is off, so every request builds its response.
+import argparse
+import json
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import generate_data
+
+
+def median_ms(function, iterations):
+    timings = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        function()
+        timings.append((time.perf_counter() - started) * 1000)
+    return statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark transaction listing payloads')
+    parser.add_argument('--db', help='database made by generate_data.py (default: generate one)')
+    parser.add_argument('--rows', type=int, default=200000)
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--limits', default='50,500')
+    parser.add_argument('--iterations', type=int, default=30)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    limits = [int(value) for value in args.limits.split(',')]
+
+    workdir = tempfile.mkdtemp()
+    database = args.db or os.path.join(workdir, 'benchmark.db')
+    # Set before the app modules are imported, which read them once
+    os.environ['FINANCE_DB_PATH'] = database
+    os.environ['FINANCE_SPOOL_DIR'] = os.path.join(workdir, 'spool')
+    os.environ['FINANCE_HASH_WORKERS'] = '0'
+    os.environ['FINANCE_RESPONSE_CACHE_MB'] = '0'
+    if not args.db:
+        print(f'generating {args.rows:,} rows for {args.users} users...')
+        generate_data.write_db(database, args.rows, args.users, 3, random.Random(args.seed))
+
+    import app as finance_app
+    import responses
+    from flask.json.provider import DefaultJSONProvider
+
+    finance_app.init_db()
+    flask_app = finance_app.app
+    client = flask_app.test_client()
+    with sqlite3.connect(database) as conn:
+        user_id = conn.execute('SELECT user_id FROM transactions GROUP BY user_id '
+                               'ORDER BY COUNT(*) DESC LIMIT 1').fetchone()[0]
+    token = client.post('/login', json={'username': f'user{user_id}',
+                                        'password': generate_data.PASSWORD}).get_json()['token']
+    headers = {'Authorization': f'Bearer {token}'}
+    default_provider = DefaultJSONProvider(flask_app)
+    orjson = responses.orjson
+    encodings = ['gzip'] + (['br'] if responses.brotli is not None else [])
+    if orjson is None:
+        print('orjson is not installed; the app uses the json module')
+    if responses.brotli is None:
+        print('brotli is not installed; the app only offers gzip')
+
+    for limit in limits:
+        print(f'\n{limit} transactions per page')
+        print(f'  {"format":<10}{"bytes":>10}' + ''.join(f'{encoding:>9}' for encoding in encodings) +
+              f'{"json ms":>10}{"orjson ms":>11}' + ''.join(f'{encoding + " ms":>10}' for encoding in encodings))
+        for response_format in ('rows', 'columnar'):
+            path = f'/transactions?limit={limit}&format={response_format}'
+            body = client.get(path, headers={**headers, 'Accept-Encoding': 'identity'}).get_data()
+            page = json.loads(body)
+            json_ms = median_ms(lambda: default_provider.dumps(page), args.iterations)
+            orjson_ms = median_ms(lambda: orjson.dumps(page), args.iterations) if orjson else float('nan')
+            sizes = [len(responses.compress(body, encoding)) for encoding in encodings]
+            compress_ms = [median_ms(lambda: responses.compress(body, encoding), args.iterations)
+                           for encoding in encodings]
+            print(f'  {response_format:<10}{len(body):>10}' + ''.join(f'{size:>9}' for size in sizes) +
+                  f'{json_ms:>10.3f}{orjson_ms:>11.3f}' + ''.join(f'{ms:>10.3f}' for ms in compress_ms))
+
+        # Whole requests, before and after
+        responses.orjson = None
+        before_path = f'/transactions?limit={limit}'
+        before_headers = {**headers, 'Accept-Encoding': 'identity'}
+        before_ms = median_ms(lambda: client.get(before_path, headers=before_headers), args.iterations)
+        before_bytes = len(client.get(before_path, headers=before_headers).get_data())
+        responses.orjson = orjson
+        after_path = f'/transactions?limit={limit}&format=columnar'
+        after_headers = {**headers, 'Accept-Encoding': ', '.join(encodings)}
+        after_ms = median_ms(lambda: client.get(after_path, headers=after_headers), args.iterations)
+        after_bytes = len(client.get(after_path, headers=after_headers).get_data())
+        print(f'  request: {before_ms:.3f} ms / {before_bytes:,} bytes before, '
+              f'{after_ms:.3f} ms / {after_bytes:,} bytes after')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+# Full-text search latency benchmark.
+#
+# Usage: python benchmarks/search_benchmark.py [rows] [users]
+#
+# Builds a scratch database with `rows` synthetic transactions (default 5M)
+# spread over `users` users, one of whom owns a tenth of all rows. The rows
+# are loaded before the full-text migration runs, so the index is built in
+# one pass. Then times search.search for a set of queries against a typical
+# user and the heavy user, next to the LIKE '%term%' scan it replaces.
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+MERCHANTS = [
+    'Starbucks Coffee', 'Uber Trip', 'Netflix', 'Amazon Marketplace', 'Whole Foods Market',
+    'Shell Gas Station', 'Delta Air Lines', 'Marriott Hotel', 'CVS Pharmacy', 'Spotify',
+    'Target Store', 'Walmart Supercenter', 'Chipotle Mexican Grill', 'Apple Store',
+    'City Water Utility', 'Comcast Internet', 'Barnes Noble Books', 'Lyft Ride',
+    'Trader Joes', 'Home Depot', 'Costco Wholesale', 'Dental Care Clinic', 'Airbnb Stay',
+]
+PREFIXES = ['POS', 'Card purchase', 'Debit', 'Online payment', 'Recurring']
+
+QUERIES = ['coffee', 'star coff', 'co', 'airbnb stay', 'pharmacy 12', 'zzzz']
+RUNS = 20
+
+
+def populate(conn, rows, users, seed=11):
+    random.seed(seed)
+    heavy_rows = rows // 10
+    batch = []
+    for i in range(rows):
+        user_id = 1 if i < heavy_rows else random.randint(2, users)
+        description = (f'{random.choice(PREFIXES)} {random.choice(MERCHANTS)} '
+                       f'#{random.randint(1, 99999)}')
+        batch.append((user_id, description, random.randint(100, 50000) / 100, 'expense', 'other',
+                      f'20{random.randint(15, 24)}-{random.randint(1, 12):02d}-{random.randint(1, 28):02d}'))
+        if len(batch) == 100000:
+            conn.executemany('INSERT INTO transactions (user_id, description, amount, type, category, date) '
+                             'VALUES (?, ?, ?, ?, ?, ?)', batch)
+            batch = []
+    if batch:
+        conn.executemany('INSERT INTO transactions (user_id, description, amount, type, category, date) '
+                         'VALUES (?, ?, ?, ?, ?, ?)', batch)
+    conn.commit()
+
+
+def timed(func, runs=RUNS):
+    samples = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        result = func()
+        samples.append((time.perf_counter() - started) * 1000)
+    samples.sort()
+    return result, samples[len(samples) // 2], samples[min(len(samples) - 1, int(len(samples) * 0.95))]
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 5000000
+    users = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+
+    os.environ['FINANCE_DB_PATH'] = os.path.join(tempfile.mkdtemp(), 'benchmark.db')
+    import db
+    import migrations
+    import search
+
+    conn = db.connect(os.environ['FINANCE_DB_PATH'])
+    search_version = next(version for version, description, _ in migrations.MIGRATIONS
+                          if description == 'Full-text search over descriptions')
+    migrations.migrate(conn, until=search_version - 1)
+
+    started = time.perf_counter()
+    populate(conn, rows, users)
+    loaded = time.perf_counter()
+    migrations.migrate(conn)
+    indexed = time.perf_counter()
+    print(f'{rows:,} rows for {users} users: loaded in {loaded - started:.1f}s, '
+          f'full-text index built in {indexed - loaded:.1f}s')
+
+    typical_user = 2
+    for label, user_id in (('typical user', typical_user), ('heavy user', 1)):
+        owned = conn.execute('SELECT COUNT(*) FROM transactions WHERE user_id = ?', (user_id,)).fetchone()[0]
+        print(f'\n{label} ({owned:,} rows)')
+        print(f'{"query":<14}{"hits":>8}{"fts p50":>10}{"fts p95":>10}{"like p50":>10}')
+        for query in QUERIES:
+            match = search.build_match(user_id, query)
+            count = conn.execute('SELECT COUNT(*) FROM transactions_fts WHERE transactions_fts MATCH ?',
+                                 (match,)).fetchone()[0]
+            _, p50, p95 = timed(lambda: search.search(conn, user_id, match, 50, 0))
+            like = '%' + query.split()[0] + '%'
+            _, like_p50, _ = timed(lambda: conn.execute(
+                'SELECT id FROM transactions WHERE user_id = ? AND description LIKE ? '
+                'ORDER BY date DESC LIMIT 50', (user_id, like)).fetchall(), runs=5)
+            print(f'{query:<14}{count:>8}{p50:>9.2f}ms{p95:>8.2f}ms{like_p50:>8.2f}ms')
+
+    conn.close()
+
+
+if __name__ == '__main__':
+    main()
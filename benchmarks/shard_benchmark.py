@@ -0,0 +1,146 @@
+# Sharded write throughput benchmark.
+#
+# Usage: python benchmarks/shard_benchmark.py [--shards 0,1,2,4,8] [--processes N]
+#            [--users N] [--duration SECONDS] [--durability normal|full]
+#
+# For each shard count, registers --users users in fresh database files and
+# starts --processes worker processes, each running its own app instance
+# the way separate server workers would. Every worker POSTs single
+# transactions through the Flask test client, cycling through its share of
+# the users, for --duration seconds. Reports aggregate inserts per second
+# and p50/p99 latency.
+#
+# The run is then repeated with one more process importing 1000-row batches
+# for a single hot user, and reports the other users' rate and p99 while
+# the hot user holds their database's write lock.
+#
+# With --durability normal each request commits on its own connection
+# (synchronous=NORMAL). With full, requests go through the group-commit
+# writers, one per database, which fsync every commit.
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+PASSWORD = 'Passw0rdShard'
+HOT_BATCH_ROWS = 1000
+
+
+def configure(database, shards, durability):
+    # Set before the app modules are imported, which read them once
+    os.environ['SECRET_KEY'] = 'shard-benchmark-key-shared-by-all-processes'
+    os.environ['FINANCE_DB_PATH'] = database
+    os.environ['FINANCE_DB_SHARDS'] = str(shards)
+    os.environ['FINANCE_SPOOL_DIR'] = os.path.join(os.path.dirname(database), 'spool')
+    os.environ['FINANCE_HASH_WORKERS'] = '0'
+    os.environ['FINANCE_PASSWORD_ITERATIONS'] = '1000'
+    os.environ['FINANCE_RESPONSE_CACHE_MB'] = '0'
+    os.environ['FINANCE_WRITE_BEHIND'] = 'true' if durability == 'full' else 'false'
+    os.environ['FINANCE_WRITE_DURABILITY'] = durability
+
+
+def setup(database, shards, durability, users, results):
+    configure(database, shards, durability)
+    import app as finance_app
+
+    finance_app.init_db()
+    client = finance_app.app.test_client()
+    tokens = []
+    for i in range(users):
+        username = f'shard{i}'
+        response = client.post('/register', json={'username': username, 'password': PASSWORD,
+                                                  'email': f'{username}@example.com'})
+        tokens.append(response.get_json()['token'])
+    results.put(tokens)
+
+
+def worker(database, shards, durability, tokens, start_at, duration, batch_rows, results):
+    configure(database, shards, durability)
+    import app as finance_app
+
+    client = finance_app.app.test_client()
+    item = {'description': 'coffee shop', 'amount': 4.5, 'type': 'expense', 'date': '2024-03-01'}
+    body = {'transactions': [item] * batch_rows} if batch_rows else item
+    path = '/transactions/batch' if batch_rows else '/transactions'
+    latencies = []
+    errors = 0
+    index = 0
+    while time.time() < start_at:
+        time.sleep(0.001)
+    deadline = start_at + duration
+    while time.time() < deadline:
+        headers = {'Authorization': f'Bearer {tokens[index % len(tokens)]}'}
+        index += 1
+        started = time.perf_counter()
+        response = client.post(path, json=body, headers=headers)
+        if response.status_code in (200, 201):
+            latencies.append((time.perf_counter() - started) * 1000)
+        else:
+            errors += 1
+    results.put((batch_rows, latencies, errors))
+
+
+def run(context, database, shards, durability, tokens, processes, duration, hot):
+    results = context.Queue()
+    # Start together once every process has imported the app
+    start_at = time.time() + 3
+    workers = []
+    for number in range(processes):
+        share = tokens[number + 1::processes] if hot else tokens[number::processes]
+        workers.append(context.Process(target=worker, args=(database, shards, durability, share,
+                                                            start_at, duration, 0, results)))
+    if hot:
+        workers.append(context.Process(target=worker, args=(database, shards, durability, tokens[:1],
+                                                            start_at, duration, HOT_BATCH_ROWS, results)))
+    for process in workers:
+        process.start()
+    outcomes = [results.get() for _ in workers]
+    for process in workers:
+        process.join()
+
+    latencies = sorted(value for batch_rows, values, _ in outcomes if not batch_rows for value in values)
+    errors = sum(errors for _, _, errors in outcomes)
+    hot_rows = sum(len(values) * batch_rows for batch_rows, values, _ in outcomes if batch_rows)
+    if not latencies:
+        return 0.0, 0.0, 0.0, errors, hot_rows / duration
+    return (len(latencies) / duration, latencies[len(latencies) // 2],
+            latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))], errors, hot_rows / duration)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark write throughput by shard count')
+    parser.add_argument('--shards', default='0,1,2,4,8')
+    parser.add_argument('--processes', type=int, default=8)
+    parser.add_argument('--users', type=int, default=64)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--durability', choices=('normal', 'full'), default='normal')
+    args = parser.parse_args()
+    shard_counts = [int(value) for value in args.shards.split(',')]
+
+    # Fresh interpreters, so each process reads its own settings on import
+    context = multiprocessing.get_context('spawn')
+    print(f'{args.processes} processes, {args.users} users, {args.durability} durability, '
+          f'{os.cpu_count()} CPUs')
+    print(f'{"shards":>6}{"load":>10}{"inserts/s":>12}{"p50 ms":>10}{"p99 ms":>10}{"errors":>8}{"hot rows/s":>12}')
+    for shards in shard_counts:
+        database = os.path.join(tempfile.mkdtemp(), 'benchmark.db')
+        results = context.Queue()
+        process = context.Process(target=setup, args=(database, shards, args.durability, args.users, results))
+        process.start()
+        tokens = results.get()
+        process.join()
+
+        for hot in (False, True):
+            rate, p50, p99, errors, hot_rate = run(context, database, shards, args.durability, tokens,
+                                                   args.processes, args.duration, hot)
+            load = 'hot user' if hot else 'uniform'
+            hot_column = f'{hot_rate:>12.0f}' if hot else f'{"":>12}'
+            print(f'{shards:>6}{load:>10}{rate:>12.0f}{p50:>10.2f}{p99:>10.2f}{errors:>8}{hot_column}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+# /analytics/timeseries aggregation benchmark.
+#
+# Usage: python benchmarks/timeseries_benchmark.py [rows]
+#
+# Loads one user with `rows` synthetic transactions spread over ten years
+# into a scratch database, then times timeseries.compute for each bucket
+# size over the whole range against a per-row Python loop over the same
+# rows.
+import datetime
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+CATEGORIES = ['groceries', 'transportation', 'entertainment', 'utilities', 'shopping',
+              'dining', 'healthcare', 'education', 'travel', 'other']
+
+
+def populate(conn, rows, start, days):
+    random.seed(7)
+    batch = []
+    for _ in range(rows):
+        is_income = random.random() < 0.1
+        batch.append((1, 'benchmark row', random.randint(100, 500000) / 100,
+                      'income' if is_income else 'expense',
+                      'other' if is_income else random.choice(CATEGORIES),
+                      (start + datetime.timedelta(days=random.randrange(days))).isoformat()))
+        if len(batch) == 100000:
+            conn.executemany('INSERT INTO transactions (user_id, description, amount, type, category, date) '
+                             'VALUES (?, ?, ?, ?, ?, ?)', batch)
+            batch = []
+    if batch:
+        conn.executemany('INSERT INTO transactions (user_id, description, amount, type, category, date) '
+                         'VALUES (?, ?, ?, ?, ?, ?)', batch)
+    conn.commit()
+
+
+def python_loop(conn, start, end):
+    income = {}
+    expenses = {}
+    for type_transaction, date, amount in conn.execute(
+            'SELECT type, date, amount FROM transactions WHERE user_id = ? AND date >= ? AND date <= ?',
+            (1, start.isoformat(), end.isoformat())):
+        target = income if type_transaction == 'income' else expenses
+        target[date] = target.get(date, 0) + amount
+    return income, expenses
+
+
+def timed(label, func, repeat=3):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    print(f'{label:<32} {best * 1000:9.1f} ms')
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    os.environ['FINANCE_DB_PATH'] = os.path.join(tempfile.mkdtemp(), 'bench.db')
+
+    import app
+    import rollups
+    import timeseries
+
+    start = datetime.date(2015, 1, 1)
+    end = datetime.date(2024, 12, 31)
+    app.init_db()
+
+    with app.app.app_context():
+        conn = app.get_db()
+        populate(conn, rows, start, (end - start).days + 1)
+        rollups.rebuild(conn)
+        print(f'{rows:,} transactions for one user, {start} to {end}')
+
+        timed('python loop, daily totals', lambda: python_loop(conn, start, end))
+        for bucket in timeseries.BUCKETS:
+            timed(f'timeseries {bucket}', lambda: timeseries.compute(conn, 1, bucket, start, end))
+
+
+if __name__ == '__main__':
+    main()
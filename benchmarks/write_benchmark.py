@@ -0,0 +1,90 @@
+# Transaction insert throughput benchmark.
+#
+# Usage: python benchmarks/write_benchmark.py [seconds per run]
+#
+# Registers one user per client in a scratch database, then has 1, 16 and
+# 64 threads each POST /transactions in a loop through the Flask test
+# client. Every client count is run with each request committing on its own
+# and with the group-commit writer in normal and full durability mode.
+# Prints inserts per second, failed requests and rows per commit.
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+CLIENT_COUNTS = (1, 16, 64)
+MODES = (
+    ('per-request commit', False, 'normal'),
+    ('group commit, normal', True, 'normal'),
+    ('group commit, full', True, 'full'),
+)
+
+
+def register_clients(client, count):
+    tokens = []
+    for i in range(count):
+        username = f'writer{i}'
+        client.post('/register', json={'username': username, 'password': 'Passw0rdWrite',
+                                       'email': f'{username}@example.com'})
+        response = client.post('/login', json={'username': username, 'password': 'Passw0rdWrite'})
+        tokens.append(response.get_json()['token'])
+    return tokens
+
+
+def run(finance_app, tokens, seconds):
+    stop = threading.Event()
+    counts = [[0, 0] for _ in tokens]
+
+    def post(index, token):
+        client = finance_app.app.test_client()
+        headers = {'Authorization': f'Bearer {token}'}
+        body = {'description': 'coffee shop', 'amount': 4.5, 'type': 'expense', 'date': '2024-03-01'}
+        while not stop.is_set():
+            response = client.post('/transactions', json=body, headers=headers)
+            counts[index][0 if response.status_code == 201 else 1] += 1
+
+    threads = [threading.Thread(target=post, args=(index, token)) for index, token in enumerate(tokens)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    time.sleep(seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    return sum(ok for ok, _ in counts) / elapsed, sum(failed for _, failed in counts)
+
+
+def main():
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 3
+
+    os.environ['FINANCE_DB_PATH'] = os.path.join(tempfile.mkdtemp(), 'benchmark.db')
+    os.environ.setdefault('FINANCE_HASH_WORKERS', '0')
+    os.environ.setdefault('FINANCE_PASSWORD_ITERATIONS', '1000')
+
+    import app as finance_app
+    import writer
+
+    finance_app.init_db()
+    tokens = register_clients(finance_app.app.test_client(), max(CLIENT_COUNTS))
+
+    print(f'{"mode":<22}{"clients":>8}{"inserts/s":>12}{"failed":>8}{"rows/commit":>13}')
+    for label, write_behind, durability in MODES:
+        for clients in CLIENT_COUNTS:
+            finance_app.app.config['WRITE_BEHIND'] = write_behind
+            finance_app.app.config['WRITE_DURABILITY'] = durability
+            rate, failed = run(finance_app, tokens[:clients], seconds)
+
+            rows_per_commit = 1.0
+            transaction_writer = finance_app.app.extensions.get('transaction_writers', {}).get('main')
+            if transaction_writer is not None:
+                rows_per_commit = transaction_writer.stats()['rows_per_commit']
+                writer.close_writer(finance_app.app)
+            print(f'{label:<22}{clients:>8}{rate:>12.0f}{failed:>8}{rows_per_commit:>13.1f}')
+
+
+if __name__ == '__main__':
+    main()
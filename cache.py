@@ -0,0 +1,154 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+from flask import Response
+
+import db
+import responses
+
+# Serialized response cache for read endpoints.
+#
+# Every user has a version counter in data_versions, next to their data,
+# that each write path bumps inside its own transaction. Cache keys include
+# that version, so a write implicitly invalidates everything cached for the
+# user and stale entries simply age out of the LRU. ETags are content hashes, which lets
+# clients revalidate with If-None-Match and get an empty 304 back. Entries
+# also keep their body compressed in each encoding clients have asked for,
+# so hits are not compressed again.
+
+
+# Raises db.UserMoved when the user's data has moved to another shard, so a
+# request routed before the move never caches or changes the old copy
+def get_data_version(conn, user_id):
+    row = conn.execute('SELECT version, moved_to FROM data_versions WHERE user_id = ?', (user_id,)).fetchone()
+    if row is None:
+        return 0
+    if row[1] is not None:
+        raise db.UserMoved(user_id)
+    return row[0]
+
+
+# Call inside the transaction that changes the user's transactions
+def bump_data_version(cursor, user_id):
+    cursor.execute('''
+        INSERT INTO data_versions (user_id, version) VALUES (?, 1)
+        ON CONFLICT (user_id) DO UPDATE SET version = version + 1 WHERE moved_to IS NULL
+    ''', (user_id,))
+    if not cursor.rowcount:
+        raise db.UserMoved(user_id)
+
+
+def make_key(user_id, version, endpoint, args, *extra):
+    return (user_id, version, endpoint, tuple(sorted(args.items(multi=True))), extra)
+
+
+class CacheEntry:
+    __slots__ = ('body', 'etag', 'mimetype', 'headers', 'encoded', 'size')
+
+    def __init__(self, body, mimetype, headers):
+        self.body = body
+        self.etag = hashlib.blake2b(body, digest_size=16).hexdigest()
+        self.mimetype = mimetype
+        self.headers = headers
+        # encoding -> compressed body
+        self.encoded = {}
+        self.size = len(body) + 256
+
+
+class ResponseCache:
+    def __init__(self, budget_bytes):
+        self.budget_bytes = budget_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, entry):
+        if entry.size > self.budget_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._size -= previous.size
+            self._entries[key] = entry
+            self._size += entry.size
+            self._evict()
+
+    def _evict(self):
+        while self._size > self.budget_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._size -= evicted.size
+
+    # The entry's body in the encoding the client prefers, as (body,
+    # encoding), with encoding None for the uncompressed body. Each encoding
+    # is compressed once per entry; concurrent requests may both compress
+    # it, and one copy is kept.
+    def encode(self, key, entry, accept_encodings):
+        if not responses.compressible(entry.mimetype, len(entry.body)):
+            return entry.body, None
+        encoding = responses.choose_encoding(accept_encodings)
+        if encoding is None:
+            return entry.body, None
+        body = entry.encoded.get(encoding)
+        if body is None:
+            body = responses.compress(entry.body, encoding)
+            with self._lock:
+                # Evicted entries are not worth growing
+                if self._entries.get(key) is entry and encoding not in entry.encoded:
+                    entry.encoded[encoding] = body
+                    entry.size += len(body)
+                    self._size += len(body)
+                    self._evict()
+        return body, encoding
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self._size,
+                'budget_bytes': self.budget_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+# Capture a freshly built 200 response, keeping its custom X- headers
+def entry_from_response(response):
+    headers = [(name, value) for name, value in response.headers.items() if name.startswith('X-')]
+    return CacheEntry(response.get_data(), response.mimetype, headers)
+
+
+# body and encoding are as returned by ResponseCache.encode
+def build_response(entry, request, cache_status, body, encoding):
+    response = Response(body, status=200, mimetype=entry.mimetype, headers=entry.headers)
+    # The same tag for every encoding, weak when compressed, as
+    # responses.compress_response does
+    response.set_etag(entry.etag, weak=encoding is not None)
+    # Let browsers keep the body but revalidate it on every use
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.headers['Vary'] = 'Authorization'
+    if responses.compressible(entry.mimetype, len(entry.body)):
+        response.vary.add('Accept-Encoding')
+    if encoding is not None:
+        response.headers['Content-Encoding'] = encoding
+    response.headers['X-Cache'] = cache_status
+    return response.make_conditional(request)
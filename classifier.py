@@ -0,0 +1,242 @@
+import functools
+import math
+import re
+import threading
+from collections import OrderedDict
+
+import metrics
+
+# Category keywords in priority order: a description gets the first category
+# that has any keyword contained in it, checking keywords in the order listed.
+CATEGORY_KEYWORDS = (
+    ('groceries', ('food', 'grocery', 'supermarket', 'market', 'fresh', 'organic', 'produce')),
+    ('transportation', ('uber', 'lyft', 'taxi', 'gas', 'fuel', 'parking', 'metro', 'bus', 'train')),
+    ('entertainment', ('movie', 'theater', 'concert', 'game', 'netflix', 'spotify', 'amazon prime')),
+    ('utilities', ('electric', 'water', 'gas', 'internet', 'phone', 'cable', 'wifi')),
+    ('shopping', ('amazon', 'walmart', 'target', 'clothing', 'shoes', 'electronics')),
+    ('dining', ('restaurant', 'cafe', 'coffee', 'pizza', 'burger', 'sushi', 'dinner', 'lunch')),
+    ('healthcare', ('pharmacy', 'doctor', 'medical', 'dental', 'vision', 'insurance')),
+    ('education', ('book', 'course', 'tuition', 'school', 'college', 'university')),
+    ('travel', ('hotel', 'flight', 'airbnb', 'vacation', 'trip', 'booking')),
+)
+
+DEFAULT_CATEGORY = 'other'
+
+CATEGORIES = tuple(category for category, _ in CATEGORY_KEYWORDS) + (DEFAULT_CATEGORY,)
+
+# Number of distinct normalized descriptions remembered
+CACHE_SIZE = 65536
+
+# No keyword contains a digit or '#', so collapsing digit runs to '#' never
+# creates or breaks a match. Descriptions that only differ in reference
+# numbers, dates or store numbers then share one cache entry.
+_DIGIT_RUNS = re.compile(r'[0-9]+')
+
+
+def normalize_description(description):
+    return _DIGIT_RUNS.sub('#', description.lower())
+
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def _match_category(normalized):
+    for category, keywords in CATEGORY_KEYWORDS:
+        for keyword in keywords:
+            if keyword in normalized:
+                return category
+    return DEFAULT_CATEGORY
+
+
+# Simple ML-based transaction classification
+@metrics.timed('classify_transaction')
+def classify_transaction(description):
+    return _match_category(normalize_description(description))
+
+
+# Classify a batch with the per-call lookups hoisted out of the loop
+@metrics.timed('classify_many')
+def classify_many(descriptions):
+    substitute = _DIGIT_RUNS.sub
+    match = _match_category
+    return [match(substitute('#', description.lower())) for description in descriptions]
+
+
+# Per-user learned classification
+#
+# Category corrections a user makes are stored in the categories table and
+# used to train a multinomial naive Bayes model over description tokens.
+# Until a user has made MIN_TRAINING_EXAMPLES corrections, or when none of a
+# description's tokens have been seen in a correction, the keyword
+# classifier above is used instead.
+#
+# The keyword result also competes with the learned categories, as if it
+# were one correction, and the model only overrides it when the winner's
+# probability beats the runner-up's by MIN_MARGIN. Words too short or too
+# common to say anything about a category are not tokens, so "Payment to
+# John" teaches nothing about "Uber to airport".
+MIN_TRAINING_EXAMPLES = 3
+MIN_MARGIN = 0.5
+
+_TOKENS = re.compile(r'[a-z]{3,}')
+
+STOPWORDS = frozenset((
+    'and', 'for', 'from', 'the', 'this', 'that', 'with', 'into', 'onto', 'via',
+    'your', 'our', 'his', 'her', 'their', 'its', 'per', 'off', 'out', 'new',
+))
+
+# Rough per-entry costs used to keep the model cache within its budget
+_MODEL_BASE_BYTES = 1024
+_TOKEN_BYTES = 200
+_COUNT_BYTES = 100
+
+
+def tokenize(description):
+    return [token for token in _TOKENS.findall(description.lower()) if token not in STOPWORDS]
+
+
+class UserModel:
+    def __init__(self):
+        self.examples = 0
+        self.category_examples = {}  # category -> number of corrections
+        self.category_tokens = {}  # category -> total token count
+        self.token_counts = {}  # token -> {category: count}
+        self.size = _MODEL_BASE_BYTES
+        self.version = None  # data version the model was last checked against
+
+    # Add one correction; O(tokens in the description)
+    def learn(self, description, category):
+        self.examples += 1
+        self.category_examples[category] = self.category_examples.get(category, 0) + 1
+
+        tokens = tokenize(description)
+        self.category_tokens[category] = self.category_tokens.get(category, 0) + len(tokens)
+        for token in tokens:
+            counts = self.token_counts.get(token)
+            if counts is None:
+                counts = self.token_counts[token] = {}
+                self.size += _TOKEN_BYTES
+            if category not in counts:
+                self.size += _COUNT_BYTES
+            counts[category] = counts.get(category, 0) + 1
+
+    # Most likely category, or None when the model has nothing to go on or
+    # is not clearly more confident than the keyword classifier, whose
+    # result for the description is keyword_category
+    def predict(self, description, keyword_category):
+        if self.examples < MIN_TRAINING_EXAMPLES:
+            return None
+
+        known = [self.token_counts[token] for token in tokenize(description) if token in self.token_counts]
+        if not known:
+            return None
+
+        vocabulary = len(self.token_counts)
+        candidates = dict(self.category_examples)
+        if keyword_category != DEFAULT_CATEGORY and keyword_category not in candidates:
+            candidates[keyword_category] = 1
+        total = sum(candidates.values())
+
+        scores = {}
+        for category, examples in candidates.items():
+            score = math.log(examples / total)
+            denominator = math.log(self.category_tokens.get(category, 0) + vocabulary)
+            for counts in known:
+                score += math.log(counts.get(category, 0) + 1) - denominator
+            scores[category] = score
+
+        best_category = max(scores, key=scores.get)
+        if len(scores) > 1:
+            # Posterior probabilities of the best two
+            best_score = scores[best_category]
+            top = sorted((math.exp(score - best_score) for score in scores.values()), reverse=True)
+            if (top[0] - top[1]) / sum(top) < MIN_MARGIN:
+                return None
+        return best_category
+
+
+class ModelCache:
+    # LRU cache of per-user models bounded by an approximate byte budget.
+    # load(user_id) must return the user's (description, category) pairs,
+    # version(user_id) the user's data version and count(user_id) how many
+    # corrections the user has stored.
+    def __init__(self, budget_bytes, load, version, count):
+        self.budget_bytes = budget_bytes
+        self._load = load
+        self._version = version
+        self._count = count
+        self._models = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    # Models are keyed on the user's data version, so corrections stored by
+    # another process are picked up. Most writes are not corrections, so on a
+    # version change the model is only rebuilt if the number of corrections
+    # differs. Loading happens outside the lock; concurrent misses for one
+    # user each build a model and the last one inserted is kept.
+    def _get(self, user_id):
+        version = self._version(user_id)
+        with self._lock:
+            model = self._models.get(user_id)
+            if model is not None and model.version == version:
+                self._models.move_to_end(user_id)
+                return model
+
+        if model is not None and model.examples == self._count(user_id):
+            model.version = version
+        else:
+            model = UserModel()
+            for description, category in self._load(user_id):
+                model.learn(description, category)
+            model.version = version
+
+        with self._lock:
+            old = self._models.pop(user_id, None)
+            if old is not None:
+                self._size -= old.size
+            self._models[user_id] = model
+            self._size += model.size
+            self._evict()
+        return model
+
+    def _evict(self):
+        # Always keep the most recently used model, even if it alone is over budget
+        while self._size > self.budget_bytes and len(self._models) > 1:
+            _, model = self._models.popitem(last=False)
+            self._size -= model.size
+
+    # Apply a correction that has already been stored in the categories table
+    def record(self, user_id, description, category):
+        with self._lock:
+            model = self._models.get(user_id)
+            if model is None:
+                return
+            before = model.size
+            model.learn(description, category)
+            self._size += model.size - before
+            self._evict()
+
+    def classify(self, user_id, description):
+        keyword_category = classify_transaction(description)
+        model = self._get(user_id)
+        with self._lock:
+            category = model.predict(description, keyword_category)
+        return category or keyword_category
+
+    def classify_many(self, user_id, descriptions):
+        keyword_categories = classify_many(descriptions)
+        model = self._get(user_id)
+        with self._lock:
+            if model.examples < MIN_TRAINING_EXAMPLES:
+                return keyword_categories
+            predicted = [model.predict(description, keyword_category)
+                         for description, keyword_category in zip(descriptions, keyword_categories)]
+        return [category or keyword_category for category, keyword_category in zip(predicted, keyword_categories)]
+
+    def invalidate(self, user_id):
+        with self._lock:
+            model = self._models.pop(user_id, None)
+            if model is not None:
+                self._size -= model.size
+
+    @property
+    def size(self):
+        return self._size
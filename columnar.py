@@ -0,0 +1,401 @@
+import json
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+import cache
+import db
+
+# Hot-user columnar transaction cache.
+#
+# Holds each cached user's transactions as NumPy columns, about 18 bytes a
+# row: one int64 sort key combining the date (days since 1970) and the id,
+# the amount as float64, and one-byte codes for type and category interned
+# in process-wide tables. Columns are kept sorted by (date, id), so date
+# ranges and list cursors are binary searches and filters are vectorized.
+#
+# An entry is only used while its version equals the user's data_version,
+# so any write the cache was not told about (another process, a path that
+# does not report its changes) simply sends reads back to SQLite. Write
+# paths report their changes with record_insert/record_delete/
+# record_category inside their transaction; the change is applied once the
+# transaction commits, moving the entry to the new version. Entries are
+# never modified in place: a change builds new arrays, so a reader keeps a
+# consistent snapshot. A user who is not cached is loaded on a background
+# thread while their requests keep going to SQLite. Entries are evicted
+# least recently used under FINANCE_COLUMNAR_CACHE_MB; 0 disables the cache.
+
+DEFAULT_BUDGET_BYTES = int(os.environ.get('FINANCE_COLUMNAR_CACHE_MB', '0')) * 1024 * 1024
+
+# Keys are day * ID_SPACE + id, which orders rows by date, then id
+ID_SPACE = 1 << 40
+
+# Fixed cost per entry on top of its arrays
+ENTRY_OVERHEAD = 512
+
+LOAD_ROWS_SQL = 'SELECT id, date, amount, type, category FROM transactions WHERE user_id = ?'
+
+# CROSS JOIN keeps json_each as the outer loop, so each id is a rowid
+# lookup instead of a filter over all of the user's rows
+PAGE_ROWS_SQL = '''
+    SELECT t.id, t.description, t.amount, t.type, t.category, t.date
+    FROM json_each(?) CROSS JOIN transactions AS t ON t.id = json_each.value
+    WHERE t.user_id = ?
+'''
+
+
+# Process-wide string <-> code tables for type and category
+class Interner:
+    def __init__(self):
+        self.values = []
+        self._codes = {}
+        self._lock = threading.Lock()
+
+    def code(self, value):
+        code = self._codes.get(value)
+        if code is None:
+            with self._lock:
+                code = self._codes.get(value)
+                if code is None:
+                    if len(self.values) > 255:
+                        raise ValueError('Too many distinct values to intern')
+                    code = len(self.values)
+                    self.values.append(value)
+                    self._codes[value] = code
+        return code
+
+    def codes(self, values):
+        return np.fromiter((self.code(value) for value in values), dtype=np.uint8, count=len(values))
+
+    # The code of value if it has one, else None
+    def find(self, value):
+        return self._codes.get(value)
+
+
+types = Interner()
+categories = Interner()
+
+
+def day_numbers(dates):
+    return np.asarray(dates, dtype='datetime64[D]').astype(np.int64)
+
+
+def day_number(date):
+    return int(np.datetime64(date, 'D').astype(np.int64))
+
+
+def make_keys(days, ids):
+    return np.asarray(days, dtype=np.int64) * ID_SPACE + np.asarray(ids, dtype=np.int64)
+
+
+# One user's transactions, sorted by (date, id). Never modified once built.
+class UserColumns:
+    __slots__ = ('version', 'keys', 'amounts', 'types', 'categories', 'size')
+
+    def __init__(self, version, keys, amounts, type_codes, category_codes):
+        self.version = version
+        self.keys = keys
+        self.amounts = amounts
+        self.types = type_codes
+        self.categories = category_codes
+        self.size = keys.nbytes + amounts.nbytes + type_codes.nbytes + category_codes.nbytes + ENTRY_OVERHEAD
+
+    # Build from (id, date, amount, type, category) rows in any order
+    @classmethod
+    def from_rows(cls, version, rows):
+        if rows:
+            ids, dates, amounts, type_names, category_names = zip(*rows)
+        else:
+            ids, dates, amounts, type_names, category_names = (), (), (), (), ()
+        keys = make_keys(day_numbers(dates), ids)
+        order = np.argsort(keys, kind='stable')
+        return cls(version, keys[order], np.asarray(amounts, dtype=np.float64)[order],
+                   types.codes(type_names)[order], categories.codes(category_names)[order])
+
+    def __len__(self):
+        return len(self.keys)
+
+    def ids(self, positions):
+        return (self.keys[positions] % ID_SPACE).tolist()
+
+    def inserted(self, version, ids, rows):
+        added = UserColumns.from_rows(version, [
+            (transaction_id, date, amount, type_transaction, category)
+            for transaction_id, (_, amount, type_transaction, category, date) in zip(ids, rows)
+        ])
+        positions = np.searchsorted(self.keys, added.keys)
+        return UserColumns(version, np.insert(self.keys, positions, added.keys),
+                           np.insert(self.amounts, positions, added.amounts),
+                           np.insert(self.types, positions, added.types),
+                           np.insert(self.categories, positions, added.categories))
+
+    # Positions of the (id, date) pairs, or None if any of them is missing
+    def _positions(self, id_dates):
+        ids, dates = zip(*id_dates)
+        keys = make_keys(day_numbers(dates), ids)
+        positions = np.searchsorted(self.keys, keys)
+        if (positions >= len(self.keys)).any() or (self.keys[np.minimum(positions, len(self.keys) - 1)] != keys).any():
+            return None
+        return positions
+
+    def deleted(self, version, id_dates):
+        positions = self._positions(id_dates)
+        if positions is None:
+            return None
+        return UserColumns(version, np.delete(self.keys, positions), np.delete(self.amounts, positions),
+                           np.delete(self.types, positions), np.delete(self.categories, positions))
+
+    def recategorized(self, version, transaction_id, date, category):
+        positions = self._positions([(transaction_id, date)])
+        if positions is None:
+            return None
+        category_codes = self.categories.copy()
+        category_codes[positions] = categories.code(category)
+        return UserColumns(version, self.keys, self.amounts, self.types, category_codes)
+
+    # Index range of rows dated start..end, and before the (date, id) cursor
+    def _bounds(self, start=None, end=None, before=None):
+        low = 0 if start is None else int(np.searchsorted(self.keys, day_number(start) * ID_SPACE))
+        high = len(self.keys) if end is None else int(np.searchsorted(self.keys, (day_number(end) + 1) * ID_SPACE))
+        if before is not None:
+            high = min(high, int(np.searchsorted(self.keys, day_number(before[0]) * ID_SPACE + before[1])))
+        return low, max(low, high)
+
+    # Which rows in low..high match the type and category: a boolean array,
+    # None when every row does, or False when a value was never interned
+    def _matches(self, low, high, type_filter, category):
+        mask = None
+        for column, interner, value in ((self.types, types, type_filter),
+                                        (self.categories, categories, category)):
+            if value is None:
+                continue
+            code = interner.find(value)
+            if code is None:
+                return False
+            matches = column[low:high] == code
+            mask = matches if mask is None else mask & matches
+        return mask
+
+    # Ids of up to limit matching rows, newest first, before the cursor.
+    # Filtered pages scan backwards in growing chunks, so a page near the
+    # newest rows does not touch the whole history.
+    def page(self, limit, type_filter=None, category=None, start=None, end=None, before=None):
+        low, high = self._bounds(start, end, before)
+        if type_filter is None and category is None:
+            return self.ids(np.arange(high - 1, max(low, high - limit) - 1, -1))
+        found = []
+        chunk = max(limit * 4, 1024)
+        while high > low and len(found) < limit:
+            chunk_low = max(low, high - chunk)
+            mask = self._matches(chunk_low, high, type_filter, category)
+            if mask is False:
+                break
+            found.extend(self.ids(np.flatnonzero(mask)[::-1][:limit - len(found)] + chunk_low))
+            high = chunk_low
+            chunk *= 2
+        return found
+
+    # (count, income total, expense total) of the matching rows, with None
+    # totals when nothing matches, like SUM in SQL
+    def totals(self, type_filter=None, category=None, start=None, end=None):
+        low, high = self._bounds(start, end)
+        mask = self._matches(low, high, type_filter, category)
+        if mask is False:
+            return 0, None, None
+        type_codes = self.types[low:high]
+        amounts = self.amounts[low:high]
+        if mask is not None:
+            type_codes = type_codes[mask]
+            amounts = amounts[mask]
+        if not len(amounts):
+            return 0, None, None
+        # One pass summing amounts per type code
+        sums = np.bincount(type_codes, weights=amounts, minlength=len(types.values))
+        income = types.find('income')
+        expense = types.find('expense')
+        return (len(amounts), float(sums[income]) if income is not None else 0.0,
+                float(sums[expense]) if expense is not None else 0.0)
+
+    # Income and expense rows dated start..end as (day offset from origin,
+    # is expense, category code, amount) columns for timeseries
+    def daily(self, origin, start, end):
+        low, high = self._bounds(start, end)
+        type_codes = self.types[low:high]
+        is_expense = type_codes == types.find('expense')
+        keep = is_expense | (type_codes == types.find('income'))
+        return ((self.keys[low:high][keep] // ID_SPACE) - day_number(origin), is_expense[keep],
+                self.categories[low:high][keep], self.amounts[low:high][keep])
+
+
+class ColumnarCache:
+    def __init__(self, app, budget_bytes=DEFAULT_BUDGET_BYTES):
+        self.app = app
+        self.budget_bytes = budget_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self._loading = set()
+        # Users whose columns alone exceed the budget are not loaded again
+        self._too_large = set()
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+
+    @property
+    def enabled(self):
+        return self.budget_bytes > 0
+
+    # The user's columns if they match the current data version. Otherwise
+    # starts loading them in the background and returns None.
+    def get(self, conn, user_id):
+        version = cache.get_data_version(conn, user_id)
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry.version == version:
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                return entry
+            self.misses += 1
+            if user_id in self._loading or user_id in self._too_large:
+                return None
+            self._loading.add(user_id)
+        threading.Thread(target=self._load, args=(user_id,), name='columnar-cache-loader', daemon=True).start()
+        return None
+
+    def _load(self, user_id):
+        try:
+            # A user moved meanwhile fails the version read below
+            name = db.database_for_user(self.app, user_id)
+            conn = db.connect(db.database_paths(self.app)[name])
+            try:
+                # Version and rows from one read snapshot
+                conn.execute('BEGIN')
+                version = cache.get_data_version(conn, user_id)
+                entry = UserColumns.from_rows(version, conn.execute(LOAD_ROWS_SQL, (user_id,)).fetchall())
+                conn.rollback()
+            finally:
+                conn.close()
+            with self._lock:
+                self.loads += 1
+                if entry.size > self.budget_bytes:
+                    self._too_large.add(user_id)
+                    return
+                current = self._entries.get(user_id)
+                if current is None or current.version < entry.version:
+                    self._replace(user_id, entry)
+        except Exception:
+            # The user is simply served from SQLite
+            pass
+        finally:
+            with self._lock:
+                self._loading.discard(user_id)
+
+    # Call with the lock held
+    def _replace(self, user_id, entry):
+        previous = self._entries.pop(user_id, None)
+        if previous is not None:
+            self._size -= previous.size
+        if entry is None:
+            return
+        self._entries[user_id] = entry
+        self._size += entry.size
+        while self._size > self.budget_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._size -= evicted.size
+
+    # Move the user's entry from version - 1 to version with
+    # change(entry, version). An entry at any other version, or a change
+    # that fails, is dropped.
+    def apply(self, user_id, version, change):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return
+            updated = None
+            if entry.version == version - 1:
+                try:
+                    updated = change(entry, version)
+                except Exception:
+                    updated = None
+            if updated is not None and updated.size > self.budget_bytes:
+                updated = None
+            self._replace(user_id, updated)
+
+    # Apply change once the cursor's transaction commits
+    def record(self, cursor, user_id, change):
+        conn = cursor.connection
+        after_commit = getattr(conn, 'after_commit', None)
+        if after_commit is None:
+            with self._lock:
+                self._replace(user_id, None)
+            return
+        # The version bumped earlier in this transaction
+        version = cache.get_data_version(conn, user_id)
+        after_commit(lambda: self.apply(user_id, version, change))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+            self._too_large.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'users': len(self._entries),
+                'rows': sum(len(entry) for entry in self._entries.values()),
+                'bytes': self._size,
+                'budget_bytes': self.budget_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'loads': self.loads,
+                'hit_ratio': round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+# The process's cache, set by init_app. Write paths outside a request (the
+# group-commit writer, import jobs) report their changes to it as well.
+active = None
+
+
+def init_app(app):
+    global active
+    app.config.setdefault('COLUMNAR_CACHE_BYTES', DEFAULT_BUDGET_BYTES)
+    active = ColumnarCache(app, app.config['COLUMNAR_CACHE_BYTES'])
+    app.extensions['columnar_cache'] = active
+
+
+# The user's columns, or None when the cache is off or not current
+def get_columns(conn, user_id):
+    if active is None or not active.enabled:
+        return None
+    return active.get(conn, user_id)
+
+
+# (id, description, amount, type, category, date) rows in the order of ids.
+# Rows deleted since the ids were read are left out.
+def fetch_rows(conn, user_id, ids):
+    rows = {row[0]: row for row in conn.execute(PAGE_ROWS_SQL, (json.dumps(ids), user_id))}
+    return [rows[transaction_id] for transaction_id in ids if transaction_id in rows]
+
+
+# Report changes from inside the writing transaction, after
+# bump_data_version. rows are (description, amount, type, category, date).
+def record_insert(cursor, user_id, ids, rows):
+    if active is not None and active.enabled:
+        active.record(cursor, user_id, lambda entry, version: entry.inserted(version, ids, rows))
+
+
+# id_dates are the (id, date) pairs of the deleted rows
+def record_delete(cursor, user_id, id_dates):
+    if active is not None and active.enabled:
+        active.record(cursor, user_id, lambda entry, version: entry.deleted(version, id_dates))
+
+
+def record_category(cursor, user_id, transaction_id, date, category):
+    if active is not None and active.enabled:
+        active.record(cursor, user_id,
+                      lambda entry, version: entry.recategorized(version, transaction_id, date, category))
@@ -0,0 +1,247 @@
+import os
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from flask import current_app, g
+
+import metrics
+
+# Default database settings, overridable through app.config or the environment
+DEFAULT_DATABASE = os.environ.get('FINANCE_DB_PATH', 'finance.db')
+DEFAULT_SHARDS = int(os.environ.get('FINANCE_DB_SHARDS', '0'))
+DEFAULT_POOL_SIZE = int(os.environ.get('FINANCE_DB_POOL_SIZE', '8'))
+DEFAULT_POOL_TIMEOUT = float(os.environ.get('FINANCE_DB_POOL_TIMEOUT', '10'))
+
+# Storage is split across database files by user. The main database holds
+# users and user_shards, which records the shard each user's data lives in.
+# With FINANCE_DB_SHARDS=N there are N shard files next to it (finance.db ->
+# finance.shard0.db, ...) holding transactions, rollups, corrections, import
+# jobs and data versions. Users without a user_shards row keep their data in
+# the main database, which is all there is with the default of 0 shards.
+# Every file has the full schema. See shards.py for placement and moves.
+MAIN = 'main'
+
+# Number of compiled statements sqlite3 keeps per connection for reuse
+STATEMENT_CACHE_SIZE = 256
+
+# PRAGMAs applied to every new connection. WAL lets readers proceed while a
+# writer holds the lock; synchronous=NORMAL is durable across app crashes in
+# WAL mode and only fsyncs at checkpoints.
+CONNECTION_PRAGMAS = (
+    'PRAGMA journal_mode = WAL',
+    'PRAGMA synchronous = NORMAL',
+    'PRAGMA cache_size = -16000',
+    'PRAGMA mmap_size = 268435456',
+    'PRAGMA temp_store = MEMORY',
+    'PRAGMA busy_timeout = 5000',
+)
+
+
+# Connection that can run callbacks once the current transaction commits,
+# for in-process state that must only change along with the database
+class Connection(metrics.TimedConnection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._after_commit = []
+
+    def after_commit(self, callback):
+        self._after_commit.append(callback)
+
+    def commit(self):
+        super().commit()
+        callbacks, self._after_commit = self._after_commit, []
+        for callback in callbacks:
+            callback()
+
+    def rollback(self):
+        self._after_commit = []
+        super().rollback()
+
+
+def connect(path, timeout=DEFAULT_POOL_TIMEOUT):
+    conn = sqlite3.connect(path, timeout=timeout,
+                           check_same_thread=False,
+                           cached_statements=STATEMENT_CACHE_SIZE,
+                           factory=Connection)
+    for pragma in CONNECTION_PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+# Raised when a user's data has been moved to another shard since the
+# request looked up where it lives
+class UserMoved(Exception):
+    pass
+
+
+class ConnectionPool:
+    def __init__(self, path, size=DEFAULT_POOL_SIZE, timeout=DEFAULT_POOL_TIMEOUT):
+        self.path = path
+        self.size = size
+        self.timeout = timeout
+        self._idle = queue.LifoQueue(maxsize=size)
+        self._created = 0
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def _connect(self):
+        return connect(self.path, self.timeout)
+
+    def acquire(self):
+        # Reuse an idle connection first, then grow up to the pool size,
+        # and only then block waiting for another request to release one.
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            if self._closed:
+                raise PoolTimeout('Connection pool is closed')
+            if self._created < self.size:
+                self._created += 1
+                try:
+                    return self._connect()
+                except Exception:
+                    self._created -= 1
+                    raise
+
+        try:
+            return self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise PoolTimeout('Timed out waiting for a database connection')
+
+    def release(self, conn):
+        # Never hand a connection with an open transaction to the next caller
+        if conn.in_transaction:
+            conn.rollback()
+        if self._closed:
+            self._discard(conn)
+            return
+        try:
+            self._idle.put_nowait(conn)
+        except queue.Full:
+            self._discard(conn)
+
+    def _discard(self, conn):
+        conn.close()
+        with self._lock:
+            self._created -= 1
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(conn)
+
+
+def init_app(app):
+    app.config.setdefault('DATABASE', DEFAULT_DATABASE)
+    app.config.setdefault('DATABASE_SHARDS', DEFAULT_SHARDS)
+    app.config.setdefault('DATABASE_POOL_SIZE', DEFAULT_POOL_SIZE)
+    app.config.setdefault('DATABASE_POOL_TIMEOUT', DEFAULT_POOL_TIMEOUT)
+    app.teardown_appcontext(close_db)
+
+
+# Database paths by name: main, then shard0..shardN-1
+def database_paths(app=None):
+    app = app or current_app
+    paths = {MAIN: app.config['DATABASE']}
+    root, ext = os.path.splitext(app.config['DATABASE'])
+    for number in range(app.config['DATABASE_SHARDS']):
+        paths[f'shard{number}'] = f'{root}.shard{number}{ext}'
+    return paths
+
+
+_pool_lock = threading.Lock()
+
+
+def get_pool(app=None, name=MAIN):
+    app = app or current_app
+    pools = app.extensions.setdefault('db_pools', {})
+    path = database_paths(app)[name]
+    pool = pools.get(name)
+    if pool is None or pool.path != path:
+        with _pool_lock:
+            pool = pools.get(name)
+            if pool is None or pool.path != path:
+                if pool is not None:
+                    pool.close()
+                pool = ConnectionPool(path,
+                                      size=app.config['DATABASE_POOL_SIZE'],
+                                      timeout=app.config['DATABASE_POOL_TIMEOUT'])
+                pools[name] = pool
+    return pool
+
+
+# Name of the database holding the user's data, read from the main database
+def placement(conn, user_id):
+    row = conn.execute('SELECT shard FROM user_shards WHERE user_id = ?', (user_id,)).fetchone()
+    return row[0] if row else MAIN
+
+
+def database_for_user(app, user_id):
+    if not app.config['DATABASE_SHARDS']:
+        return MAIN
+    with get_pool(app).connection() as conn:
+        return placement(conn, user_id)
+
+
+# Send this request's get_db() queries to the user's database
+def bind_user(user_id):
+    g.db_user = user_id
+    g.pop('db_name', None)
+
+
+# Name of the database get_db() returns: the bound user's, otherwise main
+def current_database():
+    if 'db_name' not in g:
+        user_id = g.get('db_user')
+        if user_id is None or not current_app.config['DATABASE_SHARDS']:
+            g.db_name = MAIN
+        else:
+            g.db_name = placement(get_main_db(), user_id)
+    return g.db_name
+
+
+def _connection(name):
+    connections = g.setdefault('db_connections', {})
+    if name not in connections:
+        pool = get_pool(name=name)
+        connections[name] = (pool, pool.acquire())
+    return connections[name][1]
+
+
+# Connection to the bound user's database for the current request (the main
+# database when no user is bound), returned to the pool on teardown
+def get_db():
+    return _connection(current_database())
+
+
+# Connection to the main database, for users and shard placement
+def get_main_db():
+    return _connection(MAIN)
+
+
+def close_db(exception=None):
+    connections = g.pop('db_connections', {})
+    for pool, conn in connections.values():
+        pool.release(conn)
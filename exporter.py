@@ -0,0 +1,83 @@
+import csv
+import io
+import json
+import zlib
+
+# Streaming export of a user's transactions.
+#
+# Rows are read with fetchmany in batches and each batch is encoded and
+# yielded before the next one is fetched, so memory use depends on the batch
+# size rather than on the user's history. CSV output uses the column layout
+# /upload accepts, so an export can be imported again as is.
+
+FORMATS = ('csv', 'ndjson')
+
+# Rows fetched and encoded per chunk of output
+EXPORT_BATCH_SIZE = 1000
+
+CSV_HEADER = ('Description', 'Amount', 'Type', 'Date')
+
+# Walks idx_transactions_user_date in (date, id) order, so no sort is needed
+EXPORT_ROWS_SQL = '''
+    SELECT id, description, amount, type, category, date
+    FROM transactions
+    WHERE user_id = ? AND date >= ? AND date <= ?
+    ORDER BY date, id
+'''
+
+MIMETYPES = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+}
+
+
+def iter_batches(conn, user_id, start, end, batch_size=EXPORT_BATCH_SIZE):
+    cursor = conn.execute(EXPORT_ROWS_SQL, (user_id, start, end))
+    try:
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            yield rows
+    finally:
+        cursor.close()
+
+
+def csv_chunks(batches):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    writer.writerow(CSV_HEADER)
+    for rows in batches:
+        writer.writerows((description, amount, type_transaction, date)
+                         for _, description, amount, type_transaction, _, date in rows)
+        yield buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+    # Header only when there are no rows
+    if buffer.tell():
+        yield buffer.getvalue().encode('utf-8')
+
+
+def ndjson_chunks(batches):
+    for rows in batches:
+        yield ''.join(
+            json.dumps({'id': transaction_id, 'description': description, 'amount': amount,
+                        'type': type_transaction, 'category': category, 'date': date}) + '\n'
+            for transaction_id, description, amount, type_transaction, category, date in rows
+        ).encode('utf-8')
+
+
+# Compress a stream of byte chunks into one gzip stream as it is produced
+def gzip_chunks(chunks, level=6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def export(conn, user_id, export_format, start, end, compress=False):
+    batches = iter_batches(conn, user_id, start, end)
+    chunks = csv_chunks(batches) if export_format == 'csv' else ndjson_chunks(batches)
+    return gzip_chunks(chunks) if compress else chunks
@@ -0,0 +1,71 @@
+import hashlib
+import json
+
+# Row fingerprints for idempotent CSV imports.
+#
+# A fingerprint identifies one statement line: the user, date, amount, type
+# and normalized description, plus how many identical lines came before it
+# in the same file. Two identical coffees on one day in one statement get
+# occurrence 0 and 1, so both are kept, while uploading an overlapping
+# statement again yields the same fingerprints and those lines are skipped.
+# Fingerprints are 64-bit integers kept in a unique (user_id, fingerprint)
+# index. Rows added through the JSON API have none.
+
+EXISTING_FINGERPRINTS_SQL = '''
+    SELECT fingerprint FROM transactions
+    WHERE user_id = ? AND fingerprint IN (SELECT value FROM json_each(?))
+'''
+
+# Rows updated per statement while backfilling existing transactions
+BACKFILL_BATCH_SIZE = 10000
+
+
+def normalize_description(description):
+    return ' '.join(description.casefold().split())
+
+
+def _digest(data):
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), 'big', signed=True)
+
+
+def row_key(user_id, date, amount, type_transaction, description):
+    return _digest(f'{user_id}\x1f{date}\x1f{float(amount)!r}\x1f{type_transaction}\x1f'
+                   f'{normalize_description(description)}'.encode('utf-8'))
+
+
+# Hands out fingerprints for the rows of one file in order. Holds one
+# counter per distinct row key seen, so repeated lines are numbered.
+class FingerprintCounter:
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.occurrences = {}
+
+    def next(self, date, amount, type_transaction, description):
+        key = row_key(self.user_id, date, amount, type_transaction, description)
+        occurrence = self.occurrences.get(key, 0)
+        self.occurrences[key] = occurrence + 1
+        return _digest(f'{key}\x1f{occurrence}'.encode('ascii'))
+
+
+# The subset of fingerprints already stored for the user, in one query
+def existing(cursor, user_id, fingerprints):
+    return {row[0] for row in cursor.execute(EXISTING_FINGERPRINTS_SQL, (user_id, json.dumps(fingerprints)))}
+
+
+# Migration step: fingerprint the transactions that predate fingerprints,
+# numbering identical rows of each user in id order
+def backfill(cursor):
+    rows = cursor.execute('SELECT id, user_id, date, amount, type, description FROM transactions '
+                          'ORDER BY user_id, id')
+    update = cursor.connection.cursor()
+    counter = None
+    batch = []
+    for transaction_id, user_id, date, amount, type_transaction, description in rows:
+        if counter is None or counter.user_id != user_id:
+            counter = FingerprintCounter(user_id)
+        batch.append((counter.next(date, amount, type_transaction, description), transaction_id))
+        if len(batch) >= BACKFILL_BATCH_SIZE:
+            update.executemany('UPDATE transactions SET fingerprint = ? WHERE id = ?', batch)
+            batch = []
+    if batch:
+        update.executemany('UPDATE transactions SET fingerprint = ? WHERE id = ?', batch)
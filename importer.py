@@ -0,0 +1,172 @@
+import csv
+import datetime
+import io
+import itertools
+
+import cache
+import columnar
+import fingerprints
+import rollups
+
+# Rows validated, classified and inserted per transaction
+IMPORT_CHUNK_SIZE = 1000
+
+# Only the first errors are reported back so a bad file cannot blow up memory
+MAX_REPORTED_ERRORS = 100
+
+INSERT_TRANSACTION_SQL = '''
+    INSERT INTO transactions (user_id, description, amount, type, category, date, fingerprint)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+'''
+
+
+class ImportResult:
+    def __init__(self, imported=0, failed=0, errors=None, skipped=0):
+        self.imported = imported
+        self.skipped = skipped
+        self.failed = failed
+        self.errors = errors or []
+
+    def add_error(self, line_num, message):
+        self.failed += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({'row': line_num, 'error': message})
+
+    @property
+    def processed(self):
+        return self.imported + self.skipped + self.failed
+
+    # The counts once a pending chunk is committed
+    def plus(self, imported, skipped):
+        return ImportResult(self.imported + imported, self.failed, self.errors, self.skipped + skipped)
+
+    def to_dict(self):
+        return {
+            'imported': self.imported,
+            'skipped': self.skipped,
+            'failed': self.failed,
+            'errors': self.errors,
+            'errors_truncated': self.failed > len(self.errors),
+        }
+
+
+# Decode a binary upload incrementally and yield (line number, fields) for
+# every data row. The header row is skipped and blank lines are ignored.
+def read_csv_rows(binary_stream):
+    text_stream = io.TextIOWrapper(binary_stream, encoding='utf-8-sig', newline='')
+    reader = csv.reader(text_stream)
+    try:
+        next(reader, None)
+        for parts in reader:
+            if not parts or not any(part.strip() for part in parts):
+                continue
+            yield reader.line_num, parts
+    finally:
+        # Leave the underlying upload open for the caller
+        text_stream.detach()
+
+
+# Stream rows from binary_stream into the transactions table.
+#
+# parse_row(parts) returns (True, (description, amount, type, date)) or
+# (False, error message) and classify(descriptions) returns one category per
+# description. Rows parsed with date None have no date of their own and are
+# stored and fingerprinted with default_date (today unless given). Valid
+# rows are committed every chunk_size rows, so memory use does not depend
+# on the file size beyond one fingerprint counter per distinct row. Rows
+# whose fingerprint the user already has are counted as skipped instead of
+# inserted, so uploading a file again is harmless.
+#
+# To resume an interrupted import, pass the saved result and the line number
+# of the last committed row as start_line; earlier lines are only counted
+# for fingerprint numbering. on_chunk(cursor, result, line_num) runs inside
+# each chunk's transaction just before the commit, with the counts as they
+# will be once it commits, so progress saved there is committed atomically
+# with the rows. Raising from it rolls the chunk back.
+def import_csv(conn, user_id, binary_stream, parse_row, classify, chunk_size=IMPORT_CHUNK_SIZE,
+               result=None, start_line=0, on_chunk=None, default_date=None):
+    result = result or ImportResult()
+    default_date = default_date or datetime.date.today().isoformat()
+    counter = fingerprints.FingerprintCounter(user_id)
+    chunk = []
+    chunk_fingerprints = []
+
+    for line_num, parts in read_csv_rows(binary_stream):
+        is_valid, row_result = parse_row(parts)
+        if line_num <= start_line:
+            if is_valid:
+                description, amount, type_transaction, date = row_result
+                counter.next(date or default_date, amount, type_transaction, description)
+            continue
+
+        if not is_valid:
+            result.add_error(line_num, row_result)
+            continue
+
+        description, amount, type_transaction, date = row_result
+        date = date or default_date
+        chunk.append((description, amount, type_transaction, date))
+        chunk_fingerprints.append(counter.next(date, amount, type_transaction, description))
+        if len(chunk) >= chunk_size:
+            _import_chunk(conn, user_id, chunk, chunk_fingerprints, classify, result, line_num, on_chunk)
+            chunk = []
+            chunk_fingerprints = []
+
+    if chunk:
+        _import_chunk(conn, user_id, chunk, chunk_fingerprints, classify, result, line_num, on_chunk)
+
+    return result
+
+
+def _import_chunk(conn, user_id, rows, row_fingerprints, classify, result, line_num, on_chunk):
+    before_commit = None
+    if on_chunk is not None:
+        before_commit = lambda cursor, inserted, skipped: on_chunk(cursor, result.plus(inserted, skipped), line_num)
+    inserted, skipped = insert_chunk(conn, user_id, rows, row_fingerprints, classify, before_commit)
+    result.imported += inserted
+    result.skipped += skipped
+
+
+# Insert (description, amount, type, category, date) rows and update the
+# rollups and data version in the caller's transaction. Returns the new ids.
+def insert_rows(cursor, user_id, rows, row_fingerprints=None):
+    cursor.executemany(INSERT_TRANSACTION_SQL, [
+        (user_id, description, amount, type_transaction, category, date, fingerprint)
+        for (description, amount, type_transaction, category, date), fingerprint
+        in zip(rows, row_fingerprints or itertools.repeat(None))
+    ])
+    # AUTOINCREMENT ids are handed out consecutively while this
+    # transaction holds the write lock, so the rows end at the last id
+    last_id = cursor.execute('SELECT last_insert_rowid()').fetchone()[0]
+    rollups.add_transactions(cursor, user_id, [
+        (amount, type_transaction, category, date)
+        for _, amount, type_transaction, category, date in rows
+    ])
+    cache.bump_data_version(cursor, user_id)
+    ids = list(range(last_id - len(rows) + 1, last_id + 1))
+    columnar.record_insert(cursor, user_id, ids, rows)
+    return ids
+
+
+# Insert one chunk of parsed rows in its own transaction, skipping rows the
+# user already has. Returns (inserted, skipped).
+def insert_chunk(conn, user_id, rows, row_fingerprints, classify, before_commit=None):
+    cursor = conn.cursor()
+    try:
+        # One lookup for the whole chunk; only new rows are classified
+        known = fingerprints.existing(cursor, user_id, row_fingerprints)
+        new = [(row, fingerprint) for row, fingerprint in zip(rows, row_fingerprints) if fingerprint not in known]
+        if new:
+            categories = classify([row[0] for row, _ in new])
+            insert_rows(cursor, user_id, [
+                (description, amount, type_transaction, category, date)
+                for ((description, amount, type_transaction, date), _), category in zip(new, categories)
+            ], [fingerprint for _, fingerprint in new])
+        skipped = len(rows) - len(new)
+        if before_commit is not None:
+            before_commit(cursor, len(new), skipped)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return len(new), skipped
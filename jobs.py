@@ -0,0 +1,324 @@
+import datetime
+import json
+import os
+import threading
+import time
+import uuid
+
+from flask import current_app
+
+import db
+import importer
+
+# Background CSV import jobs.
+#
+# /upload saves the file to the spool directory, records a queued job in
+# import_jobs and returns at once. Worker threads take queued jobs in order,
+# at most one per user at a time, and stream them through importer.import_csv.
+# Each chunk's progress (counts, errors, last line) is written in the same
+# transaction as its rows, so after a crash or restart queued and running
+# jobs are picked up again and continue after the last committed line.
+#
+# Jobs are claimed through the database so none runs twice. A claim records
+# the claiming process as the job's owner and a lease, which the owner
+# extends with every chunk it commits. Other processes leave a running job
+# alone until its lease has expired, i.e. its owner has died or stalled,
+# and then queue it again. The queue itself lives in the app process: a job
+# is picked up by the process that accepted it, or, once it has waited a
+# lease period, by any process that checks for abandoned jobs.
+
+DEFAULT_SPOOL_DIR = os.environ.get('FINANCE_SPOOL_DIR', 'spool')
+DEFAULT_WORKERS = int(os.environ.get('FINANCE_IMPORT_WORKERS', '2'))
+# Seconds a claim lasts without a committed chunk; a chunk must commit
+# within this time or another process may take the job over
+DEFAULT_LEASE_SECONDS = float(os.environ.get('FINANCE_IMPORT_LEASE_SECONDS', '60'))
+
+FINISHED = ('completed', 'failed', 'cancelled')
+
+
+class JobCancelled(Exception):
+    pass
+
+
+# The job's lease expired and another process has claimed it
+class LeaseLost(Exception):
+    pass
+
+
+class ImportJobs:
+    def __init__(self, app, parse_row, classify):
+        self.app = app
+        self.parse_row = parse_row
+        # classify(user_id, descriptions) -> one category per description
+        self.classify = classify
+        self.spool_dir = app.config['IMPORT_SPOOL_DIR']
+        self.workers = app.config['IMPORT_WORKERS']
+        self.lease_seconds = app.config['IMPORT_LEASE_SECONDS']
+        # Identifies this process's claims
+        self.owner = uuid.uuid4().hex
+        self._condition = threading.Condition()
+        self._queue = []
+        self._running_users = set()
+        self._running_jobs = set()
+        self._threads = []
+        self._start_lock = threading.Lock()
+        self._started = False
+        self._closed = False
+
+    # Queue unfinished jobs and start the workers
+    def start(self):
+        if self._started:
+            return
+        with self._start_lock:
+            if self._started:
+                return
+            os.makedirs(self.spool_dir, exist_ok=True)
+            self._recover(time.time())
+            for _ in range(self.workers):
+                thread = threading.Thread(target=self._run, name='import-job-worker', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            thread = threading.Thread(target=self._watch, name='import-job-recovery', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+            self._started = True
+
+    # Requeue running jobs whose lease has expired, and queue the jobs queued
+    # before queued_before that this process does not have yet
+    def _recover(self, queued_before):
+        now = time.time()
+        pending = []
+        for name in db.database_paths(self.app):
+            with db.get_pool(self.app, name).connection() as conn:
+                conn.execute("UPDATE import_jobs SET status = 'queued', owner = NULL "
+                             "WHERE status = 'running' AND (lease_until IS NULL OR lease_until < ?)", (now,))
+                conn.commit()
+                pending.extend(conn.execute("SELECT created_at, id, user_id FROM import_jobs "
+                                            "WHERE status = 'queued' AND created_at < ?",
+                                            (queued_before,)).fetchall())
+        with self._condition:
+            known = self._running_jobs | {job_id for job_id, _ in self._queue}
+            self._queue.extend((job_id, user_id) for _, job_id, user_id in sorted(pending) if job_id not in known)
+            self._condition.notify_all()
+
+    # Look for jobs abandoned by other processes once per lease period
+    def _watch(self):
+        while True:
+            check_at = time.monotonic() + self.lease_seconds
+            with self._condition:
+                while not self._closed and time.monotonic() < check_at:
+                    self._condition.wait(check_at - time.monotonic())
+                if self._closed:
+                    return
+            try:
+                self._recover(time.time() - self.lease_seconds)
+            except Exception:
+                self.app.logger.exception('Checking for abandoned import jobs failed')
+
+    def spool_path(self, job_id):
+        return os.path.join(self.spool_dir, f'{job_id}.csv')
+
+    # Record a job for a file already saved with save(spool_path) and queue it
+    def submit(self, conn, user_id, filename, save):
+        job_id = uuid.uuid4().hex
+        path = self.spool_path(job_id)
+        save(path)
+        try:
+            conn.execute('INSERT INTO import_jobs (id, user_id, filename, spool_path, status, bytes_total, created_at) '
+                         "VALUES (?, ?, ?, ?, 'queued', ?, ?)",
+                         (job_id, user_id, filename, path, os.path.getsize(path), time.time()))
+            conn.commit()
+        except Exception:
+            self._remove_spool(path)
+            raise
+        with self._condition:
+            self._queue.append((job_id, user_id))
+            self._condition.notify()
+        return job_id
+
+    # Cancel a job. A queued job is cancelled at once; a running one stops
+    # before committing its next chunk and keeps the chunks already imported.
+    # Returns the job's status afterwards, or None when it does not exist.
+    def cancel(self, conn, user_id, job_id):
+        row = conn.execute('SELECT status, spool_path FROM import_jobs WHERE id = ? AND user_id = ?',
+                           (job_id, user_id)).fetchone()
+        if row is None:
+            return None
+        status, path = row
+        if status in FINISHED:
+            return status
+
+        cursor = conn.execute("UPDATE import_jobs SET status = 'cancelled', finished_at = ? "
+                              "WHERE id = ? AND status = 'queued'", (time.time(), job_id))
+        if cursor.rowcount:
+            conn.commit()
+            with self._condition:
+                self._queue = [item for item in self._queue if item[0] != job_id]
+            self._remove_spool(path)
+            return 'cancelled'
+
+        conn.execute('UPDATE import_jobs SET cancel_requested = 1 WHERE id = ?', (job_id,))
+        conn.commit()
+        return 'cancelling'
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+    def _next(self):
+        with self._condition:
+            while not self._closed:
+                for position, (job_id, user_id) in enumerate(self._queue):
+                    if user_id not in self._running_users:
+                        del self._queue[position]
+                        self._running_users.add(user_id)
+                        self._running_jobs.add(job_id)
+                        return job_id, user_id
+                self._condition.wait()
+            return None
+
+    def _run(self):
+        while True:
+            item = self._next()
+            if item is None:
+                return
+            job_id, user_id = item
+            try:
+                with self.app.app_context():
+                    db.bind_user(user_id)
+                    self._process(db.get_db(), job_id)
+            except Exception:
+                self.app.logger.exception('Import job %s failed', job_id)
+            finally:
+                with self._condition:
+                    self._running_users.discard(user_id)
+                    self._running_jobs.discard(job_id)
+                    self._condition.notify_all()
+
+    def _process(self, conn, job_id):
+        # A user has at most one job running across all processes. The check
+        # and the claim are one statement, so two processes cannot both pass.
+        now = time.time()
+        cursor = conn.execute('''
+            UPDATE import_jobs SET status = 'running', owner = ?, lease_until = ?
+            WHERE id = ? AND status = 'queued' AND NOT EXISTS (
+                SELECT 1 FROM import_jobs AS other
+                WHERE other.user_id = import_jobs.user_id AND other.status = 'running'
+                    AND other.lease_until > ?
+            )
+        ''', (self.owner, now + self.lease_seconds, job_id, now))
+        conn.commit()
+        if not cursor.rowcount:
+            # Cancelled or claimed elsewhere since it was queued, or the user
+            # has a job running in another process. A job left queued is
+            # picked up again by the next _recover.
+            return
+
+        (user_id, path, resume_line, imported, skipped, failed, errors, run_seconds,
+         created_at) = conn.execute('SELECT user_id, spool_path, resume_line, rows_imported, rows_skipped, '
+                                    'rows_failed, errors, run_seconds, created_at FROM import_jobs WHERE id = ?',
+                                    (job_id,)).fetchone()
+        result = importer.ImportResult(imported, failed, json.loads(errors), skipped)
+        started = time.monotonic()
+
+        # Also renews the lease, in the chunk's transaction
+        def save_progress(cursor, progress, line_num):
+            cursor.execute('UPDATE import_jobs SET rows_imported = ?, rows_skipped = ?, rows_failed = ?, '
+                           'errors = ?, resume_line = ?, bytes_read = ?, run_seconds = ?, lease_until = ? '
+                           'WHERE id = ? AND owner = ? AND cancel_requested = 0',
+                           (progress.imported, progress.skipped, progress.failed, json.dumps(progress.errors),
+                            line_num, stream.tell(), run_seconds + time.monotonic() - started,
+                            time.time() + self.lease_seconds, job_id, self.owner))
+            if not cursor.rowcount:
+                owner = cursor.execute('SELECT owner FROM import_jobs WHERE id = ?', (job_id,)).fetchone()[0]
+                raise JobCancelled() if owner == self.owner else LeaseLost()
+
+        status, error = 'completed', None
+        try:
+            with open(path, 'rb') as stream:
+                importer.import_csv(conn, user_id, stream, parse_row=self.parse_row,
+                                    classify=lambda descriptions: self.classify(user_id, descriptions),
+                                    result=result, start_line=resume_line, on_chunk=save_progress,
+                                    # The upload's day, also when resumed after midnight
+                                    default_date=datetime.date.fromtimestamp(created_at).isoformat())
+            if result.processed == 0:  # Need at least header + 1 data row
+                status, error = 'failed', 'CSV file must contain at least a header and one data row'
+        except JobCancelled:
+            status = 'cancelled'
+        except LeaseLost:
+            # The new owner finishes the job and removes the file
+            self.app.logger.warning('Import job %s was taken over by another process', job_id)
+            return
+        except UnicodeDecodeError:
+            status, error = 'failed', 'Invalid file encoding. Please use UTF-8 encoding'
+        except Exception as e:
+            status, error = 'failed', f'Error processing file: {str(e)}'
+
+        if status == 'cancelled':
+            # Counts stay at the last committed chunk
+            cursor = conn.execute("UPDATE import_jobs SET status = 'cancelled', finished_at = ? "
+                                  'WHERE id = ? AND owner = ?', (time.time(), job_id, self.owner))
+        else:
+            cursor = conn.execute('UPDATE import_jobs SET status = ?, error = ?, rows_imported = ?, '
+                                  'rows_skipped = ?, rows_failed = ?, errors = ?, bytes_read = bytes_total, '
+                                  'run_seconds = ?, finished_at = ? WHERE id = ? AND owner = ?',
+                                  (status, error, result.imported, result.skipped, result.failed,
+                                   json.dumps(result.errors), run_seconds + time.monotonic() - started,
+                                   time.time(), job_id, self.owner))
+        conn.commit()
+        if cursor.rowcount:
+            self._remove_spool(path)
+
+    def _remove_spool(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+# The job's state as returned by GET /upload/<job_id>, or None when the user
+# has no such job
+def job_status(conn, user_id, job_id):
+    row = conn.execute('SELECT filename, status, cancel_requested, bytes_total, bytes_read, rows_imported, '
+                       'rows_skipped, rows_failed, errors, error, run_seconds, created_at, finished_at '
+                       'FROM import_jobs WHERE id = ? AND user_id = ?', (job_id, user_id)).fetchone()
+    if row is None:
+        return None
+    (filename, status, cancel_requested, bytes_total, bytes_read, imported, skipped, failed, errors, error,
+     run_seconds, created_at, finished_at) = row
+    processed = imported + skipped + failed
+    if status == 'running' and cancel_requested:
+        status = 'cancelling'
+    errors = json.loads(errors)
+    return {
+        'job_id': job_id,
+        'filename': filename,
+        'status': status,
+        'imported': imported,
+        'skipped': skipped,
+        'failed': failed,
+        'processed': processed,
+        'rows_per_second': round(processed / run_seconds, 1) if run_seconds else None,
+        'progress': round(bytes_read / bytes_total, 4) if bytes_total else 1.0,
+        'errors': errors,
+        'errors_truncated': failed > len(errors),
+        'error': error,
+        'created_at': created_at,
+        'finished_at': finished_at,
+    }
+
+
+def init_app(app, parse_row, classify):
+    app.config.setdefault('IMPORT_SPOOL_DIR', DEFAULT_SPOOL_DIR)
+    app.config.setdefault('IMPORT_WORKERS', DEFAULT_WORKERS)
+    app.config.setdefault('IMPORT_LEASE_SECONDS', DEFAULT_LEASE_SECONDS)
+    app.extensions['import_jobs'] = ImportJobs(app, parse_row, classify)
+
+
+# The app's job runner, started on first use
+def get_jobs(app=None):
+    app = app or current_app
+    import_jobs = app.extensions['import_jobs']
+    import_jobs.start()
+    return import_jobs
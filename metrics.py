@@ -0,0 +1,310 @@
+import bisect
+import contextvars
+import functools
+import os
+import re
+import sqlite3
+import threading
+import time
+
+from flask import current_app, g, request
+
+# In-process metrics in the Prometheus text format, served by /metrics.
+#
+# Request hooks record latency, status and response size per route. SQL
+# statements are timed through TimedConnection/TimedCursor, which db.connect
+# uses for every connection, and labelled by query name. Hot functions are
+# wrapped with @timed. With FINANCE_SLOW_REQUEST_MS set, requests slower than
+# that are logged with the time spent in each query.
+
+SLOW_REQUEST_MS = float(os.environ.get('FINANCE_SLOW_REQUEST_MS', '0'))
+
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (128, 1024, 8192, 65536, 524288, 4194304, 33554432)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    pairs = ','.join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+    return '{' + pairs + '}'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Counter:
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, label_values=(), amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        lines.extend(f'{self.name}{_format_labels(self.labels, label_values)} {value}'
+                     for label_values, value in values)
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = buckets
+        # label values -> [per-bucket counts (last one is +Inf), sum]
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, label_values, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def render(self):
+        with self._lock:
+            series = sorted((label_values, list(counts), total)
+                            for label_values, (counts, total) in self._series.items())
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        for label_values, counts, total in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                labels = _format_labels(self.labels + ('le',), label_values + (bound,))
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = _format_labels(self.labels, label_values)
+            lines.append(f'{self.name}_sum{labels} {total}')
+            lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        # Callables returning (name, help, value) gauges, read at scrape time
+        self._collectors = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector):
+        self._collectors.append(collector)
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for collector in self._collectors:
+            for name, documentation, value in collector():
+                lines.extend((f'# HELP {name} {documentation}', f'# TYPE {name} gauge', f'{name} {value}'))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+REQUEST_SECONDS = REGISTRY.register(Histogram(
+    'finance_request_duration_seconds', 'Request latency by route', ('method', 'route')))
+REQUESTS = REGISTRY.register(Counter(
+    'finance_requests_total', 'Responses by route and status', ('method', 'route', 'status')))
+RESPONSE_BYTES = REGISTRY.register(Histogram(
+    'finance_response_size_bytes', 'Response body size by route (streamed responses are not counted)',
+    ('method', 'route'), SIZE_BUCKETS))
+REQUEST_EXCEPTIONS = REGISTRY.register(Counter(
+    'finance_request_exceptions_total', 'Unhandled exceptions by route and type', ('route', 'exception')))
+SQL_SECONDS = REGISTRY.register(Histogram(
+    'finance_sql_statement_duration_seconds', 'Time to execute a statement, up to its first row', ('query',)))
+SQL_FETCH_SECONDS = REGISTRY.register(Counter(
+    'finance_sql_fetch_seconds_total', 'Time spent fetching result rows', ('query',)))
+OPERATION_SECONDS = REGISTRY.register(Histogram(
+    'finance_operation_duration_seconds', 'Latency of instrumented hot-path functions', ('operation',)))
+
+
+# Time every call of the decorated function as `operation`
+def timed(operation):
+    label_values = (operation,)
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                OPERATION_SECONDS.observe(label_values, time.perf_counter() - started)
+        return wrapper
+    return decorator
+
+
+# SQL statements are labelled by name when registered with name_query, and
+# otherwise by verb and table ("select transactions"), so labels stay few.
+_query_labels = {}
+_query_prefixes = []
+MAX_QUERY_LABELS = 1024
+
+_VERB = re.compile(r'\s*(\w+)')
+_TABLE = re.compile(r'\b(?:FROM|INTO|UPDATE|TABLE|INDEX|TRIGGER|ON)\s+(?:IF\s+NOT\s+EXISTS\s+)?(\w+)',
+                    re.IGNORECASE)
+
+
+# A template with a {filters} placeholder names every statement made from it
+def name_query(sql, name):
+    if '{filters}' in sql:
+        _query_prefixes.append((sql.split('{filters}', 1)[0], (name,)))
+    else:
+        _query_labels[sql] = (name,)
+
+
+def query_label(sql):
+    label = _query_labels.get(sql)
+    if label is None:
+        label = next((name for prefix, name in _query_prefixes if sql.startswith(prefix)), None)
+        if label is None:
+            verb = _VERB.match(sql)
+            table = _TABLE.search(sql)
+            label = (' '.join(part for part in (verb and verb.group(1).lower(), table and table.group(1)) if part)
+                     or 'other',)
+        if len(_query_labels) < MAX_QUERY_LABELS:
+            _query_labels[sql] = label
+    return label
+
+
+# (label, seconds, executed) for every statement executed or fetched from in
+# the current request, when the slow request log is on
+_trace = contextvars.ContextVar('finance_sql_trace', default=None)
+
+
+def _record(label, elapsed, histogram):
+    trace = _trace.get()
+    if trace is not None:
+        trace.append((label[0], elapsed, histogram))
+    if histogram:
+        SQL_SECONDS.observe(label, elapsed)
+    else:
+        SQL_FETCH_SECONDS.inc(label, elapsed)
+
+
+class TimedCursor(sqlite3.Cursor):
+    _label = ('other',)
+
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self._label = query_label(sql)
+            _record(self._label, time.perf_counter() - started, True)
+
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self._label = query_label(sql)
+            _record(self._label, time.perf_counter() - started, True)
+
+    def fetchone(self):
+        started = time.perf_counter()
+        try:
+            return super().fetchone()
+        finally:
+            _record(self._label, time.perf_counter() - started, False)
+
+    def fetchmany(self, size=None):
+        started = time.perf_counter()
+        try:
+            return super().fetchmany(self.arraysize if size is None else size)
+        finally:
+            _record(self._label, time.perf_counter() - started, False)
+
+    def fetchall(self):
+        started = time.perf_counter()
+        try:
+            return super().fetchall()
+        finally:
+            _record(self._label, time.perf_counter() - started, False)
+
+
+class TimedConnection(sqlite3.Connection):
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+def _route():
+    return request.url_rule.rule if request.url_rule is not None else 'unmatched'
+
+
+def _before_request():
+    g.metrics_started = time.perf_counter()
+    if SLOW_REQUEST_MS > 0:
+        g.metrics_trace = _trace.set([])
+
+
+def _after_request(response):
+    label_values = (request.method, _route())
+    REQUESTS.inc(label_values + (str(response.status_code),))
+    if response.content_length is not None:
+        RESPONSE_BYTES.observe(label_values, response.content_length)
+    return response
+
+
+def _teardown_request(exception=None):
+    started = g.pop('metrics_started', None)
+    if started is None:
+        return
+    elapsed = time.perf_counter() - started
+    route = _route()
+    REQUEST_SECONDS.observe((request.method, route), elapsed)
+    if exception is not None:
+        REQUEST_EXCEPTIONS.inc((route, type(exception).__name__))
+
+    token = g.pop('metrics_trace', None)
+    if token is None:
+        return
+    trace = _trace.get()
+    _trace.reset(token)
+    if elapsed * 1000 >= SLOW_REQUEST_MS:
+        log_slow_request(route, elapsed, trace)
+
+
+def log_slow_request(route, elapsed, trace):
+    totals = {}
+    for label, seconds, executed in trace:
+        count, total = totals.get(label, (0, 0.0))
+        totals[label] = (count + executed, total + seconds)
+    breakdown = ', '.join(f'{label} x{count} {total * 1000:.1f}ms'
+                          for label, (count, total) in sorted(totals.items(), key=lambda item: -item[1][1]))
+    sql_ms = sum(total for _, total in totals.values()) * 1000
+    current_app.logger.warning('Slow request %s %s took %.1fms (%.1fms in SQL): %s',
+                               request.method, route, elapsed * 1000, sql_ms, breakdown or 'no queries')
+
+
+def init_app(app):
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.teardown_request(_teardown_request)
+
+
+def render():
+    return REGISTRY.render()
@@ -0,0 +1,344 @@
+import datetime
+import re
+
+import fingerprints
+
+# Dates in the canonical YYYY-MM-DD form
+PADDED_DATE_GLOB = '[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]'
+
+
+# Migration step: rewrite dates stored without zero padding, e.g. 2026-9-5,
+# as YYYY-MM-DD. Dates that do not parse at all are left alone. Returns
+# (id, user_id) for every row changed.
+def normalize_dates(cursor):
+    rows = cursor.execute('SELECT id, user_id, date FROM transactions WHERE date NOT GLOB ? '
+                          'ORDER BY user_id, id', (PADDED_DATE_GLOB,)).fetchall()
+    changed = []
+    for transaction_id, user_id, date in rows:
+        try:
+            padded = datetime.datetime.strptime(date.strip(), '%Y-%m-%d').strftime('%Y-%m-%d')
+        except ValueError:
+            continue
+        changed.append((transaction_id, user_id, padded))
+    cursor.executemany('UPDATE transactions SET date = ? WHERE id = ?',
+                       [(padded, transaction_id) for transaction_id, _, padded in changed])
+    return [(transaction_id, user_id) for transaction_id, user_id, _ in changed]
+
+
+# Migration step: normalize_dates on a database that already has rollups,
+# fingerprints and data versions. Rollups of the affected users are
+# recomputed, changed rows are fingerprinted with their new date (unless
+# the user already has that fingerprint) and cached responses are dropped.
+def repair_dates(cursor):
+    changed = normalize_dates(cursor)
+    users = sorted({user_id for _, user_id in changed})
+    for user_id in users:
+        cursor.execute('DELETE FROM monthly_rollups WHERE user_id = ?', (user_id,))
+        cursor.execute('''
+            INSERT INTO monthly_rollups (user_id, month, type, category, total, count)
+            SELECT user_id, month_key, type, COALESCE(category, 'other'), SUM(amount), COUNT(*)
+            FROM transactions WHERE user_id = ?
+            GROUP BY user_id, month_key, type, COALESCE(category, 'other')
+        ''', (user_id,))
+        cursor.execute('UPDATE data_versions SET version = version + 1 WHERE user_id = ?', (user_id,))
+
+    counters = {}
+    for transaction_id, user_id in changed:
+        row = cursor.execute('SELECT date, amount, type, description FROM transactions '
+                             'WHERE id = ? AND fingerprint IS NOT NULL', (transaction_id,)).fetchone()
+        if row is None:
+            continue
+        counter = counters.setdefault(user_id, fingerprints.FingerprintCounter(user_id))
+        fingerprint = counter.next(*row)
+        if not fingerprints.existing(cursor, user_id, [fingerprint]):
+            cursor.execute('UPDATE transactions SET fingerprint = ? WHERE id = ?', (fingerprint, transaction_id))
+
+
+
+# Schema migrations, applied in order by migrate(). Each entry is
+# (version, description, steps) where a step is either an SQL string or a
+# callable taking the cursor. Applied versions are recorded in
+# schema_migrations so existing finance.db files are upgraded in place.
+MIGRATIONS = [
+    (1, 'Base schema', [
+        '''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE NOT NULL,
+            password TEXT NOT NULL,
+            email TEXT UNIQUE NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS transactions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            description TEXT NOT NULL,
+            amount REAL NOT NULL,
+            type TEXT NOT NULL,
+            category TEXT,
+            date TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+        ''',
+        # Categories table for ML training
+        '''
+        CREATE TABLE IF NOT EXISTS categories (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            description TEXT NOT NULL,
+            category TEXT NOT NULL,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+        ''',
+    ]),
+    (2, 'Per-user date indexes for transaction listing and analytics', [
+        '''
+        CREATE INDEX IF NOT EXISTS idx_transactions_user_date
+        ON transactions (user_id, date)
+        ''',
+        '''
+        CREATE INDEX IF NOT EXISTS idx_transactions_user_type_date
+        ON transactions (user_id, type, date, category, amount)
+        ''',
+    ]),
+    # Integer YYYYMM key derived from date, so a month filter is an equality
+    # lookup on the index instead of a LIKE over every row of the user. The
+    # key needs zero-padded dates, which older versions did not enforce.
+    (3, 'Month key column for monthly analytics', [
+        normalize_dates,
+        '''
+        ALTER TABLE transactions ADD COLUMN month_key INTEGER
+        GENERATED ALWAYS AS (CAST(substr(date, 1, 4) || substr(date, 6, 2) AS INTEGER)) VIRTUAL
+        ''',
+        '''
+        CREATE INDEX IF NOT EXISTS idx_transactions_user_month
+        ON transactions (user_id, month_key, type, category, amount)
+        ''',
+    ]),
+    (4, 'Per-user index on category corrections', [
+        '''
+        CREATE INDEX IF NOT EXISTS idx_categories_user
+        ON categories (user_id)
+        ''',
+    ]),
+    # Monthly totals per user, type and category, maintained by the write
+    # paths so /analytics does not aggregate raw transactions
+    (5, 'Monthly rollup table', [
+        '''
+        CREATE TABLE IF NOT EXISTS monthly_rollups (
+            user_id INTEGER NOT NULL,
+            month INTEGER NOT NULL,
+            type TEXT NOT NULL,
+            category TEXT NOT NULL,
+            total REAL NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (user_id, month, type, category)
+        ) WITHOUT ROWID
+        ''',
+        '''
+        INSERT INTO monthly_rollups (user_id, month, type, category, total, count)
+        SELECT user_id, month_key, type, COALESCE(category, 'other'), SUM(amount), COUNT(*)
+        FROM transactions
+        GROUP BY user_id, month_key, type, COALESCE(category, 'other')
+        ''',
+    ]),
+    # Bumped by every write to a user's transactions; part of response cache keys
+    (6, 'Per-user data version', [
+        'ALTER TABLE users ADD COLUMN data_version INTEGER NOT NULL DEFAULT 0',
+    ]),
+    # Full-text index over descriptions. The owner is indexed as a "u<id>"
+    # token so searches are scoped to one user inside FTS5 itself, and only
+    # descriptions are ranked. External content: the text lives in
+    # transactions and triggers keep the index in step with it.
+    (7, 'Full-text search over descriptions', [
+        '''
+        ALTER TABLE transactions ADD COLUMN search_owner TEXT
+        GENERATED ALWAYS AS ('u' || user_id) VIRTUAL
+        ''',
+        '''
+        CREATE VIRTUAL TABLE IF NOT EXISTS transactions_fts USING fts5 (
+            description, search_owner,
+            content = 'transactions', content_rowid = 'id',
+            tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3'
+        )
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS transactions_fts_insert AFTER INSERT ON transactions BEGIN
+            INSERT INTO transactions_fts (rowid, description, search_owner)
+            VALUES (new.id, new.description, new.search_owner);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS transactions_fts_delete AFTER DELETE ON transactions BEGIN
+            INSERT INTO transactions_fts (transactions_fts, rowid, description, search_owner)
+            VALUES ('delete', old.id, old.description, old.search_owner);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS transactions_fts_update AFTER UPDATE OF description, user_id ON transactions BEGIN
+            INSERT INTO transactions_fts (transactions_fts, rowid, description, search_owner)
+            VALUES ('delete', old.id, old.description, old.search_owner);
+            INSERT INTO transactions_fts (rowid, description, search_owner)
+            VALUES (new.id, new.description, new.search_owner);
+        END
+        ''',
+        "INSERT INTO transactions_fts (transactions_fts, rank) VALUES ('rank', 'bm25(1.0, 0.0)')",
+        "INSERT INTO transactions_fts (transactions_fts) VALUES ('rebuild')",
+    ]),
+    # Background CSV imports. Progress is saved in the same transaction as
+    # each chunk of rows, so an interrupted job resumes after resume_line.
+    (8, 'Import jobs', [
+        '''
+        CREATE TABLE IF NOT EXISTS import_jobs (
+            id TEXT PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            filename TEXT NOT NULL,
+            spool_path TEXT NOT NULL,
+            status TEXT NOT NULL,
+            cancel_requested INTEGER NOT NULL DEFAULT 0,
+            bytes_total INTEGER NOT NULL,
+            bytes_read INTEGER NOT NULL DEFAULT 0,
+            resume_line INTEGER NOT NULL DEFAULT 0,
+            rows_imported INTEGER NOT NULL DEFAULT 0,
+            rows_failed INTEGER NOT NULL DEFAULT 0,
+            errors TEXT NOT NULL DEFAULT '[]',
+            error TEXT,
+            run_seconds REAL NOT NULL DEFAULT 0,
+            created_at REAL NOT NULL,
+            finished_at REAL,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+        ''',
+        '''
+        CREATE INDEX IF NOT EXISTS idx_import_jobs_status
+        ON import_jobs (status, created_at)
+        ''',
+    ]),
+    # Statement line fingerprints, so re-importing a file skips the rows it
+    # already added (see fingerprints.py). Existing rows are backfilled.
+    (9, 'Transaction fingerprints for idempotent imports', [
+        'ALTER TABLE transactions ADD COLUMN fingerprint INTEGER',
+        fingerprints.backfill,
+        '''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_transactions_user_fingerprint
+        ON transactions (user_id, fingerprint) WHERE fingerprint IS NOT NULL
+        ''',
+        'ALTER TABLE import_jobs ADD COLUMN rows_skipped INTEGER NOT NULL DEFAULT 0',
+    ]),
+    # Sharded storage (see db.py and shards.py). Data versions move out of
+    # users so they live in the same database as the data they version;
+    # moved_to fences a user whose data has been moved to another shard.
+    # user_shards is only used in the main database.
+    (10, 'Per-database data versions and shard placement', [
+        '''
+        CREATE TABLE IF NOT EXISTS data_versions (
+            user_id INTEGER PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0,
+            moved_to TEXT
+        )
+        ''',
+        'INSERT INTO data_versions (user_id, version) SELECT id, data_version FROM users',
+        'ALTER TABLE users DROP COLUMN data_version',
+        '''
+        CREATE TABLE IF NOT EXISTS user_shards (
+            user_id INTEGER PRIMARY KEY,
+            shard TEXT NOT NULL
+        )
+        ''',
+    ]),
+    # Token revocation that survives restarts and is shared by every process
+    # (see auth.py). Only used in the main database.
+    (11, 'Stored token revocations', [
+        'ALTER TABLE users ADD COLUMN token_generation INTEGER NOT NULL DEFAULT 0',
+        '''
+        CREATE TABLE IF NOT EXISTS revoked_tokens (
+            digest BLOB PRIMARY KEY,
+            expires_at REAL NOT NULL
+        ) WITHOUT ROWID
+        ''',
+        '''
+        CREATE INDEX IF NOT EXISTS idx_revoked_tokens_expires
+        ON revoked_tokens (expires_at)
+        ''',
+    ]),
+    # Import job claims with an owner and lease, so a process only takes
+    # over running jobs whose owner stopped renewing them (see jobs.py)
+    (12, 'Import job leases', [
+        'ALTER TABLE import_jobs ADD COLUMN owner TEXT',
+        'ALTER TABLE import_jobs ADD COLUMN lease_until REAL',
+    ]),
+    # Databases that were past version 3 before it normalized dates: fix the
+    # dates and everything derived from them
+    (13, 'Zero-padded transaction dates', [
+        repair_dates,
+    ]),
+]
+
+
+def month_key(date_str):
+    return int(date_str[:4] + date_str[5:7])
+
+
+def current_version(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            description TEXT NOT NULL,
+            applied_at TIMESTAMP NOT NULL
+        )
+    ''')
+    row = conn.execute('SELECT MAX(version) FROM schema_migrations').fetchone()
+    return row[0] or 0
+
+
+# Apply every pending migration up to `until` (default: all), each in its
+# own transaction
+def migrate(conn, until=None):
+    applied = []
+    version = current_version(conn)
+
+    for target, description, steps in MIGRATIONS:
+        if target <= version:
+            continue
+        if until is not None and target > until:
+            break
+
+        cursor = conn.cursor()
+        try:
+            cursor.execute('BEGIN')
+            for step in steps:
+                if callable(step):
+                    step(cursor)
+                else:
+                    cursor.execute(step)
+            cursor.execute('INSERT INTO schema_migrations (version, description, applied_at) VALUES (?, ?, ?)',
+                           (target, description, datetime.datetime.utcnow().isoformat()))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+        applied.append(target)
+
+    return applied
+
+
+# FTS5 reports a MATCH lookup as a virtual table "scan" with an M index flag,
+# and a json_each scan walks the JSON list passed in as a parameter
+FTS_MATCH_PLAN = re.compile(r'^SCAN \w+ VIRTUAL TABLE INDEX \d+:M')
+JSON_EACH_PLAN = re.compile(r'^SCAN json_each VIRTUAL TABLE')
+
+
+# Run EXPLAIN QUERY PLAN over (name, sql, params) entries and return the plan
+# lines that read a whole table or index instead of searching it
+def find_full_scans(conn, queries):
+    scans = []
+    for name, sql, params in queries:
+        for row in conn.execute('EXPLAIN QUERY PLAN ' + sql, params):
+            detail = row[3]
+            if detail.startswith('SCAN ') and not FTS_MATCH_PLAN.match(detail) and not JSON_EACH_PLAN.match(detail):
+                scans.append((name, detail))
+    return scans
@@ -0,0 +1,83 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from werkzeug.security import DEFAULT_PBKDF2_ITERATIONS, generate_password_hash, check_password_hash
+
+import metrics
+
+# Password hashing settings. PBKDF2 is deliberately slow, so it runs in a
+# small process pool instead of on request threads, with a cap on how many
+# hashes may be queued or running at once. When the cap is reached callers
+# get HashingBusy immediately rather than waiting behind a login storm.
+# Setting FINANCE_HASH_WORKERS=0 hashes inline on the calling thread.
+HASH_ITERATIONS = int(os.environ.get('FINANCE_PASSWORD_ITERATIONS', '0')) or None
+HASH_WORKERS = int(os.environ.get('FINANCE_HASH_WORKERS', str(max(1, (os.cpu_count() or 2) // 2))))
+HASH_MAX_PENDING = int(os.environ.get('FINANCE_HASH_MAX_PENDING', str(max(1, HASH_WORKERS) * 4)))
+HASH_TIMEOUT = float(os.environ.get('FINANCE_HASH_TIMEOUT', '10'))
+
+
+class HashingBusy(Exception):
+    pass
+
+
+def hash_method():
+    return f'pbkdf2:sha256:{HASH_ITERATIONS or DEFAULT_PBKDF2_ITERATIONS}'
+
+
+_pool = None
+_pool_lock = threading.Lock()
+_pending = threading.BoundedSemaphore(HASH_MAX_PENDING)
+
+
+def _get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                # spawn rather than fork: forking a threaded web server can
+                # copy locks held by other threads into the workers
+                _pool = ProcessPoolExecutor(max_workers=HASH_WORKERS,
+                                            mp_context=multiprocessing.get_context('spawn'))
+    return _pool
+
+
+def _run(func, *args):
+    if HASH_WORKERS <= 0:
+        return func(*args)
+
+    if not _pending.acquire(blocking=False):
+        raise HashingBusy('Too many password operations in progress')
+    try:
+        future = _get_pool().submit(func, *args)
+    except Exception:
+        _pending.release()
+        raise
+    future.add_done_callback(lambda _: _pending.release())
+    return future.result(timeout=HASH_TIMEOUT)
+
+
+@metrics.timed('hash_password')
+def hash_password(password):
+    return _run(generate_password_hash, password, hash_method())
+
+
+@metrics.timed('verify_password')
+def verify_password(password, hashed_password):
+    return _run(check_password_hash, hashed_password, password)
+
+
+# True when a stored hash was made with different parameters than the
+# current configuration and should be replaced after a successful login
+def needs_rehash(hashed_password):
+    # Hashes are stored as "<method>$<salt>$<hash>"
+    return hashed_password.split('$', 1)[0] != hash_method()
+
+
+def shutdown():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=True)
+            _pool = None
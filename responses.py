@@ -0,0 +1,111 @@
+import os
+import zlib
+
+from flask import request
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# JSON encoding and compression of response bodies.
+#
+# With orjson installed, jsonify() encodes with it instead of the json
+# module, which is several times faster for the long lists the listing
+# endpoints return. Keys keep their insertion order rather than being
+# sorted. Bodies of at least FINANCE_COMPRESS_MIN_BYTES are compressed with
+# brotli (when installed) or gzip, whichever the client accepts and prefers;
+# smaller ones cost more to compress than the bytes saved. Streamed
+# responses, such as exports, are left alone.
+
+COMPRESS_MIN_BYTES = int(os.environ.get('FINANCE_COMPRESS_MIN_BYTES', '1024'))
+
+# Fast settings: most of the size reduction for a fraction of the CPU time
+GZIP_LEVEL = 5
+BROTLI_QUALITY = 4
+
+COMPRESSIBLE_TYPES = {
+    'application/json',
+    'application/javascript',
+    'text/css',
+    'text/csv',
+    'text/html',
+    'text/javascript',
+    'text/plain',
+}
+
+if orjson is not None:
+    # NumPy scalars are encoded like the floats and ints the json module
+    # accepts them as. Dates are left to Flask's default, which formats them
+    # as HTTP dates.
+    ORJSON_OPTIONS = (orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+                      | orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS)
+
+
+class JSONProvider(DefaultJSONProvider):
+    def dumps(self, obj, **kwargs):
+        if orjson is None or kwargs:
+            return super().dumps(obj, **kwargs)
+        return orjson.dumps(obj, default=self.default, option=ORJSON_OPTIONS).decode()
+
+    def response(self, *args, **kwargs):
+        if orjson is None:
+            return super().response(*args, **kwargs)
+        obj = self._prepare_response_obj(args, kwargs)
+        body = orjson.dumps(obj, default=self.default, option=ORJSON_OPTIONS)
+        return self._app.response_class(body, mimetype=self.mimetype)
+
+
+# The encoding to send, or None when the client accepts neither
+def choose_encoding(accept_encodings):
+    gzip_quality = accept_encodings.quality('gzip')
+    if brotli is not None:
+        brotli_quality = accept_encodings.quality('br')
+        if brotli_quality and brotli_quality >= gzip_quality:
+            return 'br'
+    return 'gzip' if gzip_quality else None
+
+
+# Whether a body is worth compressing
+def compressible(mimetype, length):
+    return mimetype in COMPRESSIBLE_TYPES and length is not None and length >= COMPRESS_MIN_BYTES
+
+
+def compress(body, encoding):
+    if encoding == 'br':
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+    return compressor.compress(body) + compressor.flush()
+
+
+def compress_response(response):
+    # Cached responses arrive already encoded (see cache.build_response)
+    if (response.status_code != 200 or response.direct_passthrough or response.is_streamed
+            or 'Content-Encoding' in response.headers):
+        return response
+    if not compressible(response.mimetype, response.content_length):
+        return response
+
+    response.vary.add('Accept-Encoding')
+    encoding = choose_encoding(request.accept_encodings)
+    if encoding is None:
+        return response
+    response.set_data(compress(response.get_data(), encoding))
+    response.headers['Content-Encoding'] = encoding
+    # The same content in another encoding: clients revalidating with the
+    # weak tag still get 304s
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+
+def init_app(app):
+    app.json = JSONProvider(app)
+    app.after_request(compress_response)
@@ -0,0 +1,108 @@
+from migrations import month_key
+
+# Per-user monthly totals by type and category. The rows are maintained by
+# every write path in the same transaction as the change to transactions,
+# so /analytics reads a handful of rollup rows instead of aggregating the
+# user's whole history.
+
+UPSERT_ROLLUP_SQL = '''
+    INSERT INTO monthly_rollups (user_id, month, type, category, total, count)
+    VALUES (?, ?, ?, ?, ?, ?)
+    ON CONFLICT (user_id, month, type, category) DO UPDATE SET
+        total = total + excluded.total,
+        count = count + excluded.count
+'''
+
+DELETE_EMPTY_ROLLUPS_SQL = '''
+    DELETE FROM monthly_rollups
+    WHERE user_id = ? AND month = ? AND type = ? AND category = ? AND count <= 0
+'''
+
+# Aggregate of raw transactions in the same shape as monthly_rollups
+RAW_TOTALS_SQL = '''
+    SELECT user_id, month_key, type, COALESCE(category, 'other'), SUM(amount), COUNT(*)
+    FROM transactions {where}
+    GROUP BY user_id, month_key, type, COALESCE(category, 'other')
+'''
+
+# Tolerance for floating point differences when comparing totals
+TOTAL_TOLERANCE = 0.005
+
+
+def _deltas(rows, sign):
+    deltas = {}
+    for amount, type_transaction, category, date in rows:
+        key = (month_key(date), type_transaction, category or 'other')
+        total, count = deltas.get(key, (0.0, 0))
+        deltas[key] = (total + sign * amount, count + sign)
+    return deltas
+
+
+def _apply(cursor, user_id, deltas):
+    cursor.executemany(UPSERT_ROLLUP_SQL, [
+        (user_id, month, type_transaction, category, total, count)
+        for (month, type_transaction, category), (total, count) in deltas.items()
+    ])
+    removed = [(user_id,) + key for key, (_, count) in deltas.items() if count < 0]
+    if removed:
+        cursor.executemany(DELETE_EMPTY_ROLLUPS_SQL, removed)
+
+
+# rows are (amount, type, category, date) tuples. Neither function commits;
+# callers run them inside the transaction that changes the raw rows.
+def add_transactions(cursor, user_id, rows):
+    _apply(cursor, user_id, _deltas(rows, 1))
+
+
+def remove_transactions(cursor, user_id, rows):
+    _apply(cursor, user_id, _deltas(rows, -1))
+
+
+def rebuild(conn, user_id=None):
+    cursor = conn.cursor()
+    try:
+        cursor.execute('BEGIN IMMEDIATE')
+        if user_id is None:
+            cursor.execute('DELETE FROM monthly_rollups')
+            cursor.execute('INSERT INTO monthly_rollups (user_id, month, type, category, total, count) '
+                           + RAW_TOTALS_SQL.format(where=''))
+        else:
+            cursor.execute('DELETE FROM monthly_rollups WHERE user_id = ?', (user_id,))
+            cursor.execute('INSERT INTO monthly_rollups (user_id, month, type, category, total, count) '
+                           + RAW_TOTALS_SQL.format(where='WHERE user_id = ?'), (user_id,))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+
+# Compare rollups with totals recomputed from raw rows. Returns one entry per
+# (user, month, type, category) that differs, with (total, count) as stored
+# and as expected; missing rows show up as None.
+def verify(conn, user_id=None):
+    where, params = ('', ()) if user_id is None else ('WHERE user_id = ?', (user_id,))
+
+    expected = {}
+    for row in conn.execute(RAW_TOTALS_SQL.format(where=where), params):
+        expected[row[:4]] = (row[4], row[5])
+
+    actual = {}
+    for row in conn.execute('SELECT user_id, month, type, category, total, count FROM monthly_rollups '
+                            + where, params):
+        actual[row[:4]] = (row[4], row[5])
+
+    drift = []
+    for key in sorted(set(expected) | set(actual)):
+        stored = actual.get(key)
+        wanted = expected.get(key)
+        if (stored is None or wanted is None or stored[1] != wanted[1]
+                or abs(stored[0] - wanted[0]) > TOTAL_TOLERANCE):
+            drift.append({
+                'user_id': key[0],
+                'month': key[1],
+                'type': key[2],
+                'category': key[3],
+                'stored': stored,
+                'expected': wanted,
+            })
+    return drift
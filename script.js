@@ -2,6 +2,24 @@
 let currentUser = null;
 let categoryChart = null;
 let monthlyChart = null;
+let transactionsCursor = null;
+let transactionsShown = 0;
+let uploadJobId = null;
+
+const TRANSACTIONS_PAGE_SIZE = 50;
+
+// Category keywords, mirrored from the server-side classifier
+const categoryKeywords = {
+    'groceries': ['food', 'grocery', 'supermarket', 'market', 'fresh', 'organic', 'produce'],
+    'transportation': ['uber', 'lyft', 'taxi', 'gas', 'fuel', 'parking', 'metro', 'bus', 'train'],
+    'entertainment': ['movie', 'theater', 'concert', 'game', 'netflix', 'spotify', 'amazon prime'],
+    'utilities': ['electric', 'water', 'gas', 'internet', 'phone', 'cable', 'wifi'],
+    'shopping': ['amazon', 'walmart', 'target', 'clothing', 'shoes', 'electronics'],
+    'dining': ['restaurant', 'cafe', 'coffee', 'pizza', 'burger', 'sushi', 'dinner', 'lunch'],
+    'healthcare': ['pharmacy', 'doctor', 'medical', 'dental', 'vision', 'insurance'],
+    'education': ['book', 'course', 'tuition', 'school', 'college', 'university'],
+    'travel': ['hotel', 'flight', 'airbnb', 'vacation', 'trip', 'booking']
+};
 
 // DOM elements
 const authSection = document.getElementById('auth-section');
@@ -67,6 +85,11 @@ function setupEventListeners() {
         uploadForm.addEventListener('submit', handleUploadCSV);
     }
     
+    const uploadCancel = document.getElementById('upload-cancel');
+    if (uploadCancel) {
+        uploadCancel.addEventListener('click', cancelUpload);
+    }
+    
     // Category auto-detection
     const descriptionInput = document.getElementById('description');
     if (descriptionInput) {
@@ -79,6 +102,23 @@ function setupEventListeners() {
     if (typeFilter) typeFilter.addEventListener('change', filterTransactions);
     if (categoryFilter) categoryFilter.addEventListener('change', filterTransactions);
     
+    // Full-text search, reloaded once typing pauses
+    const searchFilter = document.getElementById('search-filter');
+    if (searchFilter) {
+        let searchTimer = null;
+        searchFilter.addEventListener('input', () => {
+            clearTimeout(searchTimer);
+            searchTimer = setTimeout(filterTransactions, 250);
+        });
+    }
+    updateCategoryFilter();
+    
+    // Pagination
+    const loadMoreButton = document.getElementById('load-more');
+    if (loadMoreButton) {
+        loadMoreButton.addEventListener('click', () => loadTransactions(true));
+    }
+    
     // Notification close
     notificationClose.addEventListener('click', hideNotification);
 }
@@ -206,10 +246,15 @@ function handleNavigation(e) {
 }
 
 function handleLogout() {
+    // Revoke the token on the server too; local state is cleared either way
+    apiCall('/logout', { method: 'POST' }).catch(() => {});
+    
     localStorage.removeItem('token');
     localStorage.removeItem('user_id');
     localStorage.removeItem('username');
     currentUser = null;
+    // Stops polling the upload job, which belongs to this user
+    hideUploadProgress();
     showAuth();
     showNotification('Logged out successfully', 'success');
 }
@@ -229,11 +274,15 @@ async function apiCall(endpoint, options = {}) {
 
 async function loadDashboard() {
     try {
-        const response = await apiCall('/analytics');
+        const [response, seriesResponse] = await Promise.all([
+            apiCall('/analytics'),
+            apiCall('/analytics/timeseries?bucket=month')
+        ]);
         const data = await response.json();
+        const series = await seriesResponse.json();
         
-        if (response.ok) {
-            updateDashboard(data);
+        if (response.ok && seriesResponse.ok) {
+            updateDashboard(data, series);
         } else {
             showNotification('Failed to load dashboard data', 'error');
         }
@@ -242,7 +291,7 @@ async function loadDashboard() {
     }
 }
 
-function updateDashboard(data) {
+function updateDashboard(data, series) {
     // Update summary cards
     document.getElementById('total-income').textContent = formatCurrency(data.summary.total_income);
     document.getElementById('total-expenses').textContent = formatCurrency(data.summary.total_expenses);
@@ -250,7 +299,7 @@ function updateDashboard(data) {
     
     // Update charts
     updateCategoryChart(data.categories);
-    updateMonthlyChart(data.recent_transactions);
+    updateMonthlyChart(series);
     
     // Update insights
     updateInsights(data.insights);
@@ -291,7 +340,8 @@ function updateCategoryChart(categories) {
     });
 }
 
-function updateMonthlyChart(transactions) {
+// Monthly income and expense totals from /analytics/timeseries
+function updateMonthlyChart(series) {
     const ctx = document.getElementById('monthly-chart');
     if (!ctx) return;
     
@@ -299,23 +349,9 @@ function updateMonthlyChart(transactions) {
         monthlyChart.destroy();
     }
     
-    // Group transactions by date
-    const groupedData = {};
-    transactions.forEach(transaction => {
-        const date = transaction.date;
-        if (!groupedData[date]) {
-            groupedData[date] = { income: 0, expense: 0 };
-        }
-        if (transaction.type === 'income') {
-            groupedData[date].income += transaction.amount;
-        } else {
-            groupedData[date].expense += transaction.amount;
-        }
-    });
-    
-    const dates = Object.keys(groupedData).sort();
-    const incomeData = dates.map(date => groupedData[date].income);
-    const expenseData = dates.map(date => groupedData[date].expense);
+    const dates = series.labels;
+    const incomeData = series.income;
+    const expenseData = series.expenses;
     
     monthlyChart = new Chart(ctx, {
         type: 'line',
@@ -335,6 +371,14 @@ function updateMonthlyChart(transactions) {
                     borderColor: '#f44336',
                     backgroundColor: 'rgba(244, 67, 54, 0.1)',
                     tension: 0.4
+                },
+                {
+                    label: `Net (${series.rolling.window}-month average)`,
+                    data: series.rolling.net,
+                    borderColor: '#2196F3',
+                    borderDash: [5, 5],
+                    fill: false,
+                    tension: 0.4
                 }
             ]
         },
@@ -374,14 +418,42 @@ function updateInsights(insights) {
     });
 }
 
-async function loadTransactions() {
+// Fetch one page of transactions; filtering and pagination happen server-side
+async function loadTransactions(append = false) {
+    if (!append) {
+        transactionsCursor = null;
+    }
+    
+    const params = new URLSearchParams({ limit: TRANSACTIONS_PAGE_SIZE });
+    const searchFilter = document.getElementById('search-filter');
+    const typeFilter = document.getElementById('type-filter');
+    const categoryFilter = document.getElementById('category-filter');
+    const query = searchFilter ? searchFilter.value.trim() : '';
+    
+    // Searches are ranked by relevance and ignore the type and category filters
+    let endpoint = '/transactions';
+    if (query) {
+        endpoint = '/transactions/search';
+        params.set('q', query);
+    } else {
+        params.set('format', 'columnar');
+        if (typeFilter && typeFilter.value) params.set('type', typeFilter.value);
+        if (categoryFilter && categoryFilter.value) params.set('category', categoryFilter.value);
+    }
+    if (transactionsCursor) params.set('cursor', transactionsCursor);
+    
     try {
-        const response = await apiCall('/transactions');
+        const response = await apiCall(`${endpoint}?${params}`);
         const transactions = await response.json();
         
         if (response.ok) {
-            displayTransactions(transactions);
-            updateCategoryFilter(transactions);
+            if (!append) {
+                transactionsShown = 0;
+                const totalCount = response.headers.get('X-Total-Count');
+                updateTransactionsCount(totalCount === null ? null : parseInt(totalCount, 10));
+            }
+            transactionsCursor = response.headers.get('X-Next-Cursor');
+            displayTransactions(transactions, append);
         } else {
             showNotification('Failed to load transactions', 'error');
         }
@@ -390,21 +462,54 @@ async function loadTransactions() {
     }
 }
 
-function displayTransactions(transactions) {
+function updateTransactionsCount(totalCount) {
+    const loadMoreButton = document.getElementById('load-more');
+    if (!loadMoreButton) return;
+    
+    // Search results come without a total
+    if (totalCount === null) {
+        delete loadMoreButton.dataset.total;
+    } else {
+        loadMoreButton.dataset.total = totalCount;
+    }
+}
+
+// Takes either an array of transactions (search results) or a listing in
+// format=columnar: parallel arrays, with type and category sent as codes
+// into their lists of values
+function displayTransactions(transactions, append = false) {
     const container = document.getElementById('transactions-list');
     if (!container) return;
     
-    container.innerHTML = '';
+    if (!append) {
+        container.innerHTML = '';
+    }
+    
+    const columnar = !Array.isArray(transactions);
+    const count = columnar ? transactions.id.length : transactions.length;
+    transactionsShown += count;
+    updateLoadMoreButton();
     
-    if (transactions.length === 0) {
+    if (transactionsShown === 0) {
         container.innerHTML = '<div class="transaction-item">No transactions found. Add your first transaction!</div>';
         return;
     }
     
-    transactions.forEach(transaction => {
-        const transactionElement = createTransactionElement(transaction);
-        container.appendChild(transactionElement);
-    });
+    for (let i = 0; i < count; i++) {
+        const transaction = columnar ? columnarTransaction(transactions, i) : transactions[i];
+        container.appendChild(createTransactionElement(transaction));
+    }
+}
+
+function columnarTransaction(columns, i) {
+    return {
+        id: columns.id[i],
+        description: columns.description[i],
+        amount: columns.amount[i],
+        type: columns.type.values[columns.type.codes[i]],
+        category: columns.category.values[columns.category.codes[i]],
+        date: columns.date[i]
+    };
 }
 
 function createTransactionElement(transaction) {
@@ -418,7 +523,9 @@ function createTransactionElement(transaction) {
         <div class="transaction-info">
             <div class="transaction-description">${transaction.description}</div>
             <div class="transaction-meta">
-                <span>${transaction.category}</span>
+                <select class="category-select" onchange="correctCategory(${transaction.id}, this.value)">
+                    ${categoryOptions(transaction.category)}
+                </select>
                 <span>${transaction.date}</span>
             </div>
         </div>
@@ -435,11 +542,51 @@ function createTransactionElement(transaction) {
     return element;
 }
 
-function updateCategoryFilter(transactions) {
+function categoryOptions(selected) {
+    return [...Object.keys(categoryKeywords), 'other']
+        .map(category => `<option value="${category}"${category === selected ? ' selected' : ''}>${category}</option>`)
+        .join('');
+}
+
+// Corrections are stored server-side and train the user's classifier
+async function correctCategory(id, category) {
+    try {
+        const response = await apiCall(`/transactions/${id}/category`, {
+            method: 'POST',
+            body: JSON.stringify({ category })
+        });
+        
+        const data = await response.json();
+        
+        if (response.ok) {
+            showNotification('Category updated', 'success');
+            loadDashboard();
+        } else {
+            showNotification(data.error, 'error');
+        }
+    } catch (error) {
+        showNotification('Failed to update category', 'error');
+    }
+}
+
+function updateLoadMoreButton() {
+    const loadMoreButton = document.getElementById('load-more');
+    if (!loadMoreButton) return;
+    
+    if (transactionsCursor) {
+        const total = loadMoreButton.dataset.total;
+        loadMoreButton.textContent = total ? `Load more (${transactionsShown} of ${total})` : 'Load more';
+        loadMoreButton.classList.remove('hidden');
+    } else {
+        loadMoreButton.classList.add('hidden');
+    }
+}
+
+function updateCategoryFilter() {
     const categoryFilter = document.getElementById('category-filter');
     if (!categoryFilter) return;
     
-    const categories = [...new Set(transactions.map(t => t.category))];
+    const categories = [...Object.keys(categoryKeywords), 'other'];
     
     // Clear existing options except "All Categories"
     categoryFilter.innerHTML = '<option value="">All Categories</option>';
@@ -453,19 +600,7 @@ function updateCategoryFilter(transactions) {
 }
 
 function filterTransactions() {
-    const typeFilter = document.getElementById('type-filter').value;
-    const categoryFilter = document.getElementById('category-filter').value;
-    const transactions = document.querySelectorAll('.transaction-item');
-    
-    transactions.forEach(transaction => {
-        const type = transaction.dataset.type;
-        const category = transaction.dataset.category;
-        
-        const typeMatch = !typeFilter || type === typeFilter;
-        const categoryMatch = !categoryFilter || category === categoryFilter;
-        
-        transaction.style.display = typeMatch && categoryMatch ? 'flex' : 'none';
-    });
+    loadTransactions();
 }
 
 async function handleAddTransaction(e) {
@@ -558,10 +693,10 @@ async function handleUploadCSV(e) {
         const data = await response.json();
         
         if (response.ok) {
-            showNotification(data.message, 'success');
             fileInput.value = '';
-            loadDashboard();
-            loadTransactions();
+            uploadJobId = data.job_id;
+            showUploadProgress(null);
+            pollUploadJob(data.job_id);
         } else {
             showNotification(data.error, 'error');
         }
@@ -572,6 +707,96 @@ async function handleUploadCSV(e) {
     }
 }
 
+// Imports run in the background; poll the job until it finishes. Polling
+// stops when the user logs out or another upload replaces this one.
+async function pollUploadJob(jobId) {
+    if (!currentUser || uploadJobId !== jobId) return;
+    
+    let response;
+    try {
+        response = await apiCall(`/upload/${jobId}`);
+    } catch (error) {
+        // Network error: try again
+        setTimeout(() => pollUploadJob(jobId), 1000);
+        return;
+    }
+    if (!currentUser || uploadJobId !== jobId) return;
+    
+    try {
+        const job = await response.json();
+        
+        if (!response.ok) {
+            showNotification(job.error, 'error');
+            hideUploadProgress();
+            return;
+        }
+        
+        showUploadProgress(job);
+        if (job.status === 'queued' || job.status === 'running' || job.status === 'cancelling') {
+            setTimeout(() => pollUploadJob(jobId), 1000);
+            return;
+        }
+        
+        hideUploadProgress();
+        if (job.status === 'completed') {
+            let message = `Successfully imported ${job.imported} transactions`;
+            if (job.skipped) {
+                message += `, ${job.skipped} already imported`;
+            }
+            if (job.failed) {
+                message += ` (${job.failed} rows skipped due to errors)`;
+            }
+            showNotification(message, 'success');
+        } else if (job.status === 'cancelled') {
+            showNotification(`Import cancelled after ${job.imported} transactions`, 'error');
+        } else {
+            showNotification(job.error, 'error');
+        }
+        if (job.imported) {
+            loadDashboard();
+            loadTransactions();
+        }
+    } catch (error) {
+        showNotification('Failed to check import progress', 'error');
+        hideUploadProgress();
+    }
+}
+
+function showUploadProgress(job) {
+    const progress = job ? job.progress : 0;
+    let text = 'Waiting to start...';
+    if (job && job.status !== 'queued') {
+        text = `${job.processed.toLocaleString()} rows processed, ${job.failed.toLocaleString()} failed`;
+        if (job.rows_per_second) {
+            text += ` (${Math.round(job.rows_per_second).toLocaleString()} rows/s)`;
+        }
+    }
+    
+    document.getElementById('upload-progress').classList.remove('hidden');
+    document.getElementById('upload-progress-fill').style.width = `${Math.round(progress * 100)}%`;
+    document.getElementById('upload-progress-text').textContent = text;
+}
+
+function hideUploadProgress() {
+    uploadJobId = null;
+    document.getElementById('upload-progress').classList.add('hidden');
+}
+
+async function cancelUpload() {
+    if (!uploadJobId) return;
+    
+    try {
+        await fetch(`/upload/${uploadJobId}/cancel`, {
+            method: 'POST',
+            headers: {
+                'Authorization': `Bearer ${currentUser.token}`
+            }
+        });
+    } catch (error) {
+        showNotification('Failed to cancel import', 'error');
+    }
+}
+
 function autoDetectCategory() {
     const description = document.getElementById('description').value;
     const categoryInput = document.getElementById('category');
@@ -581,18 +806,6 @@ function autoDetectCategory() {
         const descriptionLower = description.toLowerCase();
         let detectedCategory = 'other';
         
-        const categoryKeywords = {
-            'groceries': ['food', 'grocery', 'supermarket', 'market', 'fresh', 'organic', 'produce'],
-            'transportation': ['uber', 'lyft', 'taxi', 'gas', 'fuel', 'parking', 'metro', 'bus', 'train'],
-            'entertainment': ['movie', 'theater', 'concert', 'game', 'netflix', 'spotify', 'amazon prime'],
-            'utilities': ['electric', 'water', 'gas', 'internet', 'phone', 'cable', 'wifi'],
-            'shopping': ['amazon', 'walmart', 'target', 'clothing', 'shoes', 'electronics'],
-            'dining': ['restaurant', 'cafe', 'coffee', 'pizza', 'burger', 'sushi', 'dinner', 'lunch'],
-            'healthcare': ['pharmacy', 'doctor', 'medical', 'dental', 'vision', 'insurance'],
-            'education': ['book', 'course', 'tuition', 'school', 'college', 'university'],
-            'travel': ['hotel', 'flight', 'airbnb', 'vacation', 'trip', 'booking']
-        };
-        
         for (const [category, keywords] of Object.entries(categoryKeywords)) {
             if (keywords.some(keyword => descriptionLower.includes(keyword))) {
                 detectedCategory = category;
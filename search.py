@@ -0,0 +1,34 @@
+import re
+
+# Full-text search over transaction descriptions, backed by the
+# transactions_fts index (see migration 7). Every word of the query must
+# match the start of a word in the description, so "star coff" finds
+# "Starbucks Coffee". Results are ordered by bm25 relevance.
+
+# Words beyond this are ignored; long queries only get slower, not better
+MAX_QUERY_TERMS = 8
+
+WORD_PATTERN = re.compile(r'\w+')
+
+SEARCH_SQL = '''
+    SELECT t.id, t.description, t.amount, t.type, t.category, t.date
+    FROM transactions_fts
+    JOIN transactions t ON t.id = transactions_fts.rowid
+    WHERE transactions_fts MATCH ? AND t.user_id = ?
+    ORDER BY transactions_fts.rank, t.id DESC
+    LIMIT ? OFFSET ?
+'''
+
+
+# Build an FTS5 query from free text, or None when it has no words. Terms are
+# quoted so user input can never be read as FTS5 syntax.
+def build_match(user_id, text):
+    terms = WORD_PATTERN.findall(text.lower())[:MAX_QUERY_TERMS]
+    if not terms:
+        return None
+    words = ' AND '.join(f'description : "{term}" *' for term in terms)
+    return f'search_owner : "u{user_id}" AND {words}'
+
+
+def search(conn, user_id, match, limit, offset):
+    return conn.execute(SEARCH_SQL, (match, user_id, limit, offset)).fetchall()
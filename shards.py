@@ -0,0 +1,247 @@
+import bisect
+import hashlib
+
+import cache
+import columnar
+import db
+import migrations
+
+# Shard placement and online moves.
+#
+# A new user is placed on the shard that owns their id on a consistent-hash
+# ring over the shard names, and the choice is recorded in user_shards in
+# the main database. Lookups always go through user_shards, so the ring only
+# decides where users should be: changing FINANCE_DB_SHARDS moves no data by
+# itself, and `flask rebalance-shards` then moves each user whose recorded
+# shard differs from the ring's choice. Growing from N to N+1 shards moves
+# about 1/(N+1) of the users; with 0 shards everyone moves back to main.
+#
+# A move copies the user's rows while writes continue, then takes the source
+# database's write lock, checks the user's data version has not changed
+# (copying again if it has), deletes the source rows, fences the user there
+# with data_versions.moved_to and switches user_shards. Requests that looked
+# up the old placement just before the switch fail with db.UserMoved rather
+# than writing to or caching the old copy. Run one rebalance at a time.
+
+VNODES = 64
+
+# Each database hands out transaction ids from its own range. Moved rows get
+# new ids in the target's range (AUTOINCREMENT continues after the largest id
+# in a table, so keeping foreign ids would push the target into another
+# range), which means an id a client kept from before a move is never reused
+# for one of that user's rows: it is simply not found. The main database uses
+# the first range. 64 ranges fit the columnar cache's keys.
+ID_RANGE = 1 << 34
+
+# Copies attempted while writes continue before copying under the lock
+COPY_ATTEMPTS = 3
+COPY_BATCH_SIZE = 10000
+
+# Tables holding a user's data, and whether rows keep their id when moved
+USER_TABLES = (
+    ('transactions', False),
+    ('monthly_rollups', True),
+    ('categories', False),
+    ('import_jobs', True),
+)
+
+ACTIVE_JOBS_SQL = "SELECT COUNT(*) FROM import_jobs WHERE user_id = ? AND status IN ('queued', 'running')"
+
+
+class MoveError(Exception):
+    pass
+
+
+def _hash(value):
+    return int.from_bytes(hashlib.blake2b(value.encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+class HashRing:
+    def __init__(self, names, vnodes=VNODES):
+        points = sorted((_hash(f'{name}#{index}'), name) for name in names for index in range(vnodes))
+        self._hashes = [point for point, _ in points]
+        self._names = [name for _, name in points]
+
+    # The shard that should hold the user's data, or main without shards
+    def owner(self, user_id):
+        if not self._names:
+            return db.MAIN
+        index = bisect.bisect(self._hashes, _hash(f'user:{user_id}')) % len(self._hashes)
+        return self._names[index]
+
+
+def get_ring(app):
+    names = tuple(name for name in db.database_paths(app) if name != db.MAIN)
+    ring = app.extensions.get('shard_ring')
+    if ring is None or ring[0] != names:
+        ring = app.extensions['shard_ring'] = (names, HashRing(names))
+    return ring[1]
+
+
+# Record where a new user's data goes, in the transaction creating the user
+def place_user(cursor, app, user_id):
+    shard = get_ring(app).owner(user_id)
+    if shard != db.MAIN:
+        cursor.execute('INSERT INTO user_shards (user_id, shard) VALUES (?, ?)', (user_id, shard))
+
+
+# Migrate every database and start each shard's transaction ids in its range
+def init_databases(app):
+    paths = db.database_paths(app)
+    if len(paths) * ID_RANGE > columnar.ID_SPACE:
+        raise ValueError(f'At most {columnar.ID_SPACE // ID_RANGE - 1} shards are supported')
+    for number, name in enumerate(paths):
+        with db.get_pool(app, name).connection() as conn:
+            migrations.migrate(conn)
+            reserve_ids(conn, number * ID_RANGE)
+    # Users on shards no longer configured would silently see no data
+    with db.get_pool(app).connection() as conn:
+        missing = [row[0] for row in conn.execute('SELECT DISTINCT shard FROM user_shards') if row[0] not in paths]
+    if missing:
+        raise ValueError(f'Users still live on {", ".join(missing)}; move them before removing shards')
+
+
+def reserve_ids(conn, start):
+    if not start:
+        return
+    cursor = conn.execute("UPDATE sqlite_sequence SET seq = ? WHERE name = 'transactions' AND seq < ?",
+                          (start, start))
+    if not cursor.rowcount and conn.execute("SELECT 1 FROM sqlite_sequence WHERE name = 'transactions'").fetchone() is None:
+        conn.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('transactions', ?)", (start,))
+    conn.commit()
+
+
+def _columns(conn, table, keep_id):
+    # Generated columns are hidden and cannot be inserted
+    return [row[1] for row in conn.execute(f'PRAGMA table_xinfo({table})')
+            if row[6] == 0 and (keep_id or row[1] != 'id')]
+
+
+# Copy the user's rows, committing each batch; returns the transactions copied
+def _copy(source, target, user_id):
+    copied = 0
+    for table, keep_id in USER_TABLES:
+        columns = _columns(source, table, keep_id)
+        insert = f'INSERT INTO {table} ({", ".join(columns)}) VALUES ({", ".join("?" * len(columns))})'
+        rows = source.execute(f'SELECT {", ".join(columns)} FROM {table} WHERE user_id = ?', (user_id,))
+        while True:
+            batch = rows.fetchmany(COPY_BATCH_SIZE)
+            if not batch:
+                break
+            target.executemany(insert, batch)
+            target.commit()
+            if table == 'transactions':
+                copied += len(batch)
+    return copied
+
+
+def _purge(conn, user_id):
+    for table, _ in USER_TABLES:
+        conn.execute(f'DELETE FROM {table} WHERE user_id = ?', (user_id,))
+
+
+def _set_placement(conn, user_id, name):
+    if name == db.MAIN:
+        conn.execute('DELETE FROM user_shards WHERE user_id = ?', (user_id,))
+    else:
+        conn.execute('INSERT OR REPLACE INTO user_shards (user_id, shard) VALUES (?, ?)', (user_id, name))
+
+
+# Fence the user in conn: later reads and writes there raise db.UserMoved
+def _fence(conn, user_id, target):
+    conn.execute('''
+        INSERT INTO data_versions (user_id, version, moved_to) VALUES (?, 0, ?)
+        ON CONFLICT (user_id) DO UPDATE SET moved_to = excluded.moved_to
+    ''', (user_id, target))
+
+
+# Move one user's data to the named database while the app keeps serving.
+# Returns the number of transactions moved.
+def move_user(app, user_id, target):
+    if target not in db.database_paths(app):
+        raise MoveError(f'Unknown database {target}')
+    main_pool = db.get_pool(app)
+    with main_pool.connection() as main:
+        source = db.placement(main, user_id)
+    if source == target:
+        return 0
+
+    with db.get_pool(app, source).connection() as src, db.get_pool(app, target).connection() as dst:
+        for attempt in range(COPY_ATTEMPTS + 1):
+            # The last attempt copies while holding the source's write lock
+            locked = attempt == COPY_ATTEMPTS
+            try:
+                src.execute('BEGIN IMMEDIATE' if locked else 'BEGIN')
+                version = cache.get_data_version(src, user_id)
+                if src.execute(ACTIVE_JOBS_SQL, (user_id,)).fetchone()[0]:
+                    raise MoveError(f'User {user_id} has import jobs in progress')
+                # Leftovers of an interrupted move are replaced
+                _purge(dst, user_id)
+                dst.commit()
+                moved = _copy(src, dst, user_id)
+                # A new version, since transaction ids changed
+                dst.execute('INSERT OR REPLACE INTO data_versions (user_id, version) VALUES (?, ?)',
+                            (user_id, version + 1))
+                dst.commit()
+
+                if not locked:
+                    src.rollback()
+                    src.execute('BEGIN IMMEDIATE')
+                    if (cache.get_data_version(src, user_id) != version
+                            or src.execute(ACTIVE_JOBS_SQL, (user_id,)).fetchone()[0]):
+                        # Written to during the copy
+                        src.rollback()
+                        continue
+
+                _purge(src, user_id)
+                _fence(src, user_id, target)
+                if source == db.MAIN:
+                    # Placement and source rows change in one transaction
+                    _set_placement(src, user_id, target)
+                else:
+                    with main_pool.connection() as main:
+                        _set_placement(main, user_id, target)
+                        main.commit()
+                src.commit()
+                return moved
+            except Exception:
+                src.rollback()
+                dst.rollback()
+                raise
+
+
+# (user_id, current database, ring's choice) for users in the wrong place
+def plan_moves(app):
+    ring = get_ring(app)
+    with db.get_pool(app).connection() as main:
+        users = [row[0] for row in main.execute('SELECT id FROM users ORDER BY id')]
+        placements = dict(main.execute('SELECT user_id, shard FROM user_shards').fetchall())
+    moves = []
+    for user_id in users:
+        current = placements.get(user_id, db.MAIN)
+        target = ring.owner(user_id)
+        if current != target:
+            moves.append((user_id, current, target))
+    return moves
+
+
+# Remove data left in a database that is not the user's placement by a move
+# interrupted between switching user_shards and committing the source.
+# Returns the number of users cleaned up.
+def sweep_orphans(app):
+    with db.get_pool(app).connection() as main:
+        placements = dict(main.execute('SELECT user_id, shard FROM user_shards').fetchall())
+    swept = 0
+    for name in db.database_paths(app):
+        with db.get_pool(app, name).connection() as conn:
+            # Rows copied by a move that never switched have no data version yet
+            present = [row[0] for row in conn.execute('SELECT user_id FROM data_versions WHERE moved_to IS NULL '
+                                                      'UNION SELECT user_id FROM transactions')]
+            for user_id in present:
+                placed = placements.get(user_id, db.MAIN)
+                if placed != name:
+                    _purge(conn, user_id)
+                    _fence(conn, user_id, placed)
+                    swept += 1
+            conn.commit()
+    return swept
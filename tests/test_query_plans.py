@@ -0,0 +1,58 @@
+import itertools
+import os
+import sys
+
+import pytest
+from werkzeug.datastructures import MultiDict
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import app as finance_app
+import db
+import migrations
+
+# GET /transactions filters, combined in every way the endpoint accepts
+FILTER_ARGS = {
+    'type': 'expense',
+    'category': 'dining',
+    'from': '2024-01-01',
+    'to': '2024-12-31',
+}
+
+
+def listing_queries():
+    queries = []
+    for size in range(len(FILTER_ARGS) + 1):
+        for names in itertools.combinations(FILTER_ARGS, size):
+            is_valid, result = finance_app.parse_transaction_filters(
+                MultiDict({name: FILTER_ARGS[name] for name in names}))
+            assert is_valid, result
+            clauses, params, _, limit, _ = result
+            filters = ''.join(' AND ' + clause for clause in clauses)
+            label = '+'.join(names) or 'unfiltered'
+            queries.append((f'list_transactions[{label}]',
+                            finance_app.LIST_TRANSACTIONS_SQL.format(filters=filters),
+                            [1] + params + [limit + 1]))
+            queries.append((f'list_transactions_page[{label}]',
+                            finance_app.LIST_TRANSACTIONS_SQL.format(filters=filters + ' AND (date, id) < (?, ?)'),
+                            [1] + params + ['2024-06-30', 100, limit + 1]))
+            queries.append((f'transaction_totals[{label}]',
+                            finance_app.TRANSACTION_TOTALS_SQL.format(filters=filters),
+                            [1] + params))
+    return queries
+
+
+@pytest.fixture
+def conn(tmp_path):
+    finance_app.app.config['DATABASE'] = str(tmp_path / 'finance.db')
+    finance_app.init_db()
+    with db.get_pool(finance_app.app).connection() as conn:
+        yield conn
+
+
+def test_hot_queries_use_indexes(conn):
+    assert migrations.find_full_scans(conn, finance_app.HOT_QUERIES) == []
+
+
+def test_transaction_listings_use_indexes(conn):
+    assert migrations.find_full_scans(conn, listing_queries()) == []
@@ -0,0 +1,149 @@
+import datetime
+
+import numpy as np
+
+import columnar
+from migrations import month_key
+
+# Income/expense time series over day, week or month buckets.
+#
+# Rows are fetched as (bucket index, is expense, category, amount) tuples
+# with the bucket arithmetic done in SQL, then turned into NumPy columns and
+# reduced with bincount and cumsum, so there is no per-row Python loop.
+# Day and week buckets start from daily totals, or from the user's cached
+# columns when the columnar cache has them; month buckets are read from
+# monthly_rollups instead of raw transactions.
+
+BUCKETS = ('day', 'week', 'month')
+MAX_BUCKETS = 3700
+DEFAULT_WINDOW = 3
+
+# Pre-aggregated per day, type and category while walking the covering
+# (user_id, type, date, category, amount) index, so at most one row per day
+# and category reaches Python however many transactions the user has
+RAW_ROWS_SQL = '''
+    SELECT CAST(julianday(date) - julianday(?) AS INTEGER),
+        type = 'expense', COALESCE(category, 'other'), SUM(amount)
+    FROM transactions
+    WHERE user_id = ? AND type IN ('income', 'expense') AND date >= ? AND date <= ?
+    GROUP BY type, date, category
+'''
+
+ROLLUP_ROWS_SQL = '''
+    SELECT (month / 100) * 12 + month % 100 - ?, type = 'expense', category, total
+    FROM monthly_rollups
+    WHERE user_id = ? AND month >= ? AND month <= ?
+'''
+
+
+def _month_number(date):
+    return date.year * 12 + date.month - 1
+
+
+# Default range ending at `end`: 30 days, 12 weeks or 12 months
+def default_start(bucket, end):
+    if bucket == 'day':
+        return end - datetime.timedelta(days=29)
+    if bucket == 'week':
+        return end - datetime.timedelta(weeks=11)
+    first = _month_number(end) - 11
+    return datetime.date(first // 12, first % 12 + 1, 1)
+
+
+# Return (bucket labels, SQL, params) covering start..end inclusive
+def plan_buckets(user_id, bucket, start, end):
+    if bucket == 'day':
+        size = (end - start).days + 1
+        labels = [(start + datetime.timedelta(days=i)).isoformat() for i in range(size)]
+        sql = RAW_ROWS_SQL
+        params = (start.isoformat(), user_id, start.isoformat(), end.isoformat())
+    elif bucket == 'week':
+        # Weeks start on Monday
+        origin = start - datetime.timedelta(days=start.weekday())
+        size = (end - origin).days // 7 + 1
+        labels = [(origin + datetime.timedelta(weeks=i)).isoformat() for i in range(size)]
+        sql = RAW_ROWS_SQL
+        params = (origin.isoformat(), user_id, start.isoformat(), end.isoformat())
+    else:
+        first = _month_number(start)
+        size = _month_number(end) - first + 1
+        labels = [f'{(first + i) // 12:04d}-{(first + i) % 12 + 1:02d}' for i in range(size)]
+        sql = ROLLUP_ROWS_SQL
+        # month / 100 * 12 + month % 100 is the month number plus one
+        params = (first + 1, user_id, month_key(start.isoformat()), month_key(end.isoformat()))
+    return labels, sql, params
+
+
+# Trailing average over `window` buckets; the first buckets average what is available
+def rolling_mean(values, window):
+    cumulative = np.concatenate(([0.0], np.cumsum(values)))
+    positions = np.arange(1, len(values) + 1)
+    lower = np.maximum(positions - window, 0)
+    return (cumulative[positions] - cumulative[lower]) / (positions - lower)
+
+
+def _rounded(values):
+    return np.round(np.asarray(values, dtype=np.float64), 2).tolist()
+
+
+def build_series(rows, labels, bucket, window):
+    if rows:
+        indexes, expense_flags, categories, amounts = zip(*rows)
+    else:
+        indexes, expense_flags, categories, amounts = (), (), (), ()
+    names, codes = np.unique(np.asarray(categories, dtype=object), return_inverse=True)
+    return series_from_columns(np.asarray(indexes, dtype=np.int64), np.asarray(expense_flags, dtype=bool),
+                               codes, names, np.asarray(amounts, dtype=np.float64), labels, bucket, window)
+
+
+# Same as build_series, from columns: day offsets, expense flags, category
+# codes into category_names (None meaning 'other') and amounts
+def series_from_columns(index, is_expense, category_codes, category_names, amount, labels, bucket, window):
+    size = len(labels)
+    if bucket == 'week':
+        index = index // 7
+
+    income = np.bincount(index[~is_expense], weights=amount[~is_expense], minlength=size)
+    expenses = np.bincount(index[is_expense], weights=amount[is_expense], minlength=size)
+    net = income - expenses
+
+    # Expense series per category: one bincount over category * size + bucket
+    category_totals = {}
+    if is_expense.any():
+        used, codes = np.unique(category_codes[is_expense], return_inverse=True)
+        grid = np.bincount(codes * size + index[is_expense], weights=amount[is_expense],
+                           minlength=len(used) * size).reshape(len(used), size)
+        for code, series in zip(used, grid):
+            name = category_names[code] or 'other'
+            category_totals[name] = category_totals[name] + series if name in category_totals else series
+    category_series = {name: _rounded(series) for name, series in sorted(category_totals.items())}
+
+    return {
+        'bucket': bucket,
+        'labels': labels,
+        'income': _rounded(income),
+        'expenses': _rounded(expenses),
+        'net': _rounded(net),
+        'cumulative_net': _rounded(np.cumsum(net)),
+        'categories': category_series,
+        'rolling': {
+            'window': window,
+            'income': _rounded(rolling_mean(income, window)),
+            'expenses': _rounded(rolling_mean(expenses, window)),
+            'net': _rounded(rolling_mean(net, window)),
+        },
+    }
+
+
+# columns are the user's columnar.UserColumns, used for day and week buckets
+def compute(conn, user_id, bucket, start, end, window=DEFAULT_WINDOW, columns=None):
+    labels, sql, params = plan_buckets(user_id, bucket, start, end)
+    if len(labels) > MAX_BUCKETS:
+        raise ValueError(f'Range too large (max {MAX_BUCKETS} {bucket} buckets)')
+    if columns is not None and bucket != 'month':
+        # params[0] is the first day of the first bucket
+        index, is_expense, category_codes, amount = columns.daily(params[0], start, end)
+        return series_from_columns(index, is_expense, category_codes, columnar.categories.values, amount,
+                                   labels, bucket, window)
+    rows = conn.execute(sql, params).fetchall()
+    return build_series(rows, labels, bucket, window)
@@ -0,0 +1,209 @@
+import atexit
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from flask import current_app
+
+import db
+import importer
+
+# Group-commit writer for transaction inserts.
+#
+# Every commit takes SQLite's single write lock and, depending on the
+# synchronous setting, an fsync. With the writer enabled, request handlers
+# hand validated rows to one dedicated thread instead of writing themselves.
+# The thread takes everything queued while its previous commit ran, plus
+# whatever arrives within GROUP_COMMIT_DELAY_MS, up to GROUP_COMMIT_MAX_ROWS
+# rows. It writes all of it in one transaction and then resolves each
+# caller's future with its new ids. Only that thread writes inserts, so
+# concurrent requests no longer race for the lock. The delay defaults to 0:
+# queueing during a commit already batches busy periods, and any wait is
+# added to every request when traffic is light.
+
+DEFAULT_WRITE_BEHIND = os.environ.get('FINANCE_WRITE_BEHIND', 'false').lower() == 'true'
+DEFAULT_DURABILITY = os.environ.get('FINANCE_WRITE_DURABILITY', 'normal').lower()
+DEFAULT_DELAY_MS = float(os.environ.get('FINANCE_GROUP_COMMIT_DELAY_MS', '0'))
+DEFAULT_MAX_ROWS = int(os.environ.get('FINANCE_GROUP_COMMIT_MAX_ROWS', '1000'))
+
+# Seconds a request waits for its rows to be committed
+WRITE_TIMEOUT = float(os.environ.get('FINANCE_WRITE_TIMEOUT', '10'))
+
+# Durability mode -> synchronous setting of the writer's connection.
+# full fsyncs the WAL on every commit; normal only at checkpoints, so a power
+# loss may drop the last commits but an app crash cannot; off never fsyncs.
+DURABILITY_MODES = {
+    'full': 'FULL',
+    'normal': 'NORMAL',
+    'off': 'OFF',
+}
+
+
+class WriterClosed(Exception):
+    pass
+
+
+class GroupCommitWriter:
+    def __init__(self, path, durability=DEFAULT_DURABILITY, delay_ms=DEFAULT_DELAY_MS,
+                 max_rows=DEFAULT_MAX_ROWS):
+        if durability not in DURABILITY_MODES:
+            raise ValueError(f'Unknown durability mode: {durability}')
+        self.path = path
+        self.durability = durability
+        self.delay = delay_ms / 1000
+        self.max_rows = max_rows
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._closed = False
+        self.commits = 0
+        self.rows = 0
+        self.requests = 0
+
+    def _start(self):
+        self._thread = threading.Thread(target=self._run, name='group-commit-writer', daemon=True)
+        self._thread.start()
+
+    # Queue (description, amount, type, category, date) rows for user_id.
+    # The returned future resolves to the new ids once they are committed.
+    def submit(self, user_id, rows):
+        future = Future()
+        with self._lock:
+            if self._closed:
+                raise WriterClosed('Writer is shut down')
+            if self._thread is None:
+                self._start()
+            self._queue.put((user_id, rows, future))
+        return future
+
+    # Stop accepting rows, commit everything already queued and stop the thread
+    def close(self, timeout=None):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            if self._thread is None:
+                return
+            self._queue.put(None)
+        self._thread.join(timeout)
+
+    def stats(self):
+        return {
+            'durability': self.durability,
+            'commits': self.commits,
+            'rows': self.rows,
+            'requests': self.requests,
+            'rows_per_commit': round(self.rows / self.commits, 2) if self.commits else 0.0,
+        }
+
+    def _run(self):
+        conn = db.connect(self.path)
+        conn.execute(f'PRAGMA synchronous = {DURABILITY_MODES[self.durability]}')
+        try:
+            while True:
+                group, stopping = self._collect()
+                if group:
+                    self._commit(conn, group)
+                if stopping:
+                    break
+        finally:
+            conn.close()
+
+    # Block for the first request, then take more until the delay runs out or
+    # the group is full. Returns (requests, whether close() was called).
+    def _collect(self):
+        first = self._queue.get()
+        if first is None:
+            return [], True
+
+        group = [first]
+        size = len(first[1])
+        deadline = time.monotonic() + self.delay
+        while size < self.max_rows:
+            remaining = deadline - time.monotonic()
+            try:
+                item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                return group, True
+            group.append(item)
+            size += len(item[1])
+        return group, False
+
+    def _commit(self, conn, group):
+        group = [item for item in group if item[2].set_running_or_notify_cancel()]
+        if not group:
+            return
+        try:
+            cursor = conn.cursor()
+            results = [importer.insert_rows(cursor, user_id, rows) for user_id, rows, _ in group]
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            # One bad request must not fail the others, so retry them one by one
+            for item in group:
+                self._commit_one(conn, item)
+            return
+
+        self._record(group)
+        for (_, _, future), ids in zip(group, results):
+            future.set_result(ids)
+
+    def _commit_one(self, conn, item):
+        user_id, rows, future = item
+        try:
+            ids = importer.insert_rows(conn.cursor(), user_id, rows)
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            future.set_exception(e)
+            return
+        self._record([item])
+        future.set_result(ids)
+
+    def _record(self, group):
+        self.commits += 1
+        self.requests += len(group)
+        self.rows += sum(len(rows) for _, rows, _ in group)
+
+
+def init_app(app):
+    app.config.setdefault('WRITE_BEHIND', DEFAULT_WRITE_BEHIND)
+    app.config.setdefault('WRITE_DURABILITY', DEFAULT_DURABILITY)
+    app.config.setdefault('GROUP_COMMIT_DELAY_MS', DEFAULT_DELAY_MS)
+    app.config.setdefault('GROUP_COMMIT_MAX_ROWS', DEFAULT_MAX_ROWS)
+
+
+_writer_lock = threading.Lock()
+
+
+# The writer for the current request's database, or None when write-behind
+# is disabled. Each database has its own writer thread.
+def get_writer(app=None, name=None):
+    app = app or current_app
+    if not app.config['WRITE_BEHIND']:
+        return None
+    name = name or db.current_database()
+    writers = app.extensions.setdefault('transaction_writers', {})
+    writer = writers.get(name)
+    if writer is None:
+        with _writer_lock:
+            writer = writers.get(name)
+            if writer is None:
+                writer = GroupCommitWriter(db.database_paths(app)[name],
+                                           durability=app.config['WRITE_DURABILITY'],
+                                           delay_ms=app.config['GROUP_COMMIT_DELAY_MS'],
+                                           max_rows=app.config['GROUP_COMMIT_MAX_ROWS'])
+                writers[name] = writer
+                # Drain queued rows before the interpreter exits
+                atexit.register(writer.close)
+    return writer
+
+
+def close_writer(app):
+    writers = app.extensions.pop('transaction_writers', {})
+    for writer in writers.values():
+        writer.close()